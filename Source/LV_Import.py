@@ -3,27 +3,19 @@
 #from rpi5 import Run
 
 import time
-import spidev
 import datetime
-import csv
 import sys
-import gpiod
 import smbus
 import logging
+from PCCS_Plan import iter_events, event_counts
+from PCCS_Frame import FrameEncoder
+from PCCS_GPIO import PulseLines
+from PCCS_SPI import (SpiTransport, resync, ReadyPoll, run_interleaved, SettleStats, READY_TIMEOUT, SCAN_TIMEOUT,
+                      PROBE_SETTLE)
 
-chip = gpiod.Chip('gpiochip4')
-
-Pulse_En = chip.get_line(14)
-Pulse_En.request(consumer="Pulse_En", type=gpiod.LINE_REQ_DIR_OUT)
-
-Pulse_Send = chip.get_line(23)
-Pulse_Send.request(consumer="Pulse_Send", type=gpiod.LINE_REQ_DIR_OUT)
-
-Sys_Rst = chip.get_line(26)
-Sys_Rst.request(consumer="Sys_Rst", type=gpiod.LINE_REQ_DIR_OUT)
-
-OE = chip.get_line(15)
-OE.request(consumer="OE", type=gpiod.LINE_REQ_DIR_OUT)
+# The pulse path lines, requested together (see PCCS_GPIO). Only the 4 this program drives, Trigger_Send is left
+# free for another process
+pulse_lines = PulseLines(lines=("Sys_Rst", "OE", "Pulse_En", "Pulse_Send"))
 
 bus = smbus.SMBus(1)
 pot_addr = 0x2c
@@ -42,133 +34,58 @@ def log_timestamp(file_path="desync.log", event="Unknown Event"):
 
 
 def send_pulse():
-    Sys_Rst.set_value(0)
-    Sys_Rst.set_value(1)
-
-    OE.set_value(0)
-    Pulse_En.set_value(1)
+    pulse_lines.play("rise")
     print("Pulse  Allowed")
 
-    Pulse_Send.set_value(1)
     time.sleep(.1)
-    Pulse_Send.set_value(0)
 
-    Pulse_En.set_value(0)
-    OE.set_value(1)
+    pulse_lines.play("fall")
     print("Pulse No longer allowed")
 
 
 def send_fastpulse():
-    Sys_Rst.set_value(0)
-    Sys_Rst.set_value(1)
-
-    OE.set_value(0)
-    Pulse_En.set_value(1)
+    pulse_lines.play("rise")
     print("Pulse  Allowed")
 
-    Pulse_Send.set_value(1)
     time.sleep(1 / 300)  # 300Hz for DRS
-    Pulse_Send.set_value(0)
 
-    Pulse_En.set_value(0)
-    OE.set_value(1)
+    pulse_lines.play("fall")
     print("Pulse No longer allowed")
 
 
 class DetectorLayer:
-    def __init__(self, cs_id, detector_spi):
-        self.data_array = bytearray()
-        self.data_array2 = bytearray()  # New for slab, need 2 frames of data since we have 2*16 pot vals to account for
+    def __init__(self, cs_id, detector_spi, poll_ready=False):
+        # The frames are built into preallocated buffers by the shared encoder (see PCCS_Frame), the slab needs 2
+        # frames of data since we have 2*16 pot vals to account for
+        self.encoder = FrameEncoder()
 
         # The "previous array" will be used to ensure data security and fix desync,
         # The picos will return the first so many values received, these will be compared to the ones here
         self.previous_array = ()
         self.pico_return = None
+        # How many bytes behind the frames the Pico's echo runs, measured by the last resync (see PCCS_SPI.resync)
+        self.echo_shift = 0
+
+        # With poll_ready the Pico is polled until it is done with a frame instead of a fixed sleep (see
+        # PCCS_SPI.wait_ready), the *_task generators yield while it is busy so the Detector can interleave the layers
+        self.poll_ready = poll_ready
+        self.settle_stats = SettleStats()
+        self.status_seq = 0
 
         self.spi = detector_spi
         self.cs = cs_id
 
-    def setByteData(self, bool_data):
-
-        # print(bool_data)
-
-        pattern_bytes = bytearray()
-
-        # print(pattern_bytes)
-
-        if len(bool_data) == 32:
-            slab_bool = []
-            print("Slab run bool data raw", bool_data)
-            for i in range(0, len(bool_data), 2):
-                # Perform OR operation on each pair and append to the result
-                slab_bool.append((1 if bool_data[i] | bool_data[i + 1] else 0))
-            print("Slab run bool data appended: ", slab_bool)
-            bool_data = slab_bool
-
-        # Construct the first byte
-        byte1 = 0
-        for i in range(8):
-            if bool_data[i]:
-                byte1 |= (1 << (7 - i))  # Set the bit at position (7 - i) if the boolean value is True
-
-        # Construct the second byte
-        byte2 = 0
-        for i in range(8, 16):
-            if bool_data[i]:
-                byte2 |= (1 << (15 - i))  # Set the bit at position (15 - i) if the boolean value is True
-
-        print(byte1)
-        print(byte2)
-        pattern_bytes.append(byte1)
-        pattern_bytes.append(byte2)
-
-        self.data_array.extend(pattern_bytes)
-        self.data_array2.extend(pattern_bytes)
-        print(self.data_array)
-        print(self.data_array2)
-
-    def setVoltage(self, voltage):
-        voltage_bytes = bytearray()
-
-        for value in voltage:
-            value = int(value)  # Convert value to integer
-            voltage_bytes.append((value >> 8) & 0xFF)  # High byte
-            voltage_bytes.append(value & 0xFF)  # Low byte
-
-        print(f"Voltage bytes length: {len(voltage_bytes)}")
-        print(f"Voltage bytes content: {voltage_bytes}")
-
-        if len(voltage) == 32:
-            self.data_array.extend(voltage_bytes[:32])  # First 32 bytes
-            self.data_array2.extend(voltage_bytes[32:64])  # Next 32 bytes
-        else:
-            self.data_array.extend(voltage_bytes)
-
-        print(self.data_array)
-        print(self.data_array2)
-
     def set_data(self, chan_val):
-        print("Chan Val in Set Data", chan_val)
-        bool_data = [(val != '0' and val != '') for val in chan_val]  # lets pulse go to non zero channels
-        print("Bool Data in Set Data", bool_data)
-        voltage_data = chan_val
-        self.setByteData(bool_data)
-        self.setVoltage(voltage_data)
+        # Pattern bytes (non zero channels let the pulse through) and voltages, written into the frame buffers
+        # print("Chan Val in Set Data", chan_val)
+        self.encoder.set_data(chan_val)
 
     def send_data(self):
-        # Enable SPI
-        self.spi.open(0, self.cs)
-        self.spi.max_speed_hz = 50 * 1000
-        self.spi.mode = 0
-
         # print(data)
         # for byte in data:
-        #     self.spi.xfer3([byte])
-        opcode_data = bytearray()
-        opcode_data.extend([0xff, 0xff])
-        opcode_data.extend(self.data_array)
-        self.pico_return = self.spi.xfer3(opcode_data)
-        self.spi.close()
+        #     self.spi.transfer(self.cs, [byte])
+        opcode_data = self.encoder.bar_frame()
+        self.pico_return = self.spi.transfer(self.cs, opcode_data)
 
         self.verification(opcode_data)
 
@@ -181,129 +98,107 @@ class DetectorLayer:
         if(sum(self.pico_return) == 0):
             print("No Pico in this")
             self.previous_array = tuple(new_previous)
-            return
+            return False
         elif(self.pico_return[0:3] == [255,254,253,252] or self.previous_array == ()):
             print("initial loops")
             self.previous_array = tuple(new_previous)
-            return
-        elif(self.pico_return[0:3] == self.previous_array[0:3]):
+            return True
+        elif(self.pico_return[self.echo_shift:self.echo_shift + 3] == self.previous_array[0:3]):
             print("Verified Correct")
             self.previous_array = tuple(new_previous)
-            return
+            return True
         else:
             log_timestamp(event="Desync detected")
             print("Entering Desync Fixing")
             self.desync_protocol()
+            return False
+
+    def settle(self, frame, fixed, timeout=READY_TIMEOUT):
+        # Task that waits for the Pico to be done with frame (sent and verified), fixed is the sleep used without polling
+        if not self.poll_ready:
+            yield time.monotonic() + fixed
+            return True
+        self.status_seq += 1
+        result = yield ReadyPoll(self.spi, self.cs, frame, self.status_seq, timeout)
+        self.settle_stats.record(frame[1], result, fixed)
+        if result.ready:
+            self.previous_array = tuple(result.last_frame)
+            self.echo_shift = result.shift
+            yield time.monotonic() + PROBE_SETTLE
+        else:
+            print(f"Pico {self.cs} not done with frame 0x{frame[1]:02x} after {result.settle * 1000:.0f} ms")
+            log_timestamp(event=f"Pico {self.cs} not ready after frame 0x{frame[1]:02x}")
+        return result.ready
 
 
     def desync_protocol(self):
-        ## When desynced the pico is recieving the opcode and data in the wrong order.
-
-        self.spi.open(0, self.cs)
-        self.spi.max_speed_hz = 50*1000
-        self.spi.mode = 0
-
-        desync_test = bytearray()
-        desync_fix = bytearray()
-
-        desync_test.extend([i for i in range(36)]) # An array 0-35 in bytes
-        print(desync_test)
-        time.sleep(0.5)
-        print("Zeroth Test send", self.spi.xfer3(desync_test))
-        time.sleep(0.5)
-        test_return1 = self.spi.xfer3(desync_test)
-        print(test_return1)
-        print("CALCULATED DESYNC = ", test_return1[-1])
-
-        time.sleep(0.5)
-        #int(test_return1[-1])
-        desync_fix.extend([i for i in range(test_return1[-1] + 1)])
-        print(desync_fix)
-        time.sleep(0.5)
-        test_return2 = self.spi.xfer3(desync_fix)
-
-        print(test_return2)
-        time.sleep(0.5)
-        revert_array = bytearray()
-        revert_array.extend([255,255])
-        revert_array.extend([0 for i in range(34)])
-        test_return3 = self.spi.xfer3(revert_array)
-        self.previous_array = tuple(revert_array)
-        print(test_return3[-1])
-
-        self.spi.close()
-
-        print("Desync Hopefully fixed")
-        log_timestamp(event="Hopefully fixed")
-        print("prev_return = ", self.previous_array)
-
-
-
+        # When desynced the pico is recieving the opcode and data in the wrong order.
+        # The offset is read from the echo of resync frames, a short transfer realigns the Pico and probe frames check
+        # it worked, retried with a backoff if not (see PCCS_SPI.resync)
+
+        result = resync(self.spi, self.cs)
+        self.previous_array = tuple(result.last_frame)
+
+        if result.ok:
+            self.echo_shift = result.shift
+            print(f"Desync fixed in {result.elapsed * 1000:.0f} ms ({result.attempts} attempts)")
+            log_timestamp(event=f"Desync fixed in {result.elapsed * 1000:.0f} ms, {result.attempts} attempts, "
+                                f"echo shift {result.shift}")
+        else:
+            print(f"Desync NOT fixed after {result.attempts} attempts")
+            log_timestamp(event=f"Desync not fixed after {result.attempts} attempts")
 
     def send_slab_data(self):
+        run_interleaved([self.slab_task()])
+
+    def slab_task(self):
 
         # New code to send 2 frames to the Pico,
         # This is needed as 1 layer on the slab is 16*2 PMTs, need 2x the DAC data.
 
-        # Enable SPI
-
-        self.spi.open(0, self.cs)
-        self.spi.max_speed_hz = 50 * 1000
-        self.spi.mode = 0
-
         # print(data)
         # for byte in data:
-        #     self.spi.xfer3([byte])
-        opcode_data1 = bytearray()
-        opcode_data1.extend([0xff, 0xfc])
-        opcode_data1.extend(self.data_array)
-        self.pico_return = self.spi.xfer3(opcode_data1)
-        self.verification(opcode_data1)
-
-        time.sleep(0.5)
-
-        opcode_data2 = bytearray()
-        opcode_data2.extend([0xff, 0xfd])
-        opcode_data2.extend(self.data_array2)
-        self.pico_return = self.spi.xfer3(opcode_data2)
-        self.verification(opcode_data2)
-
-        self.spi.close()
+        #     self.spi.transfer(self.cs, [byte])
+        opcode_data1, opcode_data2 = self.encoder.slab_frames()
+        self.pico_return = self.spi.transfer(self.cs, opcode_data1)
+        if self.verification(opcode_data1):
+            yield from self.settle(opcode_data1, 0.5)
+
+        self.pico_return = self.spi.transfer(self.cs, opcode_data2)
+        if self.verification(opcode_data2):
+            yield from self.settle(opcode_data2, 0)
+
         self.clear()
 
     def layer_scan(self):
+        run_interleaved([self.scan_task()])
 
-        self.spi.open(0, self.cs)
-        self.spi.max_speed_hz = 50 * 1000
-        self.spi.mode = 0
+    def scan_task(self):
 
         # print(data)
         # for byte in data:
-        #     self.spi.xfer3([byte])
-        opcode_scan = bytearray()
-        opcode_scan.extend([0xff, 0xfe])
-        opcode_scan.extend([0x00 for _ in range(34)])
+        #     self.spi.transfer(self.cs, [byte])
+        opcode_scan = self.encoder.scan_frame()
         # self.display(opcode_scan)
-        self.pico_return = self.spi.xfer3(opcode_scan)
-        self.verification(opcode_scan)
-        self.spi.close()
+        self.pico_return = self.spi.transfer(self.cs, opcode_scan)
+        if self.verification(opcode_scan):
+            yield from self.settle(opcode_scan, 0, SCAN_TIMEOUT)
         self.clear()
 
     def clear(self):
-        self.data_array.clear()
-        self.data_array2.clear()
+        self.encoder.clear()
 
 class Detector:
-    def __init__(self, number_of_layers):
+    def __init__(self, number_of_layers, spi=None, poll_ready=False):
         self.number_of_layers = number_of_layers
-        self.spi = spidev.SpiDev()
-        self.olayer = [DetectorLayer(_, self.spi) for _ in range(number_of_layers)]
+        # One open SPI handle per chip select for the whole run (see PCCS_SPI)
+        self.spi = spi if spi is not None else SpiTransport()
+        self.olayer = [DetectorLayer(_, self.spi, poll_ready) for _ in range(number_of_layers)]
         # self.i2c_scan()
         self.trigger = False
 
     def i2c_scan(self):
-        for index in range(self.number_of_layers):
-            self.olayer[index].layer_scan()
+        run_interleaved([layer.scan_task() for layer in self.olayer])
 
     def set_blade_data(self, chan_val):
         # Send increments of 16 channel values to each layer
@@ -312,7 +207,7 @@ class Detector:
 
     def set_slab_blade_data(self, chan_val):
         for i in range(self.number_of_layers):
-            print("Chan ", i, "is getting data ", chan_val[i * 32:(i + 1) * 32])
+            # print("Chan ", i, "is getting data ", chan_val[i * 32:(i + 1) * 32])
             self.olayer[i].set_data(chan_val[i * 32:(i + 1) * 32])
 
 
@@ -323,9 +218,8 @@ class Detector:
         send_pulse()
 
     def send_slab_data(self):
-        # Tells the layer objects to send their data to the Picos
-        for _ in range(len(self.olayer)):
-            self.olayer[_].send_slab_data()
+        # Tells the layer objects to send their data to the Picos, interleaved (see PCCS_SPI.run_interleaved)
+        run_interleaved([layer.slab_task() for layer in self.olayer])
         send_pulse()
 
     def set_trigger(self, trigger_bool):
@@ -333,8 +227,8 @@ class Detector:
         self.trigger = trigger_bool
 
     def set_length(self, length):
-        # Validate that length is a digit and within the range 100-1100
-        if not length.isdigit() or int(length) < 100 or int(length) > 1100:
+        # Validate that length is a number and within the range 100-1100
+        if not isinstance(length, int) or length < 100 or length > 1100:
             length = 500
 
         # Convert the 100-1100 ns range to 7-207 corresponding i2c hex range, 0x07 - 0xcf
@@ -346,26 +240,18 @@ class Detector:
 
 class Import_csv:
     def __init__(self, csv_file):
-        self.data = []
+        # The rows are streamed from the csv file on every pass instead of being held in memory
+        self.csv_file = csv_file
         self.odetector = Detector(4)
 
-        with open(csv_file, newline='') as csvfile:
-            reader = csv.reader(csvfile)
-            # Skip the header row if needed
-            next(reader)  # Uncomment this line if your CSV file has a header row
-            # Iterate over each row in the CSV file
-            for row in reader:
-                # Append each row to the data list
-                self.data.append(row)
-
     def start_csv_run(self):
         prev_data = 0
         prev_prev_data = 0
         for j in range(10):
             for k in range(25):
-                for i in range(len(self.data)):
-                    datai = self.data[i]
-                    detecor_type = datai[0]
+                # The rows come already cleaned (blanks to 0, limited to 4000 DAC counts) from the PCCS_Plan pipeline
+                for datai in iter_events(self.csv_file):
+                    detecor_type = datai.detector_type
                     print(datai, detecor_type)
 
                     if prev_prev_data == datai:
@@ -383,15 +269,10 @@ class Import_csv:
 
     def bar_run(self, datai):
         print("Entered Bar Run")
-        trigger = datai[3]
-        pulse_length = datai[4]
-        chan_val = datai[5:85]
-
-        processed_chan_val = [
-            '0' if val.strip() == '' or not val.strip().isdigit()
-            else ('4000' if int(val) > 4000 else val.strip())
-            for val in chan_val
-        ]
+        trigger = datai.trigger
+        pulse_length = datai.pulse_length
+        processed_chan_val = event_counts(datai)[0:80]
+
         self.odetector.set_length(pulse_length)
         self.odetector.set_blade_data(processed_chan_val)
         self.odetector.set_trigger(trigger)
@@ -400,16 +281,10 @@ class Import_csv:
 
     def slab_run(self, datai):
         print("Entered Slab Run")
-        trigger = datai[3]
-        pulse_length = datai[4]
-        chan_val = datai[5:165]
-
-        processed_chan_val = [
-            '0' if val.strip() == '' or not val.strip().isdigit()
-            else ('4000' if int(val) > 4000 else val.strip())
-            for val in chan_val
-        ]
-        print("Processed chan val", processed_chan_val)
+        trigger = datai.trigger
+        pulse_length = datai.pulse_length
+        processed_chan_val = event_counts(datai)[0:160]
+        # print("Processed chan val", processed_chan_val)
 
         self.odetector.set_length(pulse_length)
         self.odetector.set_slab_blade_data(processed_chan_val)
@@ -428,4 +303,6 @@ if __name__ == '__main__':
         Import = Import_csv(sys.argv[1])
         Import.start_csv_run()
         print("Import Run finished successfully")
+        for layer in Import.odetector.olayer:
+            print(f"Pico {layer.cs} settle times: {layer.settle_stats.summary()}")
 
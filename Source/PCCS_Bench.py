@@ -0,0 +1,454 @@
+# PCCS Bench - Microbenchmarks for the parts of the PCCS software that sit in the flashing loop.
+# Nothing here touches the hardware, it can be run on any machine with the requirements installed:
+#
+#   python PCCS_Bench.py frames [number of events]
+#   python PCCS_Bench.py spi [number of events]
+#   python PCCS_Bench.py resync [number of desyncs]
+#   python PCCS_Bench.py settle [number of events]
+#   python PCCS_Bench.py stage [number of events]
+#   python PCCS_Bench.py pulse [seconds per burst] [save]
+#
+# frames - Encodes slab events (both 0xFC/0xFD frames of a blade pair) with the shared FrameEncoder and with a copy of
+#          the old per-bit/per-byte DetectorLayer code, checks that both give the same bytes and prints frames per second.
+# spi    - Sends slab events to an emulated Pico (PCCS_Emulator) through SpiTransport at a range of clocks and settle
+#          times between frames, checks every echo like the receiver's verification and prints the frame rate in Pico
+#          time (how fast the detector could be driven) and how many echoes failed.
+# resync - Desyncs an emulated Pico by a random number of bytes, detects it from the echo and fixes it
+#          with a copy of the old DetectorLayer.desync_protocol and with PCCS_SPI.resync. Prints how long each takes in
+#          Pico time and how often the link was right afterwards, on the timed Pico and on an instant one
+#          (INSTANT_PICO). The old protocol fails on both: with the echo rules of main.c the last byte of its second
+#          test frame is 35 or 0 whatever the offset, so the fix frame only leaves a Pico aligned that already was.
+# settle - Sends slab and lightbar events to an emulated Pico with PCCS_SPI.wait_ready after every frame instead of the
+#          fixed 0.4 s settle, on a fresh Pico and on one whose echo runs behind after a resync. Checks every frame was
+#          applied by the time the wait returned and prints the settle times and the Pico time per event.
+# stage  - Stages slab events on a crate of 2 and 4 emulated Picos (one per chip select), one blade pair after the
+#          other and interleaved with PCCS_SPI.run_interleaved. Prints the staging time per event and checks every
+#          Pico ended up with its frames.
+# pulse  - Fires single pulses and 3 Hz, 300 Hz and 1 kHz bursts with PCCS_Pulse.fire_pulse / fire_burst (what
+#          send_pulse / send_fastpulse run) on PulseLines over the recording gpiod stand-in of PCCS_Emulator, in real
+#          time. From the recorded edges it prints the rise sequence (reset to Pulse_Send high), the gaps between the
+#          calls, the pulse width, the rate reached and the jitter of the periods, and the CPU used. The results are
+#          compared with the baseline of this host in bench_baselines/ (saved on the first run, or with save) and the
+#          metrics that got clearly worse (see PULSE_TOLERANCE) are flagged.
+#
+# The emulator runs on a VirtualClock, the settle sleeps and the wire time cost nothing, every run takes seconds (the
+# pulse benchmark is the exception, it measures real time). The spi, resync, settle and stage numbers rest on the
+# FIFO and timing assumptions listed in PCCS_Emulator, which have not been checked on a Pico yet.
+
+import contextlib
+import io
+import json
+import os
+import random
+import socket
+import sys
+import time
+
+import numpy as np
+
+from PCCS_Emulator import VirtualClock, emulator_factory, RecordingGpio, INSTANT_PICO
+from PCCS_GPIO import PulseLines, GPIO_CHIP, PULSE_LINES
+from PCCS_Pulse import fire_pulse, fire_burst, DUTY
+from PCCS_Frame import FrameEncoder, SLAB_OPCODES, probe_frame, echo_matches
+from PCCS_SPI import (SpiTransport, DEFAULT_SPEED_HZ, PROBE_SETTLE, resync, wait_ready, SettleStats, ReadyPoll,
+                      run_interleaved)
+
+
+def legacy_slab_frames(chan_val, verbose=False):
+    # The frame building as it was in DetectorLayer.set_data/setByteData/setVoltage, kept as the reference.
+    # verbose does the prints the receiver did on every event.
+    bool_data = [val != 0 for val in chan_val]
+    if verbose:
+        print("Chan Val in Set Data", chan_val)
+        print("Bool Data in Set Data", bool_data)
+        print("Slab run bool data raw", bool_data)
+    slab_bool = []
+    for i in range(0, len(bool_data), 2):
+        slab_bool.append((1 if bool_data[i] | bool_data[i + 1] else 0))
+    if verbose:
+        print("Slab run bool data appended: ", slab_bool)
+    byte1 = 0
+    for i in range(8):
+        if slab_bool[i]:
+            byte1 |= (1 << (7 - i))
+    byte2 = 0
+    for i in range(8, 16):
+        if slab_bool[i]:
+            byte2 |= (1 << (15 - i))
+
+    voltage_bytes = bytearray()
+    for value in chan_val:
+        value = int(value)
+        voltage_bytes.append((value >> 8) & 0xFF)
+        voltage_bytes.append(value & 0xFF)
+
+    opcode_data1 = bytearray([0xff, SLAB_OPCODES[0], byte1, byte2])
+    opcode_data1.extend(voltage_bytes[:32])
+    opcode_data2 = bytearray([0xff, SLAB_OPCODES[1], byte1, byte2])
+    opcode_data2.extend(voltage_bytes[32:64])
+    if verbose:
+        print(byte1)
+        print(byte2)
+        print(f"Voltage bytes length: {len(voltage_bytes)}")
+        print(f"Voltage bytes content: {voltage_bytes}")
+        print(opcode_data1[2:])
+        print(opcode_data2[2:])
+    return opcode_data1, opcode_data2
+
+
+def random_events(count, seed=1):
+    # Slab blade pair data, about half the channels off like the usual campaign files
+    rng = random.Random(seed)
+    return [[rng.choice((0, rng.randint(1, 4000))) for _ in range(32)] for _ in range(count)]
+
+
+def bench_frames(count=20000):
+    events = random_events(count)
+    encoder = FrameEncoder()
+
+    for chan_val in events[:1000]:
+        encoder.set_data(chan_val)
+        if encoder.slab_frames() != legacy_slab_frames(chan_val):
+            print("Mismatch between the encoder and the old frame code for", chan_val)
+            sys.exit(1)
+
+    start = time.perf_counter()
+    for chan_val in events:
+        legacy_slab_frames(chan_val)
+    legacy_time = time.perf_counter() - start
+
+    # The prints go to memory, a terminal or log file would only be slower
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for chan_val in events:
+            legacy_slab_frames(chan_val, verbose=True)
+    verbose_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for chan_val in events:
+        encoder.set_data(chan_val)
+        encoder.slab_frames()
+    encoder_time = time.perf_counter() - start
+
+    # The receiver hands the encoder the voltages already as an array straight out of the MQTT payload
+    arrays = [np.array(chan_val, dtype=">u2") for chan_val in events]
+    start = time.perf_counter()
+    for chan_val in arrays:
+        encoder.set_data(chan_val)
+        encoder.slab_frames()
+    array_time = time.perf_counter() - start
+
+    frames = 2 * count
+    print(f"{count} slab events, {frames} frames")
+    print(f"  old DetectorLayer code with its prints: {frames / verbose_time:12.0f} frames/s")
+    print(f"  old DetectorLayer code, no prints:      {frames / legacy_time:12.0f} frames/s")
+    for name, encode_time in (("FrameEncoder, list input:", encoder_time), ("FrameEncoder, array input:", array_time)):
+        print(f"  {name:<39} {frames / encode_time:12.0f} frames/s  "
+              f"({verbose_time / encode_time:.1f}x / {legacy_time / encode_time:.1f}x)")
+
+
+def emulated_transport(**pico_options):
+    # A SpiTransport to a fresh emulated Pico on chip select 0, with the clock everything has to sleep on
+    spi, picos, clock = emulated_crate(1, **pico_options)
+    return spi, picos[0], clock
+
+
+def emulated_crate(blades, **pico_options):
+    # The same with a Pico on each of chip selects 0 to blades - 1, the Picos are returned in chip select order
+    clock = VirtualClock()
+    picos = {}
+    spi = SpiTransport(spi_factory=emulator_factory(picos, clock=clock, **pico_options))
+    for cs in range(blades):
+        spi.handle(cs)
+    return spi, [picos[(spi.bus, cs)] for cs in range(blades)], clock
+
+
+def legacy_desync_protocol(spi, cs, sleep):
+    # DetectorLayer.desync_protocol without the prints, returns the frame it leaves as the last one sent
+    sleep(0.5)
+    spi.transfer(cs, bytes(range(36)))
+    sleep(0.5)
+    test_return1 = spi.transfer(cs, bytes(range(36)))
+    sleep(0.5)
+    sleep(0.5)
+    spi.transfer(cs, bytes(range(test_return1[-1] + 1)))
+    sleep(0.5)
+    revert_array = bytes([255, 255]) + bytes(34)
+    spi.transfer(cs, revert_array)
+    return revert_array
+
+
+def link_ok(spi, cs, previous, sleep, settle=0.4, probes=4, shift=0):
+    # The probe check of PCCS_Receiver probe_link, with the receiver's settle between frames
+    for seq in range(1, probes + 1):
+        sleep(settle)
+        frame = probe_frame(seq)
+        if not echo_matches(spi.transfer(cs, frame), previous, shift):
+            return False
+        previous = frame
+    return True
+
+
+def bench_spi(count=200):
+    events = random_events(count)
+    encoder = FrameEncoder()
+    print(f"{count} slab events ({2 * count} frames) to an emulated Pico")
+    print(f"  {'clock':>10} {'settle':>8} {'frames/s':>10} {'bad echoes':>11} {'desyncs':>8}  emulator frames/s")
+    for speed in (DEFAULT_SPEED_HZ, 400_000, 1_600_000, 10_000_000):
+        for settle in (0.4, 0.01, 0.005, 0.0):
+            spi, pico, clock = emulated_transport()
+            spi.set_speed(0, speed)
+            previous = None
+            bad = 0
+            start = time.perf_counter()
+            for chan_val in events:
+                encoder.set_data(chan_val)
+                for frame in encoder.slab_frames():
+                    pico_return = spi.transfer(0, frame)
+                    if previous is not None and not echo_matches(pico_return, previous):
+                        bad += 1
+                    previous = bytes(frame)
+                    clock.sleep(settle)
+            wall = time.perf_counter() - start
+            print(f"  {speed:>10} {settle:>8} {2 * count / clock():>10.1f} {bad:>11} {pico.stats['desyncs']:>8}  "
+                  f"{2 * count / wall:.0f}")
+
+
+def bench_resync(count=100):
+    encoder = FrameEncoder()
+    encoder.set_data(list(range(1, 33)))
+    frames = [bytes(frame) for frame in encoder.slab_frames()]
+    rng = random.Random(1)
+    models = {"timed": {}, "instant": INSTANT_PICO}
+    results = {(model, method): [] for model in models for method in ("desync_protocol", "resync")}
+    for n in range(count):
+        # Every other desync is a short transfer from the master, the others stray clock edges the Pico sees on its
+        # own, both of a random number of bytes
+        glitch = n % 2 == 1
+        length = rng.randint(1, 35)
+        for (model, method), runs in results.items():
+            spi, pico, clock = emulated_transport(**models[model])
+            sleep = clock.sleep
+            for frame in frames:
+                spi.transfer(0, frame)
+                sleep(0.4)
+            if glitch:
+                pico.glitch(length)
+            else:
+                spi.transfer(0, frames[0][:length])
+            previous = frames[1]
+            detected = False
+            for frame in frames * 4:
+                sleep(0.4)
+                if not echo_matches(spi.transfer(0, frame), previous):
+                    detected = True
+                    break
+                previous = frame
+            if not detected:
+                # The Pico's pages happened to end up aligned again, nothing to fix
+                continue
+            start = clock()
+            if method == "resync":
+                result = resync(spi, 0, sleep=sleep, clock=clock)
+                previous, shift = result.last_frame, result.shift or 0
+            else:
+                previous, shift = legacy_desync_protocol(spi, 0, sleep), 0
+            latency = clock() - start
+            runs.append((link_ok(spi, 0, previous, sleep, shift=shift), latency))
+
+    print(f"{count} random desyncs")
+    for (model, method), runs in results.items():
+        if not runs:
+            continue
+        latencies = sorted(latency for _, latency in runs)
+        print(f"  {model + ' Pico, ' + method + ':':<31} {sum(ok for ok, _ in runs)}/{len(runs)} fixed, "
+              f"{sum(latencies) / len(latencies) * 1000:.0f} ms mean, "
+              f"{latencies[len(latencies) // 2] * 1000:.0f} ms median, {latencies[-1] * 1000:.0f} ms max")
+
+
+def bench_settle(count=200):
+    events = random_events(count)
+    encoder = FrameEncoder()
+    print(f"{count} events (slab, every 10th a lightbar) to an emulated Pico, wait_ready after every frame")
+    print(f"  {'clock':>10} {'start':>7} {'ms/event':>9} {'fixed ms/event':>15} {'not applied':>12} {'timeouts':>9} "
+          f"{'desyncs':>8}  settle per opcode (mean / max ms)")
+    for speed in (DEFAULT_SPEED_HZ, 400_000, 1_600_000):
+        for start in ("fresh", "resync"):
+            spi, pico, clock = emulated_transport()
+            spi.set_speed(0, speed)
+            previous = None
+            if start == "resync":
+                spi.transfer(0, bytes(5))
+                previous = resync(spi, 0, sleep=clock.sleep, clock=clock).last_frame
+            stats = SettleStats()
+            not_applied = 0
+            begin = clock()
+            for n, chan_val in enumerate(events):
+                encoder.set_data(chan_val)
+                for frame in (encoder.lightbar_frames() if n % 10 == 9 else encoder.slab_frames()):
+                    spi.transfer(0, frame)
+                    result = wait_ready(spi, 0, frame, seq=n, sleep=clock.sleep, clock=clock)
+                    stats.record(frame[1], result, 0.4)
+                    if pico.settings.get(frame[1]) != bytes(frame[2:]):
+                        not_applied += 1
+            per_event = (clock() - begin) / count
+            summary = stats.summary()
+            settles = ", ".join(f"{opcode} {s['mean_ms']:.1f} / {s['max_ms']:.1f}"
+                                for opcode, s in summary["opcodes"].items())
+            timeouts = sum(s["timeouts"] for s in summary["opcodes"].values())
+            print(f"  {speed:>10} {start:>7} {per_event * 1000:>9.1f} {per_event * 1000 + summary['saved_ms'] / count:>15.1f} "
+                  f"{not_applied:>12} {timeouts:>9} {pico.stats['desyncs']:>8}  {settles}")
+
+
+def stage_task(spi, cs, frames, seq, clock):
+    # The frames of one blade pair for run_interleaved, like DetectorLayer.slab_task without the verification
+    for frame in frames:
+        spi.transfer(cs, frame)
+        result = yield ReadyPoll(spi, cs, frame, seq, clock=clock)
+        if not result.ready:
+            return False
+        yield clock() + PROBE_SETTLE
+    return True
+
+
+def bench_stage(count=100):
+    events = random_events(count)
+    encoders = [FrameEncoder() for _ in range(4)]
+    print(f"{count} slab events staged on a crate of emulated Picos")
+    print(f"  {'clock':>10} {'blades':>7} {'fixed 0.4 s':>12} {'one by one':>11} {'interleaved':>12} {'not applied':>12}"
+          f"  (ms per event)")
+    for speed in (DEFAULT_SPEED_HZ, 400_000, 1_600_000):
+        for blades in (2, 4):
+            times = {}
+            not_applied = 0
+            for mode in ("one by one", "interleaved"):
+                spi, picos, clock = emulated_crate(blades)
+                for cs in range(blades):
+                    spi.set_speed(cs, speed)
+                start = clock()
+                for n, chan_val in enumerate(events):
+                    frames = []
+                    for cs in range(blades):
+                        encoders[cs].set_data(chan_val[cs:] + chan_val[:cs])
+                        frames.append([bytes(frame) for frame in encoders[cs].slab_frames()])
+                    tasks = [stage_task(spi, cs, frames[cs], n, clock) for cs in range(blades)]
+                    if mode == "interleaved":
+                        run_interleaved(tasks, clock.sleep, clock)
+                    else:
+                        for task in tasks:
+                            run_interleaved([task], clock.sleep, clock)
+                    not_applied += sum(picos[cs].settings.get(frame[1]) != frame[2:]
+                                       for cs in range(blades) for frame in frames[cs])
+                times[mode] = (clock() - start) / count
+            # The old code, 2 frames per blade pair with 0.4 s after each, one blade pair after the other
+            fixed = blades * 2 * (0.4 + 36 * 8 / speed)
+            print(f"  {speed:>10} {blades:>7} {fixed * 1000:>12.1f} {times['one by one'] * 1000:>11.1f} "
+                  f"{times['interleaved'] * 1000:>12.1f} {not_applied:>12}")
+
+
+BASELINE_DIR = "bench_baselines"
+PULSE_RATES = (3, 300, 1000)  # Burst rates timed, Hz
+SINGLE_PULSES = 5
+# A metric is flagged when it gets worse than PULSE_TOLERANCE x its baseline + its slack (all of them are better
+# lower). The scheduler makes single samples noisy, the maxima are printed but not compared.
+PULSE_TOLERANCE = 2
+PULSE_SLACK = {"rise_us": 10, "width_error_us": 50, "rate_error_pct": 0.05, "jitter_p99_us": 200, "cpu_pct": 10}
+
+
+def pulse_metrics(chip, width, rate_hz=None):
+    # Timing of the recorded pulses of chip, Pulse_Send high for width (s) and, for a burst, rising at rate_hz
+    offsets = dict(PULSE_LINES)
+    times = chip.times[:chip.count]
+    _, resets = chip.line_edges(offsets["Sys_Rst"])  # Sys_Rst going low starts every pulse
+    rises, falls = chip.line_edges(offsets["Pulse_Send"])
+    # The calls from the reset to Pulse_Send going high, and the gaps between them
+    starts = np.searchsorted(times, resets)
+    ends = np.searchsorted(times, rises)
+    gaps = np.concatenate([np.diff(times[start:end + 1]) for start, end in zip(starts, ends)])
+    metrics = {
+        "pulses": int(len(rises)),
+        "rise_us": float(np.median(rises - resets)) / 1e3,
+        "gap_max_us": float(gaps.max()) / 1e3,
+        "width_error_us": float(np.median(np.abs(falls - rises - width * 1e9))) / 1e3,
+    }
+    if rate_hz is not None and len(rises) > 1:
+        periods = np.diff(rises) / 1e9
+        achieved = 1 / float(np.mean(periods))
+        deviation = np.abs(periods - 1 / rate_hz) * 1e6
+        metrics.update({
+            "achieved_hz": achieved,
+            "rate_error_pct": abs(achieved - rate_hz) / rate_hz * 100,
+            "jitter_p99_us": float(np.percentile(deviation, 99)),
+            "jitter_max_us": float(deviation.max()),
+        })
+    return metrics
+
+
+def timed(run):
+    # run(), and the CPU it used as a percentage of the wall time
+    wall, cpu = time.perf_counter(), time.process_time()
+    run()
+    return (time.process_time() - cpu) / (time.perf_counter() - wall) * 100
+
+
+def bench_pulse(seconds=1, save=None):
+    gpio = RecordingGpio()
+    lines = PulseLines(gpio=gpio)
+    chip = gpio.chips[GPIO_CHIP]
+    results = {}
+
+    chip.clear()
+    cpu = timed(lambda: [fire_pulse(lines, 1) for _ in range(SINGLE_PULSES)])
+    results["single"] = dict(pulse_metrics(chip, 0.1), cpu_pct=cpu)
+    for rate_hz in PULSE_RATES:
+        chip.clear()
+        count = max(4, int(rate_hz * seconds))
+        cpu = timed(lambda: fire_burst(lines, 1, rate_hz, count))
+        results[f"{rate_hz} Hz"] = dict(pulse_metrics(chip, DUTY / rate_hz, rate_hz), cpu_pct=cpu)
+
+    path = os.path.join(BASELINE_DIR, f"pulse-{socket.gethostname()}.json")
+    baseline = {}
+    if os.path.exists(path) and save != "save":
+        with open(path) as f:
+            baseline = json.load(f)["results"]
+
+    print(f"Pulses on the recording gpiod, {SINGLE_PULSES} single pulses and {seconds} s bursts (times in us)")
+    print(f"  {'':>8} {'pulses':>7} {'rise':>7} {'gap max':>8} {'width err':>10} {'rate Hz':>10} {'rate err %':>11} "
+          f"{'jitter p99':>11} {'jitter max':>11} {'cpu %':>6}")
+    regressions = []
+    for case, metrics in results.items():
+        row = f"  {case:>8} {metrics['pulses']:>7} {metrics['rise_us']:>7.1f} {metrics['gap_max_us']:>8.1f} " \
+              f"{metrics['width_error_us']:>10.1f} "
+        if "achieved_hz" in metrics:
+            row += f"{metrics['achieved_hz']:>10.3f} {metrics['rate_error_pct']:>11.4f} " \
+                   f"{metrics['jitter_p99_us']:>11.1f} {metrics['jitter_max_us']:>11.1f} "
+        else:
+            row += f"{'':>10} {'':>11} {'':>11} {'':>11} "
+        print(row + f"{metrics['cpu_pct']:>6.1f}")
+        for name, slack in PULSE_SLACK.items():
+            before = baseline.get(case, {}).get(name)
+            if before is not None and name in metrics and metrics[name] > PULSE_TOLERANCE * before + slack:
+                regressions.append(f"{case} {name} {metrics[name]:.2f} (baseline {before:.2f})")
+
+    if baseline:
+        print(f"Compared with {path}: " + ("no regressions" if not regressions else "REGRESSIONS"))
+        for regression in regressions:
+            print(f"  {regression}")
+    else:
+        os.makedirs(BASELINE_DIR, exist_ok=True)
+        with open(path, "w") as f:
+            json.dump({"host": socket.gethostname(), "saved": time.strftime("%Y-%m-%d %H:%M:%S"),
+                       "seconds": seconds, "results": results}, f, indent=2)
+        print(f"Baseline saved to {path}")
+    return results, regressions
+
+
+BENCHMARKS = {"frames": bench_frames, "spi": bench_spi, "resync": bench_resync, "settle": bench_settle,
+              "stage": bench_stage, "pulse": bench_pulse}
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        print(f"Usage: python PCCS_Bench.py <{'|'.join(BENCHMARKS)}> [count] [save]\n")
+        sys.exit(1)
+    BENCHMARKS[sys.argv[1]](*(int(arg) if arg.isdigit() else arg for arg in sys.argv[2:]))
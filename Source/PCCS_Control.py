@@ -8,10 +8,12 @@ import struct
 import json
 import threading
 import time
-from threading import Event
 import datetime
-import csv
 import sys
+from collections import deque, Counter, namedtuple
+import numpy as np
+from PCCS_Plan import (iter_segments, compile_plan, RunPlan, CleanReport, DEVICE_IDS, device_payloads,
+                       pack_plan_slices)
 
 broker_ip = "128.141.91.10"  # Replace with MillQan PC's IP (Or where ever the MQTT Broker is initialized),
 # see GitHub readme
@@ -21,6 +23,10 @@ TOPIC_HANDSHAKE = "pccs/handshake"
 TOPIC_DATA = "pccs/data"
 TOPIC_PULSE = f"pccs/pulse/PCCS_Flasher"
 TOPIC_PREP = "pccs/prep"
+TOPIC_ABORT = "pccs/abort"  # Stops a burst that is running on the flasher and drops its queued pulses
+TOPIC_COMMIT = "pccs/commit"  # The event id whose staged data the devices put onto their Picos now
+TOPIC_GO = "pccs/go"  # Run-upload mode, the event of the uploaded plan the devices stage next
+TOPIC_FIRE = "pccs/fire/PCCS_Flasher"  # Run-upload mode, fire the event with the pulse settings of the plan
 
 TOPIC_LIGHTBAR_DATA = "pccs/lightbar/data"
 
@@ -30,10 +36,46 @@ TOPIC_LIGHTBAR_DATA = "pccs/lightbar/data"
 TOPIC_STATUS = "pccs/status/+"
 TOPIC_ERROR = "pccs/error/+"
 TOPIC_CLEAR = "pccs/clear/+"
+TOPIC_ACK = "pccs/ack/+"  # Run-upload mode, the ready / done answers as ACK structs instead of JSON
 
 # The expected devices, these need to be hardcoded onto the Receiver.Py
 expected_workers = {"PCCS_Flasher", "PCCS_Sub_1", "PCCS_Sub_2", "PCCS_Sub_3"}
 
+LATENCY_SAMPLES = 1000  # Wake latencies kept for the summary
+
+# Every event of the run (a segment, its data and its pulse or burst) gets the next event id. It goes out in front of
+# the data payloads (EVENT_HEADER) and in the pulse message, the devices send it back with ready_for_flash, pulse_done
+# and flash_done, and an answer for any other event than the current one is discarded (and counted), a late ready or
+# done from an older event can't be taken for the current one.
+EVENT_HEADER = struct.Struct(">I")
+
+# An event whose data went out to the devices that needed it (changed), staged there until the commit. position is
+# its place in the pass (the index into an uploaded plan).
+StagedEvent = namedtuple("StagedEvent", ["event", "position", "segment", "changed", "payloads"])
+
+# Run-upload mode (--upload). Every device gets its slice of the whole plan once, before the run (see
+# PCCS_Plan.pack_plan_slices), and from then on the data and pulse messages are replaced by a few bytes:
+#   GO    event id, position in the plan, bit mask of the devices (DEVICE_IDS order) that stage it
+#   FIRE  event id, position in the plan, the flasher takes trigger, rate and count from its slice
+#   ACK   status code, event id, the answers of a device that has a plan (codes in ACK_STATUS)
+# A device without the plan (the upload failed, or it restarted since) gets its data event by event as before.
+GO = struct.Struct(">IIB")
+FIRE = struct.Struct(">II")
+ACK = struct.Struct(">BI")
+ACK_STATUS = {1: "ready_for_flash", 2: "pulse_done", 3: "flash_done"}
+PLAN_TIMEOUT = 30  # Seconds the devices get to unpack their slice
+
+# Startup, seconds
+HANDSHAKE_RETRY = 6  # SYNC sent again if not every expected worker answered within this
+HANDSHAKE_TIMEOUT = 30  # Start without the workers that didn't answer after this (the flasher is always waited for)
+PREP_TIMEOUT = 10  # Start anyway if not every device acknowledged its prep within this
+
+# After a single pulse, seconds. The flasher acknowledges every pulse with pulse_done, the next pulse goes out no
+# earlier than DAQ_DEAD_TIME after it (set it to the MilliDAQ readout time), the next event is committed meanwhile.
+# Without an acknowledgement it starts after PULSE_DONE_TIMEOUT, the flat wait there used to be after every pulse.
+DAQ_DEAD_TIME = 0.5
+PULSE_DONE_TIMEOUT = 3
+
 # Known Bad Channels, hardcoded into Controller - distributed to the rest
 bad_channels = [0] * 96
 
@@ -84,11 +126,31 @@ def log_error(error=None, device=None):
             f.write(f"[{timestamp}] {device or 'UNKNOWN'}: Error: {error}\n")
 
 
+class WakeLatency:
+    # Latencies (e.g. from the last worker's ready to the waiter waking up), the last LATENCY_SAMPLES of them in us
+    def __init__(self, size=None):
+        self.samples = deque(maxlen=size or LATENCY_SAMPLES)
+        self.lock = threading.Lock()
+
+    def record(self, seconds):
+        with self.lock:
+            self.samples.append(seconds * 1e6)
+
+    def summary(self):
+        with self.lock:
+            samples = np.array(self.samples)
+        if not len(samples):
+            return {"count": 0}
+        return {"count": int(len(samples)), "p50_us": round(float(np.percentile(samples, 50)), 1),
+                "p99_us": round(float(np.percentile(samples, 99)), 1), "max_us": round(float(samples.max()), 1)}
+
+
 class ErrorManager:
     def __init__(self, expected_devices=None):
         # device_id -> set of active error IDs
         self.error_events = {}
-        self.lock = threading.Lock()
+        # A Condition, the waiters are woken by clear_error instead of polling
+        self.lock = threading.Condition()
 
     def set_error(self, device_id, error_id):
         with self.lock:
@@ -102,23 +164,46 @@ class ErrorManager:
                 self.error_events[device_id].discard(error_id)
                 if not self.error_events[device_id]:
                     del self.error_events[device_id]
+            self.lock.notify_all()
 
     def wait_for_all_clear(self, timeout=None):
-        start = time.time()
-        while True:
-            with self.lock:
-                has_errors = any(self.error_events.values())
-            if not has_errors:
-                return True
-            if timeout and (time.time() - start) >= timeout:
-                return False
-            time.sleep(0.1)
+        with self.lock:
+            return self.lock.wait_for(lambda: not any(self.error_events.values()), timeout or None)
+
+
+def Handshake():
+    # Send out the "SYNC" message on the HANDSHAKE topic, the PCCS_Subs will respond with a message which will then
+    # populate the workers_online set. Done as soon as every expected worker answered, the SYNC is sent again every
+    # HANDSHAKE_RETRY seconds until then. After HANDSHAKE_TIMEOUT the run starts with the ones that answered, as long
+    # as PCCS_Flasher is one of them (without it there is no pulse).
+    start = time.perf_counter()
+    while True:
+        client.publish(TOPIC_HANDSHAKE, "SYNC")
+        print("Sent SYNC handshake to all listeners")
+        if pccs_controller.wait_for_workers(expected_workers, HANDSHAKE_RETRY):
+            break
+        online = pccs_controller.get_workers_online()
+        print(f"Workers online: {online}")
+        if "PCCS_Flasher" in online and time.perf_counter() - start >= HANDSHAKE_TIMEOUT:
+            print(f"No answer from {expected_workers - online}, starting without them")
+            log_error(device="System", error=f"No handshake from {expected_workers - online}")
+            break
+    pccs_controller.log_startup(f"handshake, online: {sorted(pccs_controller.get_workers_online())}")
 
 
 def Initialize_Devices():
     # Send Command to Init Picos/Base Reading - Where we expect the majority of Errors to occur
+    # The init resets the devices, so nothing that was delivered before can be trusted anymore
+    pccs_controller.clear_delivered()
+    pccs_controller.clear_prep_done()
     publish_bad_channels_data(bad_channels)
-    time.sleep(6)
+    # Every device acknowledges with prep_done once its scan is done, the run starts when all of them did
+    online = pccs_controller.get_workers_online()
+    if not pccs_controller.wait_for_prep(online, PREP_TIMEOUT):
+        missing = online - pccs_controller.get_prep_done()
+        print(f"No prep_done from {missing} after {PREP_TIMEOUT} s, starting anyway")
+        log_error(device="System", error=f"No prep_done from {missing}")
+    pccs_controller.log_startup("device prep")
 
 
 class Import_csv:
@@ -127,155 +212,252 @@ class Import_csv:
     # csv file should be repeated - allows for smaller files to be used
 
     # Aditionally a repeat column could be added to each flashing event in the csv file to allow more compression.
-
-    def __init__(self, csv_file, repeat_times=1):
-        # Data array that will store the csv file
-        self.data = []
+    # Identical consecutive rows are collapsed up front anyway (see collapse_runs in PCCS_Plan), so a run of the same
+    # row turns into one segment with the summed flash count.
+
+    # By default the csv is compiled into a binary run plan (cached by content, so only the first run of a campaign
+    # file pays for it) and the segments are walked straight out of the memory-mapped plan. With compiled=False the
+    # rows are instead streamed from the csv and collapsed on the fly, which starts flashing without any compile step.
+
+    def __init__(self, csv_file, repeat_times=1, compiled=True):
+        # The csv file is never loaded into memory as a whole (see PCCS_Plan)
+        self.csv_file = csv_file
+        # Keeps track of the cells the cleaning stage had to coerce to 0 or clamp
+        self.clean_report = CleanReport()
+        self.plan = RunPlan(compile_plan(csv_file, report=self.clean_report)) if compiled else None
+        self.log_clean_report()
         self.repeat = repeat_times
-        self.flash_count_per_event = 0
         self.good_events = 0
-
-        # Opening the CSV file and emptying each row into the self.data array
-        with open(csv_file, newline='') as csvfile:
-            reader = csv.reader(csvfile)
-            # Skip the header row
-            next(reader)
-            # Iterate over each row in the CSV file
-            for row in reader:
-                # Append each row to the data list
-                self.data.append(row)
-
-    # This function is utilized to sort the data into ones that "necessarily" need the data to be transmitted
-    # throughout the system and which ones we can just flash the same settings again. We also use the code in
-    # the first column of the csv to categorize the data as regular slab data or as lightbar data (other PCCS use-case).
-
-    # Again utilizing a times repeat in the csv file will allow us to simplify this
+        # perf_counter before which the next pulse must not go out (the MilliDAQ still reading out the last one)
+        self.next_pulse_time = 0.0
+        # Place of the next event in the pass, matches the positions of the uploaded plan
+        self.position = 0
+
+    # Every segment is one flashing setup and the number of flashes to do with it. The data is only transmitted
+    # throughout the system once per segment, the flashes themselves are then fired either as a single pulse or as
+    # one fast-flash burst for the whole count. We also use the code in the first column of the csv to categorize
+    # the data as regular slab data or as lightbar data (other PCCS use-case).
     def start_csv_run(self):
         # repeat the number specified in the object init
         for CSV_repeat_times in range(0, self.repeat):
 
-            # loop through every row (super flashing event, since we can have many flashes in one row)
-            for flashing_super_event in range(len(self.data)):
+            # loop through every segment (super flashing event, since we can have many flashes in one segment)
+            # Either walk the mapped plan again or re-open the csv and read, clean, split and collapse the rows lazily
+            if self.plan is not None:
+                segments = self.plan
+            else:
+                # The cleaning is only reported for the first pass through the csv
+                segments = iter_segments(self.csv_file, report=self.clean_report if CSV_repeat_times == 0 else None)
+            # One event is always staged ahead, its data loads on the devices while the one before it flashes
+            staged = None
+            self.position = 0
+            for segment in segments:
 
-                datai = self.data[flashing_super_event]
                 # detector/use-case mentioned above
-                detector_type = datai[0]
                 # This is the one we are interested in, the slab_run function is the next step of the data pipeline.
-                if detector_type != 'slab':
+                if segment.detector_type != 'slab':
                     print("Wrong detector type format given")
                     exit()
 
-                # How many times you want this flashing setup to be run
-                flashing_event_repeat_times = (
-                    int(datai[1].strip()) if datai[1].strip().isdigit() else 1
-                )
-
-                # Frequency of flashing
-                flashing_rate = (
-                    int(datai[2].strip()) if datai[2].strip().isdigit() else 3
-                )
-
-                # Trigger MilliDAQ or not
-                trigger = (
-                    int(datai[3].strip()) if datai[3].strip().isdigit() else 0
-                )
-
-                for flash in range(0, flashing_event_repeat_times):
-                    print(f"flash_count_per_event: {self.flash_count_per_event}, good_events: {self.good_events}")
-                    if self.flash_count_per_event > 4 and self.good_events > 4:
-                        print("Switching to fast flashing")
-                        pccs_controller.clear_flash_done()
+                # A repeat of 0 means the rows are in the csv but should not be flashed
+                if segment.repeat == 0:
+                    continue
 
-                        publish_send_fast_pulse(trigger, flashing_rate, flashing_event_repeat_times - 5)
+                staged = self.slab_run(staged, segment)
 
-                        expected_flashing_time = int(flashing_event_repeat_times / flashing_rate)
-                        acceptable_delay_time = expected_flashing_time * 2
+                # Debug
+                # print(segment)
 
-                        # wait for a signal back (e.g., "READY_FOR_NEXT")
-                        pccs_controller.wait_for_flashing_end(acceptable_delay_time)
+            # The last event of the pass has nothing staged behind it
+            if staged is not None:
+                self.slab_run(staged, None)
 
-                        self.flash_count_per_event = 0  # reset for next super event
-                        break
-                    else:
-                        self.slab_run(datai)
-                        self.flash_count_per_event += 1
+            if self.plan is None and CSV_repeat_times == 0:
+                self.log_clean_report()
+            # How fast the waits woke up after the last worker reported, and the last ready to the pulse
+            print(f"Wake latencies: {pccs_controller.latency_summary()}")
+            print(f"Stale messages discarded: {pccs_controller.stale_summary()}")
+            time.sleep(0.5)
 
-                # Debug
-                # print(datai, detector_type)
+    def upload_plan(self):
+        # Run-upload mode, send every online device its slice of the whole plan and wait for them to unpack it. The
+        # devices that don't confirm get their data event by event.
+        segments = self.plan if self.plan is not None else iter_segments(self.csv_file)
+        plan_id, count, slices = pack_plan_slices(segments)
+        online = pccs_controller.get_workers_online()
+        pccs_controller.start_upload(plan_id)
+        for device_id, plan_slice in slices.items():
+            if device_id in online:
+                client.publish(f"pccs/plan/{device_id}", plan_slice)
+        if not pccs_controller.wait_for_plan(online, PLAN_TIMEOUT):
+            missing = online - pccs_controller.get_plan_loaded()
+            print(f"No plan_loaded from {missing} after {PLAN_TIMEOUT} s, sending them their data event by event")
+            log_error(device="System", error=f"No plan_loaded from {missing}")
+        pccs_controller.log_startup(f"plan {plan_id:08x} uploaded, {count} events in "
+                                    f"{sum(len(plan_slice) for plan_slice in slices.values())} bytes")
+
+    def log_clean_report(self):
+        # Blank and non-numeric cells become 0 and values above 4000 are clamped, log where that happened
+        if self.clean_report.rows and not self.clean_report.clean():
+            print(self.clean_report.summary())
+            log_error(device="System", error=self.clean_report.summary(details=50))
+
+    # The data for a segment goes out in 2 steps. stage_event publishes it to the devices, which only decode it into
+    # frames, then the commit (a few bytes, to every device) has them put it onto their Picos. slab_run commits the
+    # staged event and, once the devices are ready, stages the next one before firing, so the devices load event N+1
+    # while N flashes. The Picos can't be written while the LEDs flash, but they can during the MilliDAQ dead time
+    # after a pulse, the commit goes out as soon as the pulse is done and the next pulse waits for whichever of the
+    # two takes longer instead of both one after the other.
+    def stage_event(self, segment):
+        # The data for the 192 channels (PMT Leds) has already been cleaned (limited to 4000 DAC counts) and split
+        # into the 4 packed ">48H" slices, one for each slab layer, by the PCCS_Plan pipeline. The flashing data is
+        # larger as it also sets the length of the LED pulse (~ 100-1100 ns).
+        payloads = device_payloads(segment)
+
+        # Only the devices whose slice differs from the one they last successfully received need the data again, the
+        # others still have it on their Picos and count as ready without a round trip. For sweeps where one channel
+        # changes at a time this is usually a single device. The event before is committed by now, delivered is what
+        # the devices will hold when this one is committed.
+        changed = {device_id for device_id, packed in payloads.items()
+                   if pccs_controller.get_delivered(device_id) != packed}
+
+        event = pccs_controller.new_event()
+        position = self.position
+        self.position += 1
+        header = EVENT_HEADER.pack(event)
+        mask = 0
+        for bit, device_id in enumerate(DEVICE_IDS):
+            if device_id not in changed:
+                continue
+            if pccs_controller.has_plan(device_id):
+                # The device has the data in its uploaded plan, it is only told which event
+                mask |= 1 << bit
+            else:
+                # For each PCCS, the Data it needs is already in the MQTT req struct
+                # Publish the data to the topic below, with /{device_id}
+                client.publish(f"pccs/data/{device_id}", header + payloads[device_id])
+        if mask:
+            client.publish(TOPIC_GO, GO.pack(event, position, mask))
+        return StagedEvent(event, position, segment, changed, payloads)
+
+    # Process the data in the csv for the different detector functions. Commits and fires staged, staging upcoming
+    # (the next segment, None at the end of a pass) on the way, and returns what is staged now.
+    def slab_run(self, staged, upcoming):
+        if staged is None:
+            return self.stage_event(upcoming) if upcoming is not None else None
+        event, position, segment, changed, payloads = staged
+
+        # How many times you want this flashing setup to be run
+        flashing_event_repeat_times = segment.repeat
+
+        print(f"Entered Slab Run, event {event}, {flashing_event_repeat_times} flashes, "
+              f"good_events: {self.good_events}")
+
+        # Frequency of flashing
+        flashing_rate = segment.rate
+
+        # Trigger MilliDAQ or not
+        trigger = segment.trigger
 
-            time.sleep(0.5)
+        # Ready_lock is a blocking method for the set ready_for_flash. It is used to keep track of when all hand-shook
+        # devices have successfully sent their data to the picos and received good responses. The event starts with
+        # nobody ready, only readies sent back with its id count.
+        pccs_controller.begin_event(event)
+        if changed:
+            publish_commit(event)
+
+        # After the commit, we wait for the PCCS that got new data to respond ready, if within 10 seconds not every
+        # one of them has responded, we will not send the pulse and instead skip the whole segment, moving to the next
+        # flashing event
+        if not pccs_controller.wait_for_all_ready(timeout=10, expected=changed):
+            print("Timeout waiting for all subs — skipping this segment")
+            log_error(device="System", error="Timeout waiting for Devices to respond ready after sending Data")
+            # A device that did not answer may have half written its Picos, send its data again next time
+            for device_id in changed:
+                pccs_controller.clear_delivered(device_id)
+            self.good_events = 0
+            return self.stage_event(upcoming) if upcoming is not None else None
 
-    # Process the data in the csv for the different detector functions
-    def slab_run(self, datai):
+        # Only a device that confirmed with ready_for_flash really has the data (an offline one is not waited for)
+        for device_id in changed & pccs_controller.get_ready_for_flash():
+            pccs_controller.set_delivered(device_id, payloads[device_id])
 
-        print("Entered Slab Run")
+        # The next event loads on the devices during this one's flashes
+        next_staged = self.stage_event(upcoming) if upcoming is not None else None
 
-        # Length of LED Pulse ~ 100-1100 ns
-        pulse_length = int(datai[4])
-        trigger = int(datai[3])
+        # Whatever is left of the dead time of the last pulse, the commit ran during the rest of it
+        time.sleep(max(0.0, self.next_pulse_time - time.perf_counter()))
 
-        # The data for each of the 192 channels (PMT Leds) in the Slab detector
-        chan_val = datai[5:197]
+        if flashing_event_repeat_times == 1:
+            print("All subs ready — firing pulse")
+            publish_send_pulse(trigger, event, position)
+            pccs_controller.pulse_sent(after_ready=bool(changed))
+            if pccs_controller.wait_for_pulse_done(event, PULSE_DONE_TIMEOUT):
+                self.next_pulse_time = time.perf_counter() + DAQ_DEAD_TIME
+            else:
+                print(f"No pulse_done for event {event} after {PULSE_DONE_TIMEOUT} s, going on")
+                log_error(device="System", error=f"No pulse_done for event {event}")
+        else:
+            # The data is staged, the flasher does the whole count on its own as one fast-flash burst
+            print(f"All subs ready — fast flashing {flashing_event_repeat_times} pulses")
 
-        # Clean up the CSV, limit the voltage to be 4000 DAC counts (voltage setter).
-        processed_chan_val = [
-            '0' if val.strip() == '' or not val.strip().isdigit()
-            else ('4000' if int(val) > 4000 else val.strip())
-            for val in chan_val
-        ]
+            publish_send_fast_pulse(trigger, flashing_rate, flashing_event_repeat_times, event, position)
+            pccs_controller.pulse_sent(after_ready=bool(changed))
 
-        # Split the Data for the whole detector into 4 parts for each slab layer.
-        data_segment_flasher = [int(x) for x in processed_chan_val[0:48]]
-        data_sub = [int(x) for x in processed_chan_val[48:192]]
-        data_slices = [data_sub[i * 48:(i + 1) * 48] for i in range(3)]
+            expected_flashing_time = flashing_event_repeat_times / max(flashing_rate, 1)
+            acceptable_delay_time = expected_flashing_time * 2 + 5
 
-        # Debug
-        # print("data_main", data_segments_main)
-        # print("data_sub", data_sub)
+            # wait for a signal back (e.g., "READY_FOR_NEXT")
+            if not pccs_controller.wait_for_flashing_end(acceptable_delay_time):
+                self.good_events = 0
+                return next_staged
 
-        # Ready_lock is a blocking method for the set ready_for_flash. It is used to keep track of when all hand-shook
-        # devices have successfully sent their data to the picos and received good responses.
-        pccs_controller.clear_ready_for_flash()
-
-        # Construct the flashing data, which is larger to as it needs to set the pulse length of the event
-
-        flasher_data = [int(pulse_length)] + data_segment_flasher
-        flasher_packed = struct.pack(">49H", *flasher_data)
-        client.publish(f"pccs/data/PCCS_Flasher", flasher_packed)
-
-        for i, slice_ in enumerate(data_slices):
-            # For each Sub PCCS, format the Data it needs into the MQTT req struct
-            # Publish the data to the topic below, with /{device_id}
-            sub_packed = struct.pack(">48H", *slice_)
-            device_id = f"PCCS_Sub_{i + 1}"
-            client.publish(f"pccs/data/{device_id}", sub_packed)
-
-        # After sending all the instructions, we wait for the Sub PCCS to respond ready, if within 10 seconds
-        # not every PCCS has responded, we will not send the pulse and instead skip the pulse, moving to the
-        # next flashing event
-        if pccs_controller.wait_for_all_ready(timeout=10):
-            print("All subs ready — firing pulse")
-            publish_send_pulse(trigger)
-            self.good_events += 1
-            print(f"good_events incremented: {self.good_events}")
-            time.sleep(3)
-        else:
-            print("Timeout waiting for all subs — skipping this pulse")
-            log_error(device="System", error="Timeout waiting for Devices to respond ready after sending Data")
-            self.good_events = 0
-            time.sleep(0.10)
+        self.good_events += 1
+        print(f"good_events incremented: {self.good_events}")
+        return next_staged
 
 
 class PCCSController:
     def __init__(self):
+        # The waits below are on Conditions, add_ready_for_flash / set_flash_done wake the waiter up directly
         self.ready_for_flash = set()
-        self.ready_lock = threading.Lock()
+        self.ready_lock = threading.Condition()
+        self.last_ready_time = 0.0  # perf_counter of the last ready_for_flash
 
         self.workers_online = set()
-        self.workers_lock = threading.Lock()
+        self.workers_lock = threading.Condition()
+
+        # Devices that acknowledged the prep (reset and I2C scan)
+        self.prep_done = set()
+        self.prep_lock = threading.Condition()
+
+        # Run-upload mode, the id of the uploaded plan and the devices that unpacked it
+        self.plan_id = None
+        self.plan_loaded = set()
+        self.plan_lock = threading.Condition()
+
+        # Startup timing, from launch to the first pulse
+        self.launch_time = time.perf_counter()
+        self.first_pulse_time = None
+
+        self.flash_done = False
+        self.flash_lock = threading.Condition()
+        self.flash_done_time = 0.0
+
+        # The flasher acknowledges a single pulse with the id of its event
+        self.pulse_done_event = 0
+        self.pulse_lock = threading.Condition()
 
-        self.flash_done = Event()
-        self.flash_lock = threading.Lock()
+        # The current event (see EVENT_HEADER), the last one handed out (staged ahead of it) and the answers discarded
+        # because they were for another one, by status
+        self.event_id = 0
+        self.last_event_id = 0
+        self.stale = Counter()
+        self.stale_lock = threading.Lock()
+
+        # From the last ready_for_flash to the wait returning and to the pulse going out, and from flash_done to the
+        # wait returning
+        self.latency = {"ready_wake": WakeLatency(), "ready_to_pulse": WakeLatency(), "done_wake": WakeLatency()}
 
         self.last_heartbeat = {}
         self.heartbeat_status = {}
@@ -283,6 +465,10 @@ class PCCSController:
 
         self.expected_workers = set(expected_workers)
 
+        # The last data payload each device confirmed with a ready_for_flash, used to only re-send changed slices
+        self.delivered = {}
+        self.delivered_lock = threading.Lock()
+
     def update_heartbeat(self, device_id, timestamp=None):
         if timestamp is None:
             timestamp = time.time()
@@ -311,14 +497,102 @@ class PCCSController:
     def add_worker_online(self, worker_id):
         with self.workers_lock:
             self.workers_online.add(worker_id)
+            self.workers_lock.notify_all()
 
     def get_workers_online(self):
         with self.workers_lock:
             return set(self.workers_online)
 
-    def add_ready_for_flash(self, worker_id):
+    def wait_for_workers(self, expected, timeout):
+        with self.workers_lock:
+            return self.workers_lock.wait_for(lambda: self.workers_online >= set(expected), timeout)
+
+    def add_prep_done(self, worker_id):
+        with self.prep_lock:
+            self.prep_done.add(worker_id)
+            self.prep_lock.notify_all()
+
+    def get_prep_done(self):
+        with self.prep_lock:
+            return set(self.prep_done)
+
+    def clear_prep_done(self):
+        with self.prep_lock:
+            self.prep_done.clear()
+
+    def wait_for_prep(self, expected, timeout):
+        with self.prep_lock:
+            return self.prep_lock.wait_for(lambda: self.prep_done >= set(expected), timeout)
+
+    def start_upload(self, plan_id):
+        with self.plan_lock:
+            self.plan_id = plan_id
+            self.plan_loaded.clear()
+
+    def add_plan_loaded(self, worker_id, plan_id):
+        # Only a confirmation for the plan being uploaded counts
+        with self.plan_lock:
+            if plan_id == self.plan_id:
+                self.plan_loaded.add(worker_id)
+                self.plan_lock.notify_all()
+
+    def drop_plan(self, worker_id):
+        # The device lost its plan (restarted or failed to unpack it), its data goes out event by event again
+        with self.plan_lock:
+            self.plan_loaded.discard(worker_id)
+
+    def has_plan(self, worker_id):
+        with self.plan_lock:
+            return worker_id in self.plan_loaded
+
+    def get_plan_loaded(self):
+        with self.plan_lock:
+            return set(self.plan_loaded)
+
+    def wait_for_plan(self, expected, timeout):
+        with self.plan_lock:
+            return self.plan_lock.wait_for(lambda: self.plan_loaded >= set(expected), timeout)
+
+    def log_startup(self, phase):
+        # Time since launch at the end of a startup phase, printed and kept in startup.log
+        event = f"{phase} at {time.perf_counter() - self.launch_time:.3f} s after launch"
+        print(f"[startup] {event}")
+        log_timestamp(file_path="startup.log", event=event)
+
+    def new_event(self):
+        # Id for the next event to stage, only the run thread hands them out
+        self.last_event_id += 1
+        return self.last_event_id
+
+    def begin_event(self, event):
+        # event becomes the current one, with nobody ready and no flash done for it yet. Done holding the locks the
+        # answers are checked under, an answer for the old event is either in before (and cleared) or discarded after.
+        with self.ready_lock, self.flash_lock, self.pulse_lock:
+            self.event_id = event
+            self.ready_for_flash.clear()
+            self.flash_done = False
+
+    def is_current(self, status, worker_id, event):
+        # Whether an answer is for the current event, if not it is counted and dropped. Called holding the lock of
+        # what the answer sets.
+        if event == self.event_id:
+            return True
+        with self.stale_lock:
+            self.stale[status] += 1
+        print(f"Discarded stale {status} from {worker_id} (event {event}, current {self.event_id})")
+        return False
+
+    def stale_summary(self):
+        with self.stale_lock:
+            return dict(self.stale)
+
+    def add_ready_for_flash(self, worker_id, event):
         with self.ready_lock:
+            if not self.is_current("ready_for_flash", worker_id, event):
+                return
             self.ready_for_flash.add(worker_id)
+            self.last_ready_time = time.perf_counter()
+            self.ready_lock.notify_all()
 
     def remove_ready_for_flash(self, worker_id):
         with self.ready_lock:
@@ -336,44 +610,93 @@ class PCCSController:
         with self.ready_lock:
             self.ready_for_flash.clear()
 
-    def set_flash_done(self):
+    def get_delivered(self, device_id):
+        with self.delivered_lock:
+            return self.delivered.get(device_id)
+
+    def set_delivered(self, device_id, payload):
+        with self.delivered_lock:
+            self.delivered[device_id] = payload
+
+    def clear_delivered(self, device_id=None):
+        # Forget what one device (or with no id, every device) has, so its data is sent again on the next event
+        with self.delivered_lock:
+            if device_id is None:
+                self.delivered.clear()
+            else:
+                self.delivered.pop(device_id, None)
+
+    def set_flash_done(self, worker_id, event):
         with self.flash_lock:
-            self.flash_done.set()
+            if not self.is_current("flash_done", worker_id, event):
+                return
+            self.flash_done = True
+            self.flash_done_time = time.perf_counter()
+            self.flash_lock.notify_all()
 
     def clear_flash_done(self):
         with self.flash_lock:
-            self.flash_done.clear()
+            self.flash_done = False
+
+    def set_pulse_done(self, worker_id, event):
+        with self.pulse_lock:
+            if not self.is_current("pulse_done", worker_id, event):
+                return
+            self.pulse_done_event = event
+            self.pulse_lock.notify_all()
+
+    def wait_for_pulse_done(self, event, timeout):
+        with self.pulse_lock:
+            return self.pulse_lock.wait_for(lambda: self.pulse_done_event == event, timeout)
+
+    def pulse_sent(self, after_ready=True):
+        # Called right after the pulse is published, the time from the last ready to it (if it waited for one), and
+        # the time from launch for the first pulse of the run
+        now = time.perf_counter()
+        with self.ready_lock:
+            last_ready = self.last_ready_time
+        if after_ready and last_ready:
+            self.latency["ready_to_pulse"].record(now - last_ready)
+        if self.first_pulse_time is None:
+            self.first_pulse_time = now
+            self.log_startup("first pulse")
 
-    # A function that checks if all the expected workers (from the handshake) are ready, checking every 0.1 seconds with a
-    # variable timeout
+    def latency_summary(self):
+        return {name: latency.summary() for name, latency in self.latency.items()}
 
-    def wait_for_all_ready(self, timeout=10):
-        start = time.time()
-        print(f"[wait_for_all_ready] Expected: {self.workers_online}")
+    # A function that waits until all the expected workers (from the handshake) are ready, woken up by every
+    # add_ready_for_flash, with a variable timeout. expected narrows it down to the workers that were actually sent
+    # new data.
 
-        while time.time() - start < timeout:
-            with self.ready_lock:
-                ready_copy = set(self.ready_for_flash)
+    def wait_for_all_ready(self, timeout=10, expected=None):
+        expected = self.get_workers_online() if expected is None else self.get_workers_online() & set(expected)
+        print(f"[wait_for_all_ready] Expected: {expected}")
 
-            if ready_copy >= self.workers_online:
-                print(f"[wait_for_all_ready] Got ready: {ready_copy}")
-                return True
-            time.sleep(0.5)
+        with self.ready_lock:
+            # Only a wait that really had to wait for a ready says how fast the wake up is
+            waited = not self.ready_for_flash >= expected
+            ready = self.ready_lock.wait_for(lambda: self.ready_for_flash >= expected, timeout)
+            ready_copy = set(self.ready_for_flash)
+            last_ready = self.last_ready_time
+        if ready and waited:
+            self.latency["ready_wake"].record(time.perf_counter() - last_ready)
 
         print(f"[wait_for_all_ready] Got ready: {ready_copy}")
-        return False
+        return ready
 
     def wait_for_flashing_end(self, timeout):
         print("Fast flash timeout length = ", timeout)
-        self.flash_done.clear()  # Ensure we start waiting fresh
-        start_time = time.time()
-
-        while time.time() - start_time < timeout:
-            if self.flash_done.is_set():
-                self.flash_done.clear()
-                print("Flashing complete")
-                return True
-            time.sleep(0.1)
+        # flash_done is cleared by begin_event before the burst is published, clearing it here could miss a short burst
+        with self.flash_lock:
+            waited = not self.flash_done
+            done = self.flash_lock.wait_for(lambda: self.flash_done, timeout)
+            self.flash_done = False
+            done_time = self.flash_done_time
+        if done:
+            if waited:
+                self.latency["done_wake"].record(time.perf_counter() - done_time)
+            print("Flashing complete")
+            return True
 
         print("Timeout waiting for flasher finishing flashes")
         log_error(device="System", error="Timeout waiting for flashing complete signal")
@@ -388,6 +711,18 @@ def on_message(client, userdata, message):
     print(f"Main RPi received: {message.topic} -> {message.payload}")
     # Extract the message topic and payload (which needs to be decoded from the struct) for sorting
     topic = message.topic
+
+    # The binary answers of the run-upload mode, same as the JSON statuses below
+    if topic.startswith("pccs/ack/"):
+        sub_id = topic.split("/")[-1]
+        try:
+            code, event = ACK.unpack(message.payload)
+            handle_run_status(sub_id, ACK_STATUS[code], event)
+        except (struct.error, KeyError) as e:
+            print(f"Bad ack from {sub_id}: {message.payload}")
+            log_error(error=e, device=sub_id)
+        return
+
     payload = message.payload.decode()
 
     if topic == TOPIC_HANDSHAKE:
@@ -397,6 +732,9 @@ def on_message(client, userdata, message):
             sub_id = payload.removeprefix("READY_")  # Python 3.9+; or use slicing
             print(f"{sub_id} is online.")
             pccs_controller.add_worker_online(worker_id=sub_id)
+            # A (re)started device has nothing on its Picos yet, nor an uploaded plan
+            pccs_controller.clear_delivered(sub_id)
+            pccs_controller.drop_plan(sub_id)
 
     elif topic.startswith("pccs/status/"):
         # If the message comes from the STATUS topic, extract the id of the sender and process
@@ -407,13 +745,19 @@ def on_message(client, userdata, message):
 
             # If the status is a ready to flash, which the Subs send after writing their Picos,
             # add that device to the list
-            if status == "ready_for_flash":
-                print(f"{sub_id} is ready for flash.")
-                pccs_controller.add_ready_for_flash(sub_id)
+            # The run path answers carry the id of the event they are for, one without it is never current
+            if status in ("ready_for_flash", "flash_done", "pulse_done"):
+                handle_run_status(sub_id, status, data.get("event"))
 
-            elif status == "flash_done":
-                print("Received flash done")
-                pccs_controller.set_flash_done()
+            # The device unpacked its slice of the uploaded plan
+            elif status == "plan_loaded":
+                print(f"{sub_id} loaded plan {data.get('plan_id', 0):08x}, {data.get('events')} events")
+                pccs_controller.add_plan_loaded(sub_id, data.get("plan_id"))
+
+            # The device finished its reset and I2C scan (Initialize_Devices waits for all of them)
+            elif status == "prep_done":
+                print(f"{sub_id} prep done in {data.get('elapsed', '?')} s")
+                pccs_controller.add_prep_done(sub_id)
 
             # A heartbeat mechanism is implemented in which the Sub PCCS send out a heartbeat every n seconds.
             # We can use this information to figure out when network connectivity has issues
@@ -435,9 +779,13 @@ def on_message(client, userdata, message):
             message = data.get("message", "Unknown error")
             print(f"[{worker}] Error: {message}")
 
-            # Set error state and log
+            # Set error state and log, whatever went wrong the device's data is sent again on the next event
             error_manager.set_error(worker, message)
             log_error(error=message, device=worker)
+            pccs_controller.clear_delivered(worker)
+            # No usable plan on the device, it gets its data event by event from now on
+            if data.get("context") == "plan":
+                pccs_controller.drop_plan(worker)
         except Exception as e:
             print(f"Failed to parse error message from {worker}: {e}")
             log_error(error=e, device=worker)
@@ -457,6 +805,21 @@ def on_message(client, userdata, message):
             print(f"Failed to parse error message from {worker}: {e}")
             log_error(error=e, device=worker)
 
+def handle_run_status(sub_id, status, event):
+    # ready_for_flash, flash_done and pulse_done of an event, whether they came as JSON or as an ACK
+    if status == "ready_for_flash":
+        print(f"{sub_id} is ready for flash.")
+        pccs_controller.add_ready_for_flash(sub_id, event)
+
+    elif status == "flash_done":
+        print("Received flash done")
+        pccs_controller.set_flash_done(sub_id, event)
+
+    # A single pulse was fired
+    elif status == "pulse_done":
+        pccs_controller.set_pulse_done(sub_id, event)
+
+
 def monitor_heartbeat(pccs_ctrl, error_mang, timeout=60, check_interval=15):
     while True:
         now = time.time()
@@ -467,6 +830,7 @@ def monitor_heartbeat(pccs_ctrl, error_mang, timeout=60, check_interval=15):
             if not healthy and pccs_ctrl.is_healthy(sub_id):
                 print(f"[WARNING] Missed heartbeat from {sub_id}")
                 pccs_ctrl.mark_unhealthy(sub_id)
+                pccs_ctrl.clear_delivered(sub_id)
                 log_error(f"Missed heartbeat from {sub_id} at {time.strftime('%Y-%m-%d %H:%M:%S')}")
                 error_mang.set_error(sub_id, "Missing Heartbeat")
 
@@ -477,24 +841,53 @@ def monitor_heartbeat(pccs_ctrl, error_mang, timeout=60, check_interval=15):
         time.sleep(check_interval)
 
 
-def publish_send_pulse(trig):
+def publish_send_pulse(trig, event, position=None):
+    # The flasher sends the event id back with pulse_done. With the plan uploaded it has the pulse settings itself.
+    if position is not None and pccs_controller.has_plan("PCCS_Flasher"):
+        client.publish(TOPIC_FIRE, FIRE.pack(event, position))
+        return
     pulse_msg = {
         "type": "single",
-        "trigger": trig
+        "trigger": trig,
+        "event": event
     }
     client.publish(TOPIC_PULSE, json.dumps(pulse_msg))
 
 
-def publish_send_fast_pulse(trig, rate, number):
+def publish_send_fast_pulse(trig, rate, number, event, position=None):
+    # The flasher sends the event id back with flash_done. With the plan uploaded it has the pulse settings itself.
+    if position is not None and pccs_controller.has_plan("PCCS_Flasher"):
+        client.publish(TOPIC_FIRE, FIRE.pack(event, position))
+        return
     pulse_msg = {
         "type": "fast",
         "trigger": trig,
         "rate": rate,  # e.g., Hz
-        "count": number  # total number of pulses
+        "count": number,  # total number of pulses
+        "event": event
     }
     client.publish(TOPIC_PULSE, json.dumps(pulse_msg))
 
 
+def publish_commit(event):
+    # Every device with data staged for event puts it onto its Picos and answers with ready_for_flash
+    client.publish(TOPIC_COMMIT, EVENT_HEADER.pack(event))
+
+
+def publish_abort():
+    client.publish(TOPIC_ABORT, "ABORT")
+
+
+def run_csv(Import):
+    # A Ctrl-C during the run stops the flasher too, instead of it finishing a burst nobody waits for anymore
+    try:
+        Import.start_csv_run()
+    except KeyboardInterrupt:
+        print("Run interrupted, aborting the flashing")
+        publish_abort()
+        raise
+
+
 def publish_bad_channels_data(bad_data_array):
     bad_channels_flasher = [int(x) for x in bad_data_array[0:24]]
     bad_chans_sub = [int(x) for x in bad_data_array[24:96]]
@@ -513,58 +906,52 @@ def publish_bad_channels_data(bad_data_array):
 
 
 if __name__ == '__main__':
-    time.sleep(2)
+    # --upload sends every device its slice of the plan before the run and drives the run with GO / FIRE messages
+    # --stream skips the compiled plan, the rows are read, cleaned and collapsed from the csv while the run goes
+    upload = "--upload" in sys.argv[1:]
+    stream = "--stream" in sys.argv[1:]
+    argv = [arg for arg in sys.argv if arg not in ("--upload", "--stream")]
+    if len(argv) not in (2, 3):
+        print("Usage: python PCCS_Control.py <file_path> Optional<number of repeats> [--upload] [--stream]\n")
+        print(
+            "For the usage and system information please refer to Github Repo: MilliQan-Experiment-LV-Dist-Calibration "
+            "(will need to search within github)")
+        sys.exit(1)
+
+    # PCCS Controller - Class that handles Locks
+    # Error Manager - A separate class which handles locking of everything when errors occur
+    # Heartbeat Manager - A class which handles the MQTT hearbeats
+    # Created first, the callback needs them as soon as the first message comes in
+    pccs_controller = PCCSController()
+    error_manager = ErrorManager(expected_workers)
 
-    # Init the MQTT Client and connect it to the MQTT Broker
+    # Init the MQTT Client and connect it to the MQTT Broker. The subscriptions go out before the SYNC on the same
+    # connection, the broker has them in place before any answer to it comes back.
     client = mqtt.Client(client_id="Controller")
+    client.on_message = on_message
     client.connect(broker_ip, 1883, 60)
-
-    # Start the listening/handling of the MQTT communication and subscribe to the topics
-    client.loop_start()
     client.subscribe(TOPIC_HANDSHAKE)
     client.subscribe(TOPIC_STATUS)
     client.subscribe(TOPIC_ERROR)
     client.subscribe(TOPIC_CLEAR)
+    client.subscribe(TOPIC_ACK)
 
-    # PCCS Controller - Class that handles Locks
-    # Error Manager - A separate class which handles locking of everything when errors occur
-    # Heartbeat Manager - A class which handles the MQTT hearbeats
-    pccs_controller = PCCSController()
-    error_manager = ErrorManager(expected_workers)
+    # Start the listening/handling of the MQTT communication
+    client.loop_start()
 
     # Start Heartbeat monitor
     threading.Thread(target=monitor_heartbeat, args=(pccs_controller, error_manager), daemon=True).start()
 
-    # Define the callback function that process incoming messages.
-    client.on_message = on_message
-
-    # Create a set of connected PCCS and keep info on their last heartbeat
-    while "PCCS_Flasher" not in pccs_controller.get_workers_online():
-        # Send out the "SYNC" message on the HANDSHAKE topic, the PCCS_Subs will respond with a message which will then
-        # populate the workers_ready set
-        client.publish(TOPIC_HANDSHAKE, "SYNC")
-        print("Sent SYNC handshake to all listeners")
-
-        # Wait up to 6 seconds for READY responses
-        time.sleep(6)
-        print(f"Workers online: {pccs_controller.get_workers_online()}")
-        # Repeat until at least PCCS_Flasher device is connected
-
     # Finally try to create the Import_csv objects with the parameters called when running the function
-    # The third optional argument is the number of repeats which defaults of 1
-    if len(sys.argv) == 3:
-        Import = Import_csv(sys.argv[1], int(sys.argv[2]))
-        Initialize_Devices()
-        Import.start_csv_run()
-        print("Import Run finished successfully")
-    if len(sys.argv) == 2:
-        Import = Import_csv(sys.argv[1])
-        Initialize_Devices()
-        Import.start_csv_run()
-        print("Import Run finished successfully")
-    else:
-        print("Usage: python PCCS_Control.py <file_path> Optional<number of repeats>\n")
-        print(
-            "For the usage and system information please refer to Github Repo: MilliQan-Experiment-LV-Dist-Calibration "
-            "(will need to search within github)")
-        sys.exit(1)
+    # The third optional argument is the number of repeats which defaults of 1. The plan compiles before the
+    # handshake, a new campaign file doesn't add to the wait for the devices (with --stream there is nothing to
+    # compile).
+    Import = Import_csv(argv[1], int(argv[2]) if len(argv) == 3 else 1, compiled=not stream)
+    pccs_controller.log_startup("plan ready" if not stream else "streaming the csv")
+
+    Handshake()
+    Initialize_Devices()
+    if upload:
+        Import.upload_plan()
+    run_csv(Import)
+    print("Import Run finished successfully")
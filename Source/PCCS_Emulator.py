@@ -0,0 +1,349 @@
+# PCCS Emulator - A stand-in for spidev.SpiDev that behaves like a Pico blade running Source/Pico/main.c (and at the
+# end one for gpiod that records when every line was set).
+# It lets DetectorLayer style code (frames, verification, desync_protocol) run at full speed on any machine, for the
+# benchmarks in PCCS_Bench and for trying changes to the SPI code without the detector.
+#
+# It has NOT been checked against a Pico on the bench or against an SPI capture (there is none in the repo yet), so
+# the numbers PCCS_Bench gets from it are only as good as the assumptions below.
+#
+# Taken from main.c:
+#   - The main loop, spi_write_read_blocking of a 0x24 (36) byte page into in_buf while out_buf goes out on MISO. The
+#     pages are counted by the Pico on its own, a transfer of the wrong length shifts every page after it.
+#   - processInput, bytes 0-3 and 32-35 of the page are echoed into out_buf, 5-31 zeroed (byte 4 is never touched, it
+#     stays the 0xfb from the startup buffer). 0xFF pages are dispatched on the opcode, anything else is a desync, the
+#     Pico applies zeroed pins and voltages and only echoes the next 4 pages (desync_flag).
+#   - The status writeStatus puts in bytes 5-9 after every page it processes, the channels whose base write failed
+#     (failing, only channels the scan found a base on can fail) and the channels the scan found a base on (bases).
+#
+# Assumed (from the RP2040 datasheet and the SDK source, not measured):
+#   - The PL022 FIFOs, 8 deep each way. The SDK loop keeps the TX FIFO topped up (at most 8 bytes ahead of what was
+#     received), when it is empty the Pico clocks out zeros. While the Pico is busy with a page the bytes the master
+#     sends pile up in the RX FIFO, from the 9th on they are lost (overrun).
+#   - Chip select does not frame the pages (CPHA 1, the PL022 slave just keeps shifting bytes while it is low).
+#   - The time the Pico spends on a page before it starts the next spi_write_read_blocking (I2C writes, the mux
+#     sleep_ms(5)s, the printf of the page), per opcode in PROCESSING_TIMES or given per emulator. These are
+#     estimates, the USB printf alone could be off by a lot.
+# INSTANT_PICO turns the timing off (every page processed the moment it is in, no byte ever lost), so what follows
+# from the main.c rules alone can be told apart from what depends on the FIFO and timing assumptions.
+#
+# Time is the clock given to the emulator. With a VirtualClock nothing ever waits, the wire time of every transfer is
+# added to the clock and time.sleep can be swapped for VirtualClock.sleep, so a 0.4 s settle costs nothing.
+#
+#   picos = {}
+#   spi = SpiTransport(spi_factory=emulator_factory(picos, clock=clock))
+#   ... picos[(0, cs)] is the emulated Pico behind chip select cs
+
+import time
+from collections import Counter, deque
+
+import numpy as np
+
+from PCCS_Frame import (FRAME_SIZE, SYNC_BYTE, BAR_OPCODE, SCAN_OPCODE, SLAB_OPCODES, LIGHTBAR_OPCODES,
+                        ECHO_SLICES, STATUS_OFFSET, STATUS_VERSION)
+
+FIFO_DEPTH = 8
+DESYNC_PAGES = 4  # desync_flag
+
+# Rough time the firmware takes for a page of each opcode, in seconds. Bar/slab pages are 16 channels of mux select +
+# DAC write at 400 kHz I2C, lightbar pages have the sleep_ms(5) around every mux write, the scan is the version scan
+# (16 x 5 ms) and both lightbar configs. Every page is also printed over USB.
+PAGE_PRINT_TIME = 0.0003
+PROCESSING_TIMES = {
+    BAR_OPCODE: 0.004,
+    SLAB_OPCODES[0]: 0.004,
+    SLAB_OPCODES[1]: 0.0035,
+    LIGHTBAR_OPCODES[0]: 0.17,
+    LIGHTBAR_OPCODES[1]: 0.17,
+    SCAN_OPCODE: 0.42,
+}
+DESYNC_TIME = 0.004  # The zeroed pins and voltages are applied like a bar page
+
+# PicoEmulator options for a Pico that takes no time on a page
+INSTANT_PICO = {"processing_times": {opcode: 0.0 for opcode in PROCESSING_TIMES}, "page_print_time": 0.0,
+                "desync_time": 0.0}
+
+# The channels (bit 15 - channel) the base writes of a page go to
+ALL_CHANNELS = 0xFFFF
+HALF_CHANNELS = (0xFF00, 0x00FF)
+
+
+class VirtualClock:
+    # A clock that only moves when told to, used as the emulator clock and in place of time.sleep
+    def __init__(self, start=0.0):
+        self.now = start
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += max(seconds, 0)
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+class PicoEmulator:
+    # One Pico blade, the firmware state and its SPI slave
+    def __init__(self, processing_times=None, page_print_time=PAGE_PRINT_TIME, desync_time=DESYNC_TIME,
+                 bases=ALL_CHANNELS, failing=0, clock=time.monotonic):
+        self.processing_times = {**PROCESSING_TIMES, **(processing_times or {})}
+        self.page_print_time = page_print_time
+        self.desync_time = desync_time
+        self.bases = bases
+        self.failing = failing
+        self.clock = clock
+
+        self.out_buf = bytearray(~i & 0xFF for i in range(FRAME_SIZE))
+        self.in_buf = bytearray(FRAME_SIZE)
+        self.desync_flag = 0
+        self.rx_fifo = deque()
+        self.tx_fifo = deque()
+        self.rx_remaining = 0  # Bytes still to be read / written by the current spi_write_read_blocking
+        self.tx_remaining = 0
+        self.in_page = False
+        self.busy_until = 0.0  # Time the Pico gets back to spi_write_read_blocking
+        self.bus_free = 0.0  # End of the last transfer, a transfer can't start before it
+
+        # What the Pico has applied, {opcode: bytes 2-35 of the page}, its status and counters
+        self.settings = {}
+        self.chan_faults = 0
+        self.chan_present = 0
+        self.stats = Counter()
+
+    # -- Firmware --
+
+    def _start_page(self):
+        self.in_page = True
+        self.rx_remaining = self.tx_remaining = FRAME_SIZE
+
+    def _service(self, t):
+        # Run the Pico up to time t: the spi_write_read_blocking loop and the page processing after it
+        while True:
+            if not self.in_page:
+                if t < self.busy_until:
+                    return
+                self._start_page()
+            while self.rx_remaining and self.rx_fifo:
+                self.in_buf[FRAME_SIZE - self.rx_remaining] = self.rx_fifo.popleft()
+                self.rx_remaining -= 1
+            while (self.tx_remaining and len(self.tx_fifo) < FIFO_DEPTH
+                   and self.rx_remaining < self.tx_remaining + FIFO_DEPTH):
+                self.tx_fifo.append(self.out_buf[FRAME_SIZE - self.tx_remaining])
+                self.tx_remaining -= 1
+            if self.rx_remaining or self.tx_remaining:
+                return
+            self.in_page = False
+            self.busy_until = t + self.page_print_time + self._process_page()
+
+    def _process_page(self):
+        # The main loop after a page, returns the time it took
+        buf, out = self.in_buf, self.out_buf
+        self.stats["pages"] += 1
+        for echo in ECHO_SLICES:
+            out[echo] = buf[echo]
+        if self.desync_flag:
+            self.desync_flag -= 1
+            return 0.0
+
+        out[5:32] = bytes(27)
+        if buf[0] != SYNC_BYTE:
+            self.stats["desyncs"] += 1
+            self.settings[BAR_OPCODE] = bytes(FRAME_SIZE - 2)
+            self.desync_flag = DESYNC_PAGES
+            self._write_bases(ALL_CHANNELS)
+            busy = self.desync_time
+        elif buf[1] in self.processing_times:
+            opcode = buf[1]
+            self.stats[f"0x{opcode:02x}"] += 1
+            self.settings[opcode] = bytes(buf[2:])
+            if opcode == SCAN_OPCODE:
+                self.chan_present = self.bases
+                self._write_bases(ALL_CHANNELS)  # The lightbar configs
+            elif opcode in SLAB_OPCODES:
+                self._write_bases(HALF_CHANNELS[SLAB_OPCODES.index(opcode)])
+            elif opcode in LIGHTBAR_OPCODES:
+                self._write_bases(HALF_CHANNELS[LIGHTBAR_OPCODES.index(opcode)])
+            else:
+                self._write_bases(ALL_CHANNELS)
+            busy = self.processing_times[opcode]
+        else:
+            self.stats["echoed"] += 1  # Unknown opcode, falls through the inner switch
+            busy = 0.0
+        out[STATUS_OFFSET:STATUS_OFFSET + 5] = bytes([STATUS_VERSION, *self.chan_faults.to_bytes(2, "big"),
+                                                      *self.chan_present.to_bytes(2, "big")])
+        return busy
+
+    def _write_bases(self, channels):
+        # The base writes to channels, a channel without a base (none found by the last scan) can't fail
+        self.chan_faults = (self.chan_faults & ~channels) | (self.failing & self.chan_present & channels)
+
+    # -- SPI --
+
+    def glitch(self, count):
+        # count stray clock edges (e.g. noise on SCK), the Pico shifts count bytes the master never sent or saw
+        self.exchange(bytes(count), 50 * 1000)
+        self.stats["glitches"] += 1
+
+    def exchange(self, data, speed_hz):
+        # One transfer from the master, returns what the Pico clocked out on MISO
+        byte_time = 8 / speed_hz
+        t = max(self.clock(), self.bus_free)
+        miso = bytearray(len(data))
+        for i, mosi in enumerate(data):
+            self._service(t)
+            if self.tx_fifo:
+                miso[i] = self.tx_fifo.popleft()
+            else:
+                self.stats["underruns"] += 1
+            t += byte_time
+            if len(self.rx_fifo) < FIFO_DEPTH:
+                self.rx_fifo.append(mosi)
+            else:
+                self.stats["overruns"] += 1
+            self._service(t)
+        self.bus_free = t
+        self.stats["bytes"] += len(data)
+        advance = getattr(self.clock, "advance", None)
+        if advance is not None:
+            advance(t - self.clock())
+        return miso
+
+
+class EmulatedSpiDev:
+    # The part of spidev.SpiDev the PCCS code uses. The Picos live in a dict shared by all the handles, keyed by
+    # (bus, chip select), so one survives its handle being closed and opened again like the real one.
+    def __init__(self, picos=None, **pico_options):
+        self.picos = picos if picos is not None else {}
+        self.pico_options = pico_options
+        self.pico = None
+        self.mode = 0
+        self.max_speed_hz = 50 * 1000
+
+    def open(self, bus, cs):
+        self.pico = self.picos.get((bus, cs))
+        if self.pico is None:
+            self.pico = self.picos[(bus, cs)] = PicoEmulator(**self.pico_options)
+
+    def close(self):
+        self.pico = None
+
+    def xfer3(self, data):
+        if self.pico is None:
+            raise OSError("SPI device is not open")
+        return tuple(self.pico.exchange(bytes(data), self.max_speed_hz))
+
+    xfer2 = xfer3
+    xfer = xfer3
+
+
+def emulator_factory(picos=None, **pico_options):
+    # spi_factory for SpiTransport, every chip select opened gets its own emulated Pico in picos
+    picos = picos if picos is not None else {}
+    return lambda: EmulatedSpiDev(picos, **pico_options)
+
+
+# A stand-in for the gpiod module (the v1 bindings the PCCS code uses), for timing the pulse code without the board.
+# Every set_value / set_values is timestamped with perf_counter_ns into arrays allocated when the chip is opened,
+# with the state of all the lines of the chip after it (bit offset = line offset), so the edges of every line can be
+# read back afterwards. Recording costs a clock read and 2 array writes, about what the ioctl it stands in for does.
+#
+#   gpio = RecordingGpio()
+#   lines = PulseLines(gpio=gpio)
+#   ... gpio.chips["gpiochip4"].times[:count], .states[:count]
+
+GPIO_RECORD_SIZE = 1 << 16  # Calls recorded per chip, the ones after are counted in dropped
+
+
+class RecordingChip:
+    def __init__(self, name, size=GPIO_RECORD_SIZE):
+        self.name = name
+        self.times = np.zeros(size, dtype=np.int64)
+        self.states = np.zeros(size, dtype=np.uint64)
+        self.size = size
+        self.count = 0
+        self.dropped = 0
+        self.state = 0
+        self.start_state = 0  # State before the first call recorded
+        self.consumers = {}  # {offset: consumer}, a line can only be requested once like on the real chip
+
+    def get_line(self, offset):
+        return RecordingLines(self, [offset])
+
+    def get_lines(self, offsets):
+        return RecordingLines(self, list(offsets))
+
+    def record(self, mask, bits):
+        now = time.perf_counter_ns()
+        self.state = self.state & ~mask | bits
+        if self.count < self.size:
+            self.times[self.count] = now
+            self.states[self.count] = self.state
+            self.count += 1
+        else:
+            self.dropped += 1
+
+    def clear(self):
+        self.count = self.dropped = 0
+        self.start_state = self.state
+
+    def line_edges(self, offset):
+        # (rise times, fall times) of a line in ns, from the recorded states
+        times = self.times[:self.count]
+        if not self.count:
+            return times, times
+        levels = ((self.states[:self.count] >> np.uint64(offset)) & np.uint64(1)).astype(np.int8)
+        changes = np.diff(levels, prepend=np.int8(self.start_state >> offset & 1))
+        return times[changes == 1], times[changes == -1]
+
+
+class RecordingLines:
+    # A line or a bulk of lines of a RecordingChip
+    def __init__(self, chip, offsets):
+        self.chip = chip
+        self.offsets = offsets
+        self.bits = [1 << offset for offset in offsets]
+        self.mask = sum(self.bits)
+
+    def request(self, consumer="", type=None, default_vals=None):
+        for offset in self.offsets:
+            if offset in self.chip.consumers:
+                raise OSError(f"Line {offset} of {self.chip.name} is busy ({self.chip.consumers[offset]})")
+            self.chip.consumers[offset] = consumer
+        if default_vals is not None:
+            self.chip.state = self.chip.state & ~self.mask | self._bits(default_vals)
+            if not self.chip.count:
+                self.chip.start_state = self.chip.state
+
+    def release(self):
+        for offset in self.offsets:
+            self.chip.consumers.pop(offset, None)
+
+    def _bits(self, values):
+        return sum(bit for bit, value in zip(self.bits, values) if value)
+
+    def set_values(self, values):
+        self.chip.record(self.mask, self._bits(values))
+
+    def set_value(self, value):
+        self.set_values([value])
+
+    def get_values(self):
+        return [self.chip.state >> offset & 1 for offset in self.offsets]
+
+    def get_value(self):
+        return self.get_values()[0]
+
+
+class RecordingGpio:
+    # The module, gpio.Chip(name) opens (or reopens) a recording chip
+    LINE_REQ_DIR_OUT = 3  # gpiod's values
+    LINE_REQ_DIR_IN = 2
+
+    def __init__(self, size=GPIO_RECORD_SIZE):
+        self.size = size
+        self.chips = {}
+
+    def Chip(self, name):
+        if name not in self.chips:
+            self.chips[name] = RecordingChip(name, self.size)
+        return self.chips[name]
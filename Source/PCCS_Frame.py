@@ -0,0 +1,148 @@
+# PCCS Frame - The SPI frame encoder shared by PCCS_Receiver, PCCS_Sender, LV_Import and rpi5.
+# It builds the 36 byte frames described in PCCS_Receiver/PCCS_Sender (opcode header, 2 pattern bytes and 16
+# big-endian voltages). Every frame lives in a buffer that is allocated once. The voltages of an event are converted to
+# big-endian uint16 bytes with one NumPy cast, the pattern bits are packed with np.packbits from a wider view of those
+# same bytes, and both are copied into the frame buffers with slice assignments. Encoding an event is a few vectorized operations instead of
+# per-bit and per-byte Python loops, and the buffer itself is what gets handed to spi.xfer3.
+#
+# The buffers are reused by the next encode, so a frame that has to be kept (e.g. as the last frame sent to a Pico)
+# must be copied with bytes(frame).
+
+import numpy as np
+
+FRAME_SIZE = 36
+FRAME_CHANNELS = 16
+SYNC_BYTE = 0xFF
+
+# The 0xF_ opcode byte of each frame type
+BAR_OPCODE = 0xFF
+SCAN_OPCODE = 0xFE
+SLAB_OPCODES = (0xFC, 0xFD)  # Central blade, auxiliary blade
+LIGHTBAR_OPCODES = (0xFA, 0xFB)
+# Not a command, the firmware falls through to its default case and only echoes the frame back. Changes nothing on
+# the Pico, so it can be sent at any time to check the link.
+PROBE_OPCODE = 0xF1
+
+# The Pico echoes these bytes of every frame it receives back on the next transfer
+ECHO_SLICES = (slice(0, 4), slice(32, 36))
+# Byte 4 of the Pico's output buffer is never written by the firmware, it stays the 0xfb (~4) it starts with, so it
+# marks where the echo of bytes 0-3 is in whatever comes back
+ECHO_BEACON = 0xFB
+
+# Bytes 5-9 of the Pico's output buffer are its status (written after every page it processes, see Pico/main.c): a
+# version byte, then the channels whose last base write failed and the channels the last scan found a base on, as 16
+# bit big-endian maps with channel 0 in the MSB like the pattern bytes. Firmware without it leaves them at 0.
+STATUS_OFFSET = 5
+STATUS_VERSION = 1
+
+# The resync frame is a ramp of values that are neither 0xff nor the beacon, the echo of a page made of it tells at
+# which byte of the frame the Pico's page starts
+RESYNC_BASE = 0x80
+
+
+def new_frame(opcode):
+    frame = bytearray(FRAME_SIZE)
+    frame[0] = SYNC_BYTE
+    frame[1] = opcode
+    return frame
+
+
+def probe_frame(seq):
+    # A probe frame, a sequence number and its complement in the echoed bytes so every probe echo is different
+    frame = new_frame(PROBE_OPCODE)
+    frame[2:4] = (seq & 0xFFFF).to_bytes(2, "big")
+    frame[32:36] = bytes([0xA5, 0x5A, seq & 0xFF, ~seq & 0xFF])
+    return frame
+
+
+def echo_matches(pico_return, sent, shift=0):
+    # Did the Pico echo back the echoed bytes of the frame sent before this transfer. shift is how many bytes the
+    # Pico's output runs behind the frames (see echo_shift), the part of the echo pushed past the end is not checked.
+    return (bytes(pico_return[shift:shift + 4]) == bytes(sent[0:4])
+            and bytes(pico_return[32 + shift:FRAME_SIZE]) == bytes(sent[32:FRAME_SIZE - shift]))
+
+
+def echo_shift(pico_return, sent):
+    # Where the echo of sent starts in the return, found from the beacon after it. Bytes the master clocks while the
+    # Pico is busy with a page come out of an empty TX FIFO, the Pico's output then runs that many bytes behind the
+    # frames for good (only a restart clears it). None if the echo is not there.
+    for beacon in range(4, len(pico_return)):
+        if pico_return[beacon] == ECHO_BEACON and bytes(pico_return[beacon - 4:beacon]) == bytes(sent[0:4]):
+            return beacon - 4
+    return None
+
+
+def resync_frame():
+    return bytearray(RESYNC_BASE + i for i in range(FRAME_SIZE))
+
+
+def page_offset(pico_return):
+    # The byte of a resync frame the Pico's pages start at, from the echo of a page filled with resync frames.
+    # None if the return has no such echo (the page was not all resync frame yet, or its echo did not fit in).
+    for beacon in range(4, len(pico_return)):
+        if pico_return[beacon] != ECHO_BEACON:
+            continue
+        offset = pico_return[beacon - 4] - RESYNC_BASE
+        if 0 <= offset < FRAME_SIZE and all(pico_return[beacon - 4 + i] == RESYNC_BASE + (offset + i) % FRAME_SIZE
+                                            for i in range(4)):
+            return offset
+    return None
+
+
+def pattern_bytes(voltage, leds_per_channel=1):
+    # The 2 pattern bytes (channel 0 is the MSB of the first byte) from the packed big-endian voltages. Viewing the
+    # bytes of the LEDs of a channel as one wider integer gives the OR of the pair for free, it is non zero if any of
+    # them is on.
+    return np.packbits(np.frombuffer(voltage, dtype=f">u{2 * leds_per_channel}") != 0).tobytes()
+
+
+class FrameEncoder:
+    # One encoder per DetectorLayer (blade pair). The two halves are shared by the slab and lightbar frames, only the
+    # opcode byte differs, it is set when the frames are asked for.
+    def __init__(self):
+        self.bar = new_frame(BAR_OPCODE)
+        self.halves = (new_frame(SLAB_OPCODES[0]), new_frame(SLAB_OPCODES[1]))
+        self.scan = new_frame(SCAN_OPCODE)
+
+    def set_data(self, chan_val):
+        # 16 values fill the bar frame. 32 values are slab/lightbar data, 2 LEDs per channel, the pattern bit of a
+        # channel is on if either of its LEDs is (OR of the pairs) and the voltages are split 16/16 over the halves.
+        # The voltages are converted to big-endian 16 bit in one go (wrapping like the old high/low byte masking did)
+        # and copied into place with slice assignments, no per-value work in Python.
+        voltage = np.asarray(chan_val).astype(">u2", copy=False).tobytes()
+        if len(voltage) == 4 * FRAME_CHANNELS:
+            pattern = pattern_bytes(voltage, leds_per_channel=2)
+            for half, frame in enumerate(self.halves):
+                frame[2:4] = pattern
+                frame[4:] = voltage[half * 2 * FRAME_CHANNELS:(half + 1) * 2 * FRAME_CHANNELS]
+        else:
+            self.bar[2:4] = pattern_bytes(voltage)
+            self.bar[4:] = voltage
+
+    def set_pattern(self, pattern, voltage):
+        # rpi5 style bar data, the pattern is given as 4 rows of 4 channels (MSB first) instead of from the voltages
+        self.bar[2:4] = np.packbits(np.asarray(pattern, dtype=bool).reshape(-1)).tobytes()
+        self.bar[4:] = np.asarray(voltage).astype(">u2").tobytes()
+
+    def bar_frame(self):
+        return self.bar
+
+    def slab_frames(self):
+        return self._half_frames(SLAB_OPCODES)
+
+    def lightbar_frames(self):
+        return self._half_frames(LIGHTBAR_OPCODES)
+
+    def _half_frames(self, opcodes):
+        for frame, opcode in zip(self.halves, opcodes):
+            frame[1] = opcode
+        return self.halves
+
+    def scan_frame(self, bad_chans=()):
+        # The I2C scan frame, the bad channel bytes (if any) right after the opcode then zeros
+        self.scan[2:] = bytes(bad_chans) + bytes(FRAME_SIZE - 2 - len(bad_chans))
+        return self.scan
+
+    def clear(self):
+        for frame in (self.bar, *self.halves):
+            frame[2:] = bytes(FRAME_SIZE - 2)
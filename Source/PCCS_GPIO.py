@@ -0,0 +1,95 @@
+# PCCS GPIO - The pulse path GPIO lines shared by the programs that pulse the LEDs.
+# Every program used to request Sys_Rst, OE, Pulse_En, Trigger_Send and Pulse_Send one by one at import and set them
+# one by one, a syscall per edge. PulseLines requests all of them as one bulk request (one file descriptor, one
+# ioctl sets every line at once) and the pulse sequences are compiled once into short tables of value vectors, one
+# vector per set_values call. A sequence is a list of steps, each step the lines that change together, the order of
+# the steps is the order the hardware needs (reset before the buffer is enabled, enabled before Pulse_Send rises):
+#   reset   Sys_Rst low                                        (the ICs on the reset line)
+#   arm     Sys_Rst high, OE* low, Pulse_En high               (release the reset, open the buffer and the AND switch)
+#   fire    Trigger_Send, Pulse_Send high                      (starts the one-shots, and the MilliDAQ trigger)
+#   disarm  Trigger_Send, Pulse_Send, Pulse_En low, OE* high   (the one-shots are long done by then)
+# so a pulse is 3 calls on the rise and 1 on the fall instead of 6 and 4, and the edges within a step are simultaneous.
+#
+# The vectors hold the state of every line, compiled from the state the sequence starts in (IDLE, or the end of the
+# one it follows), the trigger is compiled in as both values. gpiod is only imported when the chip is opened, and the
+# module can be swapped out (gpio), like PCCS_SPI's spi_factory. A program that doesn't drive every line (LV_Import
+# never touches Trigger_Send) requests only its own (lines), the steps are compiled for those lines only and the
+# others stay free for another process.
+
+GPIO_CHIP = "gpiochip4"
+CONSUMER = "PCCS_Pulse"
+
+# Pulse path lines, (name, offset on the chip), in the order of the value vectors
+PULSE_LINES = (("Sys_Rst", 26), ("OE", 15), ("Pulse_En", 14), ("Trigger_Send", 24), ("Pulse_Send", 23))
+LINE_NAMES = tuple(name for name, _ in PULSE_LINES)
+LINE_OFFSETS = dict(PULSE_LINES)
+
+# Value of every line between pulses, OE* is active low
+IDLE = {"Sys_Rst": 1, "OE": 1, "Pulse_En": 0, "Trigger_Send": 0, "Pulse_Send": 0}
+TRIGGER = "trigger"  # Stands for the trigger value in a step, filled in when compiled
+
+# The sequences, (start, steps), start is IDLE or the name of the sequence whose end it starts from
+SEQUENCES = {
+    "reset": (IDLE, ({"Sys_Rst": 0}, {"Sys_Rst": 1})),
+    "rise": (IDLE, ({"Sys_Rst": 0},
+                    {"Sys_Rst": 1, "OE": 0, "Pulse_En": 1},
+                    {"Trigger_Send": TRIGGER, "Pulse_Send": 1})),
+    "untrigger": ("rise", ({"Trigger_Send": 0},)),  # Trigger_Send back low with Pulse_Send still high
+    "fall": ("rise", ({"Trigger_Send": 0, "Pulse_Send": 0, "Pulse_En": 0, "OE": 1},)),
+}
+
+
+def compile_steps(steps, start, trigger=0, names=LINE_NAMES):
+    # The value vectors (of the lines in names) of steps from the state start (dict of every line), and the state after
+    # them. A step that changes nothing on those lines is dropped.
+    state = dict(start)
+    vectors = []
+    for step in steps:
+        changed = {name: trigger if value == TRIGGER else value for name, value in step.items() if name in names}
+        if all(state[name] == value for name, value in changed.items()):
+            continue
+        state.update(changed)
+        vectors.append(tuple(state[name] for name in names))
+    return tuple(vectors), state
+
+
+def compile_sequences(sequences=SEQUENCES, names=LINE_NAMES):
+    # {(name, trigger): vectors} for both trigger values
+    waveforms = {}
+    for trigger in (0, 1):
+        ends = {}
+        for name, (start, steps) in sequences.items():
+            start = ends[start] if isinstance(start, str) else start
+            waveforms[name, trigger], ends[name] = compile_steps(steps, start, trigger, names)
+    return waveforms
+
+
+class PulseLines:
+    # The pulse path lines in one bulk request, set with the compiled waveforms. gpio is the gpiod module (imported
+    # here if None) or anything with the same Chip and LINE_REQ_DIR_OUT. lines are the names of the lines requested,
+    # all of them by default.
+    def __init__(self, chip_name=GPIO_CHIP, gpio=None, consumer=CONSUMER, lines=LINE_NAMES):
+        if gpio is None:
+            import gpiod as gpio
+        unknown = set(lines) - set(LINE_NAMES)
+        if unknown:
+            raise ValueError(f"Not a pulse path line: {', '.join(sorted(unknown))}")
+        # In PULSE_LINES order, the order of the value vectors
+        self.lines = tuple(name for name in LINE_NAMES if name in lines)
+        self.chip = gpio.Chip(chip_name)
+        self.bulk = self.chip.get_lines([LINE_OFFSETS[name] for name in self.lines])
+        self.bulk.request(consumer=consumer, type=gpio.LINE_REQ_DIR_OUT,
+                          default_vals=[IDLE[name] for name in self.lines])
+        self.waveforms = compile_sequences(names=self.lines)
+        self.calls = 0  # set_values calls made, for the benchmarks
+
+    def play(self, name, trigger=0):
+        # Apply the vectors of a compiled sequence, back to back (any non zero trigger raises Trigger_Send)
+        vectors = self.waveforms[name, 1 if trigger else 0]
+        set_values = self.bulk.set_values
+        for vector in vectors:
+            set_values(vector)
+        self.calls += len(vectors)
+
+    def release(self):
+        self.bulk.release()
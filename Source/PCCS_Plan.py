@@ -0,0 +1,521 @@
+# PCCS Plan - The CSV side of the data pipeline, shared by the PCCS_Control, PCCS_Sender and LV_Import programs.
+# Instead of loading the whole campaign CSV into memory, the rows are pulled lazily through a chain of generators:
+#
+#   read_rows  ->  clean_rows  ->  split_events  ->  collapse_runs
+#
+# read_rows yields the raw csv rows one at a time, clean_rows turns the header columns into ints (held to the widths
+# of the plan record, so a streamed run and a compiled one get the same values) and cleans the channel columns into a
+# uint16 matrix with NumPy, a block of rows at a time (same rules as the old per-row list comprehension, but every
+# coerced or clamped cell is reported), and split_events packs the 192 slab channels into the 4 per-device MQTT
+# payloads. Only one block of rows is alive at a time, so memory stays flat no matter how long
+# the file is and the first event can fire right after the first block is read. Finally collapse_runs merges runs of
+# identical consecutive rows into one segment whose repeat is the total number of flashes, so a test that is thousands
+# of copies of the same row is staged once and fired as a single fast-flash burst.
+#
+# The same pipeline is used to "compile" a csv into a binary run plan (compile_plan), which is what Import_csv
+# normally runs from. The plan is a header followed by fixed-width records, one per segment:
+#
+# +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+# |  Header (48 bytes): magic "PCCSPLAN", version, record size,   |
+# |  record count, sha256 of the source csv                       |
+# +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+# |  Record (394 bytes): detector type (1), trigger (1), rate (2), |
+# |  pulse length (2), repeat count (4),                          |
+# |  192 DAC counts as big-endian uint16 (384)                    |
+# +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+#
+# The DAC counts are stored big-endian, in the exact ">48H" layout the devices expect over MQTT, so each device
+# payload is just a slice of the memory-mapped file and nothing has to be parsed while the run is going.
+# Compiled plans are cached by the sha256 of the csv content, re-running the same campaign file skips compilation.
+#
+# For the run-upload mode of PCCS_Control the plan is also cut into one slice per device (pack_plan_slices), uploaded
+# once at the start of the run. A slice holds the distinct payloads the device gets over the whole run, the index of
+# the payload for every event of the run and, for the flasher, the pulse settings of every event, zlib compressed:
+#
+#   header (19 bytes): magic "PCSL", plan id, event count, payload count, payload size, pulse table flag
+#   zlib( payloads (count x size) | index (events x >u4) | pulses (events x trigger u1, rate >u2, repeat >u4) )
+#
+# The devices keep a slice as NumPy arrays (PlanSlice) and during the run only get told which event to load.
+
+import csv
+import hashlib
+import mmap
+import os
+import struct
+import sys
+import zlib
+from collections import namedtuple
+from itertools import islice
+
+import numpy as np
+
+# Column layout of the PCCS CSV files
+DETECTOR_COLUMN = 0
+REPEAT_COLUMN = 1
+RATE_COLUMN = 2
+TRIGGER_COLUMN = 3
+LENGTH_COLUMN = 4
+FIRST_CHANNEL_COLUMN = 5
+
+# The Slab detector has 192 channels (PMT LEDs), split into 4 crates of 48
+SLAB_CHANNELS = 192
+DEVICE_CHANNELS = 48
+DEVICE_IDS = ("PCCS_Flasher", "PCCS_Sub_1", "PCCS_Sub_2", "PCCS_Sub_3")
+
+# Maximum DAC counts, slab/bar runs are limited to 4000 by the voltage setter, lightbar packs 2 bytes of info
+SLAB_MAX_COUNTS = 4000
+LIGHTBAR_MAX_COUNTS = 65535
+DETECTOR_MAX_COUNTS = {"lightbar": LIGHTBAR_MAX_COUNTS}
+
+# The cleaning stage works on blocks of rows, with each cell held as fixed width text (clean_block relies on 8)
+BLOCK_ROWS = 1024
+CELL_WIDTH = 8
+
+# Defaults used when a header column is blank or not a number
+DEFAULT_REPEAT = 1
+DEFAULT_RATE = 3
+DEFAULT_TRIGGER = 0
+DEFAULT_LENGTH = 500
+
+# Binary run plan layout, described at the top of the file
+PLAN_MAGIC = b"PCCSPLAN"
+PLAN_VERSION = 4
+PLAN_HEADER = struct.Struct(">8sHHI32s")
+RECORD_HEADER = struct.Struct(">BBHHI")
+RECORD_SIZE = RECORD_HEADER.size + SLAB_CHANNELS * 2
+PLAN_CACHE_DIR = "plan_cache"
+# Largest flash count a segment record can hold (4 byte repeat field)
+MAX_SEGMENT_REPEAT = 0xFFFFFFFF
+
+# Detector types are stored as a single byte in the plan records
+DETECTOR_CODES = {"slab": 0, "bar": 1, "lightbar": 2}
+DETECTOR_NAMES = {code: name for name, code in DETECTOR_CODES.items()}
+UNKNOWN_DETECTOR = 0xFF
+UNKNOWN_DETECTOR_NAME = "unknown"
+
+# Largest value of every numeric header column, the widths of the record fields. clean_rows clamps to these (and
+# reports it) for both the streamed and the compiled path.
+HEADER_LIMITS = (
+    (REPEAT_COLUMN, "Repeat", MAX_SEGMENT_REPEAT),
+    (RATE_COLUMN, "Rate", 0xFFFF),
+    (TRIGGER_COLUMN, "Trigger", 0xFF),
+    (LENGTH_COLUMN, "Length", 0xFFFF),
+)
+
+# One flashing event: the header columns and the 4 packed ">48H" payloads, one per device (in DEVICE_IDS order)
+SlabEvent = namedtuple("SlabEvent", ["detector_type", "repeat", "rate", "trigger", "pulse_length", "payloads"])
+
+# Per-device plan slices of the run-upload mode, described at the top of the file
+SLICE_MAGIC = b"PCSL"
+SLICE_HEADER = struct.Struct(">4sIIIHB")
+SLICE_INDEX_DTYPE = np.dtype(">u4")
+PULSE_DTYPE = np.dtype([("trigger", "u1"), ("rate", ">u2"), ("repeat", ">u4")])
+
+
+def parse_field(val, default):
+    # Header columns that are blank or not a number fall back to the default
+    val = val.strip()
+    return int(val) if val.isdigit() else default
+
+
+class CleanReport:
+    # Collects what the cleaning stage changed in the channel columns, which used to happen silently.
+    # Blank cells are normal in the campaign files (channels that are off) so they are only counted, non-numeric cells
+    # that were coerced to 0 and values that were clamped are kept with their row and column.
+    # Header columns that don't fit their plan record field (trigger, rate, length, repeat) and detector types that
+    # aren't known are kept the same way, under the column names Trigger, Rate, Length, Repeat and Detector.
+    # Rows are counted from 1 after the header row, columns use the Chan# names of the csv header.
+
+    MAX_DETAILS = 1000
+
+    def __init__(self):
+        self.rows = 0
+        self.blank = 0
+        self.coerced_total = 0
+        self.clamped_total = 0
+        self.coerced = []  # (row, column, original text)
+        self.clamped = []  # (row, column, original value, limit)
+        self.header_total = 0
+        self.headers = []  # (row, column, original value, value used)
+
+    def add_header(self, row, column, value, used):
+        self.header_total += 1
+        if len(self.headers) < self.MAX_DETAILS:
+            self.headers.append((row, column, value, used))
+
+    def add_block(self, first_row, cells, coerced, clamped, values, limits):
+        self.rows += len(cells)
+        self.coerced_total += int(coerced.sum())
+        self.clamped_total += int(clamped.sum())
+        rows, cols = np.nonzero(coerced)
+        for r, c in zip(rows[:self.MAX_DETAILS - len(self.coerced)], cols):
+            self.coerced.append((first_row + int(r) + 1, f"Chan{int(c) + 1}", cells[r][c]))
+        rows, cols = np.nonzero(clamped)
+        for r, c in zip(rows[:self.MAX_DETAILS - len(self.clamped)], cols):
+            self.clamped.append((first_row + int(r) + 1, f"Chan{int(c) + 1}", int(values[r, c]), int(limits[r])))
+
+    def clean(self):
+        return self.coerced_total == 0 and self.clamped_total == 0 and self.header_total == 0
+
+    def summary(self, details=10):
+        lines = [f"Cleaned {self.rows} rows: {self.blank} blank cells, {self.coerced_total} non-numeric cells "
+                 f"coerced to 0, {self.clamped_total} values clamped, {self.header_total} header cells changed"]
+        for row, column, value, used in self.headers[:details]:
+            lines.append(f"  row {row} {column}: {value!r} changed to {used!r}")
+        for row, column, text in self.coerced[:details]:
+            lines.append(f"  row {row} {column}: {text!r} coerced to 0")
+        for row, column, value, limit in self.clamped[:details]:
+            lines.append(f"  row {row} {column}: {value} clamped to {limit}")
+        hidden = (self.coerced_total + self.clamped_total + self.header_total - min(details, len(self.headers))
+                  - min(details, len(self.coerced)) - min(details, len(self.clamped)))
+        if hidden > 0:
+            lines.append(f"  ... and {hidden} more")
+        return "\n".join(lines)
+
+
+def clean_block(chan_rows, limits, first_row=0, report=None):
+    # Clean up a whole block of channel columns in one pass: blanks and non-digits become 0 and the DAC counts are
+    # limited per row (limits holds one max value per row). Returns an (rows x channels) uint16 matrix.
+    #
+    # A cell is accepted the same way as the old val.strip().isdigit(): one run of digits with only whitespace
+    # around it. The cells are held as fixed width unicode and looked at as their character codes, so the checks and
+    # the digit to int conversion are array operations instead of Python string calls on every cell.
+    # With CELL_WIDTH = 8 the 8 per-character flags of a cell are 8 bytes, which are read as one uint64 to answer
+    # "any character like this?" per cell without a reduction.
+    cells = np.array(chan_rows, dtype=f"U{CELL_WIDTH}")
+    codes = cells.view(np.uint32).reshape(cells.shape + (CELL_WIDTH,))
+    shape = cells.shape
+
+    # Non-ASCII cells and cells that filled the whole width (may have been cut short) are rare, those are checked
+    # one by one with the old string rules below
+    slow = ((codes > 0x7F).view(np.uint64).reshape(shape) != 0) | (codes[..., -1] != 0)
+
+    chars = codes.astype(np.uint8)
+    digits = chars - np.uint8(0x30)
+    digit = digits < 10
+    space = (chars == 0) | (chars == 0x20) | ((chars - np.uint8(0x09)) < 5)
+    has_other = (~(digit | space)).view(np.uint64).reshape(shape) != 0
+
+    # A valid number is exactly one run of digits: the run start flags then hold a single set byte, a power of two
+    run_starts = digit.copy()
+    run_starts[..., 1:] &= ~digit[..., :-1]
+    starts = run_starts.view(np.uint64).reshape(shape)
+    blank = (starts == 0) & ~has_other
+    valid = (starts != 0) & ((starts & (starts - np.uint64(1))) == 0) & ~has_other
+
+    # Whitespace is skipped, so the digits of a valid cell are accumulated left to right
+    values = np.zeros(shape, dtype=np.uint32)
+    for k in range(CELL_WIDTH):
+        values = np.where(digit[..., k], values * 10 + digits[..., k], values)
+    values[~valid] = 0
+
+    for r, c in zip(*np.nonzero(slow)):
+        text = chan_rows[r][c].strip()
+        try:
+            number = int(text) if text.isdigit() else None
+        except ValueError:
+            number = None
+        valid[r, c] = number is not None
+        blank[r, c] = text == ''
+        values[r, c] = min(number, 0xFFFFFFFF) if number is not None else 0
+
+    limits = np.asarray(limits, dtype=np.uint32)[:, None]
+    counts = np.minimum(values, limits).astype(np.uint16)
+
+    if report is not None:
+        report.blank += int(blank.sum())
+        report.add_block(first_row, chan_rows, ~valid & ~blank, values > limits, values, limits[:, 0])
+    return counts
+
+
+def clean_counts(chan_val, max_value=SLAB_MAX_COUNTS, report=None):
+    # Single row version of clean_block, returns the cleaned DAC counts as a list of ints
+    return clean_block([chan_val], [max_value], report=report)[0].tolist()
+
+
+def read_rows(csv_file):
+    # Stage 1: yield the raw csv rows one at a time, skipping the header row
+    with open(csv_file, newline='') as csvfile:
+        reader = csv.reader(csvfile)
+        next(reader, None)
+        for row in reader:
+            yield row
+
+
+def clean_header(row, row_number, report=None):
+    # The header columns of one row as (detector, repeat, rate, trigger, length). Values too big for their plan record
+    # field are clamped and a detector type the plan has no code for becomes "unknown", both reported with the row.
+    detector_type = row[DETECTOR_COLUMN].strip()
+    if detector_type not in DETECTOR_CODES:
+        if report is not None:
+            report.add_header(row_number, "Detector", detector_type, UNKNOWN_DETECTOR_NAME)
+        detector_type = UNKNOWN_DETECTOR_NAME
+    values = {
+        REPEAT_COLUMN: parse_field(row[REPEAT_COLUMN], DEFAULT_REPEAT),
+        RATE_COLUMN: parse_field(row[RATE_COLUMN], DEFAULT_RATE),
+        TRIGGER_COLUMN: parse_field(row[TRIGGER_COLUMN], DEFAULT_TRIGGER),
+        LENGTH_COLUMN: parse_field(row[LENGTH_COLUMN], DEFAULT_LENGTH),
+    }
+    for column, name, limit in HEADER_LIMITS:
+        if values[column] > limit:
+            if report is not None:
+                report.add_header(row_number, name, values[column], limit)
+            values[column] = limit
+    return (detector_type, values[REPEAT_COLUMN], values[RATE_COLUMN], values[TRIGGER_COLUMN], values[LENGTH_COLUMN])
+
+
+def clean_rows(rows, channels=SLAB_CHANNELS, report=None):
+    # Stage 2: parse the header columns and clean the channel columns. The rows are gathered into blocks of
+    # BLOCK_ROWS so the channel cleaning runs as one NumPy pass per block, memory is still bounded by the block size.
+    # Short rows are padded with blanks so every row has the same number of channels.
+    width = FIRST_CHANNEL_COLUMN + channels
+    first_row = 0
+    while True:
+        block = [row + [''] * (width - len(row)) for row in islice(rows, BLOCK_ROWS)]
+        if not block:
+            return
+        headers = [clean_header(row, first_row + r + 1, report) for r, row in enumerate(block)]
+        limits = [DETECTOR_MAX_COUNTS.get(header[0], SLAB_MAX_COUNTS) for header in headers]
+        counts = clean_block([row[FIRST_CHANNEL_COLUMN:width] for row in block], limits, first_row, report)
+        for header, row_counts in zip(headers, counts):
+            yield header + (row_counts,)
+        first_row += len(block)
+
+
+def split_events(cleaned):
+    # Stage 3: split the data for the whole detector into the 4 per-device payloads, already packed in the MQTT
+    # struct format so the publisher does not have to touch the values again.
+    step = DEVICE_CHANNELS * 2
+    for detector_type, repeat, rate, trigger, pulse_length, counts in cleaned:
+        packed = counts.astype(">u2").tobytes()
+        payloads = tuple(packed[i * step:(i + 1) * step] for i in range(len(DEVICE_IDS)))
+        yield SlabEvent(detector_type, repeat, rate, trigger, pulse_length, payloads)
+
+
+def collapse_runs(events, max_repeat=MAX_SEGMENT_REPEAT):
+    # Stage 4: run-length collapse. Consecutive events with the same settings and payloads become one segment
+    # (config, count) with the repeats summed, a segment is only cut when its count would not fit in the plan record.
+    segment = None
+    for event in events:
+        if segment is not None and event[:1] + event[2:] == segment[:1] + segment[2:] \
+                and segment.repeat + event.repeat <= max_repeat:
+            segment = segment._replace(repeat=segment.repeat + event.repeat)
+            continue
+        if segment is not None:
+            yield segment
+        segment = event
+    if segment is not None:
+        yield segment
+
+
+def iter_events(csv_file, report=None):
+    # The whole pipeline up to one event per row, every call re-opens the file so it can be used once per repeat
+    return split_events(clean_rows(read_rows(csv_file), report=report))
+
+
+def iter_segments(csv_file, report=None):
+    # Same as iter_events but with the identical consecutive rows already collapsed
+    return collapse_runs(iter_events(csv_file, report=report))
+
+
+def payload_counts(payload):
+    # Unpack device payload(s) back into their DAC counts
+    return list(struct.unpack(f">{len(payload) // 2}H", payload))
+
+
+def event_counts(event):
+    # All 192 DAC counts of an event, for the programs that drive the Picos themselves
+    return payload_counts(b"".join(event.payloads))
+
+
+def device_payloads(event):
+    # What each device is sent for an event, {device_id: payload}. The flasher's also sets the pulse length, so it
+    # starts with it as a ">H".
+    flasher_slice, *sub_slices = event.payloads
+    return dict(zip(DEVICE_IDS, [struct.pack(">H", event.pulse_length) + flasher_slice] + list(sub_slices)))
+
+
+def is_flashed(event):
+    # The events a slab run goes through, rows with a repeat of 0 are in the csv but not flashed
+    return event.detector_type == "slab" and event.repeat > 0
+
+
+def csv_digest(csv_file):
+    # sha256 of the csv content, read in chunks, used as the plan cache key
+    digest = hashlib.sha256()
+    with open(csv_file, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 16), b""):
+            digest.update(chunk)
+    return digest.digest()
+
+
+def pack_record(event):
+    # Turn one event into its fixed-width plan record, clean_header already held the header values to the field widths
+    return RECORD_HEADER.pack(
+        DETECTOR_CODES.get(event.detector_type, UNKNOWN_DETECTOR),
+        event.trigger,
+        event.rate,
+        event.pulse_length,
+        event.repeat,
+    ) + b"".join(event.payloads)
+
+
+def compile_plan(csv_file, cache_dir=PLAN_CACHE_DIR, report=None):
+    # Compile the csv into a binary run plan and return its path. If a plan for the same csv content is already in
+    # the cache it is reused as is (and report stays empty, it was reported when the plan was compiled).
+    digest = csv_digest(csv_file)
+    plan_path = os.path.join(cache_dir, digest.hex() + ".plan")
+    if os.path.exists(plan_path):
+        try:
+            RunPlan(plan_path, digest).close()
+            return plan_path
+        except ValueError as e:
+            print(f"Cached plan {plan_path} is not usable ({e}), recompiling")
+
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = plan_path + ".tmp"
+    count = 0
+    with open(tmp_path, "wb") as f:
+        # The header is written last, once the number of records is known
+        f.write(bytes(PLAN_HEADER.size))
+        report = report if report is not None else CleanReport()
+        for segment in iter_segments(csv_file, report=report):
+            f.write(pack_record(segment))
+            count += 1
+        f.seek(0)
+        f.write(PLAN_HEADER.pack(PLAN_MAGIC, PLAN_VERSION, RECORD_SIZE, count, digest))
+    # Only a complete plan ever gets the real name, an interrupted compile leaves just the .tmp file
+    os.replace(tmp_path, plan_path)
+    print(f"Compiled {csv_file} into {plan_path} ({count} segments)")
+    print(report.summary())
+    return plan_path
+
+
+class RunPlan:
+    # A compiled run plan, memory-mapped read only. Iterating over it yields the same SlabEvents as iter_events, but
+    # the payloads are sliced straight out of the mapping, so it can be walked any number of times (one per repeat of
+    # the csv) without touching the csv again.
+
+    def __init__(self, plan_path, expected_digest=None):
+        self.plan_path = plan_path
+        self._file = open(plan_path, "rb")
+        try:
+            self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self._file.close()
+            raise ValueError("empty plan file")
+
+        if len(self._mm) < PLAN_HEADER.size:
+            self.close()
+            raise ValueError("truncated plan header")
+        magic, version, record_size, count, digest = PLAN_HEADER.unpack_from(self._mm, 0)
+        if magic != PLAN_MAGIC or version != PLAN_VERSION or record_size != RECORD_SIZE:
+            self.close()
+            raise ValueError("not a PCCS plan or wrong plan version")
+        if len(self._mm) != PLAN_HEADER.size + count * RECORD_SIZE:
+            self.close()
+            raise ValueError("plan size does not match its record count")
+        if expected_digest is not None and digest != expected_digest:
+            self.close()
+            raise ValueError("plan was compiled from a different csv")
+
+        self.count = count
+        self.digest = digest
+
+    def __len__(self):
+        return self.count
+
+    def event(self, index):
+        # Decode the record at index, the header is 5 fixed-width ints and the payloads are plain slices
+        offset = PLAN_HEADER.size + index * RECORD_SIZE
+        code, trigger, rate, pulse_length, repeat = RECORD_HEADER.unpack_from(self._mm, offset)
+        offset += RECORD_HEADER.size
+        step = DEVICE_CHANNELS * 2
+        payloads = tuple(self._mm[offset + i * step:offset + (i + 1) * step] for i in range(len(DEVICE_IDS)))
+        return SlabEvent(DETECTOR_NAMES.get(code, UNKNOWN_DETECTOR_NAME), repeat, rate, trigger, pulse_length, payloads)
+
+    def __iter__(self):
+        for index in range(self.count):
+            yield self.event(index)
+
+    def close(self):
+        if getattr(self, "_mm", None) is not None:
+            self._mm.close()
+            self._mm = None
+        self._file.close()
+
+
+def pack_plan_slices(events):
+    # Cut the flashed events of a run into the compressed slice of every device, returns (plan id, number of events,
+    # {device_id: slice}). The plan id is a crc32 of the slices, the same run gives the same id.
+    payload_ids = {device_id: {} for device_id in DEVICE_IDS}
+    index = {device_id: [] for device_id in DEVICE_IDS}
+    pulses = []
+    for event in filter(is_flashed, events):
+        for device_id, payload in device_payloads(event).items():
+            # Distinct payloads are kept in the order they first come up
+            index[device_id].append(payload_ids[device_id].setdefault(bytes(payload), len(payload_ids[device_id])))
+        pulses.append((event.trigger, event.rate, event.repeat))
+
+    count = len(pulses)
+    bodies = {}
+    for device_id in DEVICE_IDS:
+        payloads = list(payload_ids[device_id])
+        body = b"".join(payloads) + np.array(index[device_id], dtype=SLICE_INDEX_DTYPE).tobytes()
+        if device_id == DEVICE_IDS[0]:
+            body += np.array(pulses, dtype=PULSE_DTYPE).tobytes()
+        size = len(payloads[0]) if payloads else 0
+        bodies[device_id] = (len(payloads), size, device_id == DEVICE_IDS[0], zlib.compress(body, 9))
+
+    plan_id = 0
+    for _, _, _, body in bodies.values():
+        plan_id = zlib.crc32(body, plan_id)
+    slices = {device_id: SLICE_HEADER.pack(SLICE_MAGIC, plan_id, count, payloads, size, has_pulses) + body
+              for device_id, (payloads, size, has_pulses, body) in bodies.items()}
+    return plan_id, count, slices
+
+
+class PlanSlice:
+    # One device's slice of an uploaded plan, unpacked into arrays. payload(position) is the data for the event at
+    # position, the same bytes a data message would carry (without the event id).
+
+    def __init__(self, data):
+        if len(data) < SLICE_HEADER.size:
+            raise ValueError("truncated plan slice")
+        magic, self.plan_id, self.count, payloads, self.size, has_pulses = SLICE_HEADER.unpack_from(data)
+        if magic != SLICE_MAGIC:
+            raise ValueError("not a PCCS plan slice")
+        try:
+            body = zlib.decompress(data[SLICE_HEADER.size:])
+        except zlib.error as e:
+            raise ValueError(f"corrupt plan slice ({e})")
+        index_start = payloads * self.size
+        pulses_start = index_start + self.count * SLICE_INDEX_DTYPE.itemsize
+        expected = pulses_start + (self.count * PULSE_DTYPE.itemsize if has_pulses else 0)
+        if len(body) != expected:
+            raise ValueError("plan slice size does not match its counts")
+        self.payloads = np.frombuffer(body, dtype=np.uint8, count=index_start).reshape(payloads, self.size)
+        self.index = np.frombuffer(body, dtype=SLICE_INDEX_DTYPE, count=self.count, offset=index_start)
+        self.pulses = np.frombuffer(body, dtype=PULSE_DTYPE, offset=pulses_start) if has_pulses else None
+
+    def __len__(self):
+        return self.count
+
+    def payload(self, position):
+        return self.payloads[self.index[position]].tobytes()
+
+    def pulse(self, position):
+        # (trigger, rate, repeat) of the event at position, flasher only
+        trigger, rate, repeat = self.pulses[position].item()
+        return trigger, rate, repeat
+
+
+if __name__ == '__main__':
+    # Compile step on its own, e.g. to prepare the plans for a campaign before the run
+    if len(sys.argv) < 2:
+        print("Usage: python PCCS_Plan.py <file_path> [<file_path> ...]\n")
+        sys.exit(1)
+    for path in sys.argv[1:]:
+        plan = RunPlan(compile_plan(path))
+        print(f"{path}: {len(plan)} segments, {sum(segment.repeat for segment in plan)} flashes -> {plan.plan_path}")
+        plan.close()
@@ -0,0 +1,92 @@
+# PCCS Pulse - The timing of the LED pulse bursts (fast flashes) used for calibration, e.g. 300 Hz for the DRS.
+# The old loop slept 1 / rate after the GPIO calls and prints of every pulse, so every pulse came late by however long
+# those took and the burst ran well below the rate asked for. Here the edges are on a fixed grid of absolute deadlines
+# from the start of the burst (pulse k rises at start + k / rate), a pulse that comes late doesn't push the ones after
+# it back. The wait for a deadline sleeps until SPIN_TIME before it (the scheduler can wake up late by about that much)
+# and spins on the clock for the rest. Nothing is printed during the burst, run_burst returns a BurstReport with the
+# rate reached, the jitter (how late the rising edges were) and the deadlines missed, for after it. A burst can be
+# stopped with an Event (stop), the waits between the edges are waits on it, so it ends within a pulse period.
+#
+# The GPIO work itself is given as 2 functions, rise (everything up to Pulse_Send going high) and fall, so the same
+# scheduler works for every program that pulses. fire_pulse and fire_burst are the single pulse and the burst on the
+# PCCS_GPIO pulse lines, what send_pulse / send_fastpulse of the programs run (and PCCS_Bench pulse times).
+
+import time
+from collections import namedtuple
+
+import numpy as np
+
+SPIN_TIME = 0.002  # The last part of every wait is spun instead of slept
+# Fraction of the period Pulse_Send stays high. The whole period like the old send_fastpulse, which drove the one-shots
+# that way: the fall is at the next deadline, right before the rise of the next pulse.
+DUTY = 1.0
+PULSE_WIDTH = 0.1  # Pulse_Send high for a single pulse
+MISS_TOLERANCE = 0.1  # A rising edge later than this fraction of the period missed its deadline
+
+BurstReport = namedtuple("BurstReport", ["count", "rate_hz", "achieved_hz", "jitter_us", "missed", "elapsed",
+                                         "aborted"])
+
+
+def wait_until(deadline, clock=time.perf_counter, sleep=time.sleep, spin=SPIN_TIME, stop=None):
+    # Sleep until spin before deadline, then spin on the clock until it is reached. Returns early if stop gets set.
+    remaining = deadline - clock()
+    if remaining > spin:
+        if stop is None:
+            sleep(remaining - spin)
+        elif stop.wait(remaining - spin):
+            return
+    while clock() < deadline:
+        pass
+
+
+def run_burst(rise, fall, rate_hz, count, duty=DUTY, clock=time.perf_counter, sleep=time.sleep, stop=None):
+    # count pulses at rate_hz, rise() at every deadline and fall() duty of a period later. Returns a BurstReport.
+    # Once the Event stop is set no more pulses are started (a pulse that is high is still brought down), the report
+    # only covers the ones fired.
+    period = 1 / rate_hz
+    lateness = np.zeros(count)  # Allocated up front, the loop only writes into it
+    rises = np.zeros(count)
+    begin = clock()
+    start = begin + period  # The first pulse a period from now, leaves time to set up
+    fired = count
+    for k in range(count):
+        deadline = start + k * period
+        wait_until(deadline, clock, sleep, stop=stop)
+        if stop is not None and stop.is_set():
+            fired = k
+            break
+        now = clock()
+        rise()
+        rises[k] = now
+        lateness[k] = now - deadline
+        wait_until(deadline + duty * period, clock, sleep, stop=stop)
+        fall()
+    return burst_report(rises[:fired], lateness[:fired], rate_hz, clock() - begin, fired < count)
+
+
+def fire_pulse(lines, trigger, width=PULSE_WIDTH, sleep=time.sleep):
+    # One pulse on the PulseLines lines, Pulse_Send high for width
+    lines.play("rise", trigger)
+    sleep(width)
+    lines.play("fall", trigger)
+
+
+def fire_burst(lines, trigger, rate_hz, count, clock=time.perf_counter, sleep=time.sleep, stop=None):
+    # count pulses at rate_hz on the PulseLines lines, returns the BurstReport
+    return run_burst(lambda: lines.play("rise", trigger), lambda: lines.play("fall", trigger), rate_hz, count,
+                     clock=clock, sleep=sleep, stop=stop)
+
+
+def burst_report(rises, lateness, rate_hz, elapsed, aborted=False):
+    count = len(rises)
+    achieved = (count - 1) / (rises[-1] - rises[0]) if count > 1 and rises[-1] > rises[0] else 0.0
+    jitter = {f"p{p}": round(float(np.percentile(lateness, p)) * 1e6, 1) for p in (50, 90, 99)} if count else {}
+    jitter["max"] = round(float(lateness.max()) * 1e6, 1) if count else 0.0
+    missed = int(np.count_nonzero(lateness > MISS_TOLERANCE / rate_hz))
+    return BurstReport(count, rate_hz, achieved, jitter, missed, elapsed, aborted)
+
+
+def format_report(report):
+    return (f"{report.count} pulses at {report.achieved_hz:.2f} Hz ({report.rate_hz} Hz asked) in "
+            f"{report.elapsed:.3f} s, rising edge late by {report.jitter_us} us, "
+            f"{report.missed} deadlines missed" + (", ABORTED" if report.aborted else ""))
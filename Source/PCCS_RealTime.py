@@ -0,0 +1,186 @@
+# PCCS RealTime - The pulse engine, a thread of its own for the pulses when the Receiver runs with --realtime.
+# Without it the pulses run on paho's network thread, at normal priority, next to the heartbeat, the prints and the
+# MQTT traffic, and a burst is only as even as that thread gets scheduled. The engine thread is set up once, when it
+# starts, and then only waits for pulse commands:
+#   - pinned to one CPU (os.sched_setaffinity), the thread that starts it (and the threads started after, the
+#     heartbeat, paho's) is moved off that CPU
+#   - SCHED_FIFO at a fixed priority if the process is allowed to (root or CAP_SYS_NICE), else it stays at normal
+#     priority and says so
+#   - memory locked (mlockall) so no page of it is swapped out or faulted in the middle of a burst. MCL_FUTURE only if
+#     RLIMIT_MEMLOCK is unlimited, with a limit the allocations after it would fail once it was reached. A warm-up
+#     burst on no-op GPIO runs the scheduler code once before the first real pulse.
+#   - the Python switch interval is lowered, a thread holding the GIL gives it up to the engine after that long
+#     instead of 5 ms
+# Commands go in through a deque and an Event wakes the engine up. The deque is only touched under a lock that is held
+# just to add, take or drop commands (never during a pulse), the MQTT thread never waits on a burst. abort() drops the
+# queued commands (their done is called with None, like a failed pulse) and stops a running burst within a pulse
+# period (see PCCS_Pulse.run_burst). What was applied and the last burst are
+# kept in status() for the heartbeat.
+
+import ctypes
+import os
+import resource
+import sys
+import threading
+from collections import deque, namedtuple
+
+from PCCS_Pulse import fire_pulse, fire_burst, run_burst, format_report
+
+RT_PRIORITY = 80  # SCHED_FIFO priority, below the kernel's own threads (99 / 50 for the IRQ threads on PREEMPT_RT)
+RT_SWITCH_INTERVAL = 0.0005  # sys.setswitchinterval while the engine runs
+WARMUP_PULSES = 20
+MCL_CURRENT = 1
+MCL_FUTURE = 2
+
+PulseCommand = namedtuple("PulseCommand", ["kind", "trigger", "rate_hz", "count", "done"])
+
+
+def lock_memory():
+    # mlockall, returns what was locked ("current+future", "current") or why nothing was
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        soft, _ = resource.getrlimit(resource.RLIMIT_MEMLOCK)
+        flags = MCL_CURRENT | MCL_FUTURE if soft == resource.RLIM_INFINITY or os.geteuid() == 0 else MCL_CURRENT
+        if libc.mlockall(flags) != 0:
+            return f"not locked ({os.strerror(ctypes.get_errno())})"
+        return "current+future" if flags & MCL_FUTURE else "current"
+    except (OSError, AttributeError) as e:
+        return f"not locked ({e})"
+
+
+def make_realtime(cpu=None, priority=RT_PRIORITY):
+    # Pin the calling thread to cpu and put it on SCHED_FIFO, returns what was applied. Anything not allowed is left
+    # as it was.
+    applied = {"cpu": None, "policy": "normal"}
+    if cpu is not None:
+        try:
+            os.sched_setaffinity(0, {cpu})
+            applied["cpu"] = cpu
+        except (OSError, ValueError, AttributeError) as e:
+            applied["cpu"] = f"not pinned ({e})"
+    try:
+        os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))
+        applied["policy"] = f"SCHED_FIFO {priority}"
+    except (OSError, AttributeError) as e:
+        applied["policy"] = f"normal ({e})"
+    return applied
+
+
+class PulseEngine:
+    # The pulse thread. lines are the PCCS_GPIO PulseLines, cpu the CPU to pin it to (None leaves it unpinned).
+    def __init__(self, lines, cpu=None, priority=RT_PRIORITY, announce=print):
+        self.lines = lines
+        self.cpu = cpu
+        self.priority = priority
+        self.announce = announce
+        self.commands = deque()
+        self.wake = threading.Event()
+        # Set by abort(), cleared when the engine takes the next command. Taking a command and clearing stop happen
+        # under lock, the same lock abort() drops the queue under, so a stop always belongs to the burst that was
+        # running (or taken) when abort() was called and never to one queued after it.
+        self.stop = threading.Event()
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+        self.applied = {}
+        self.last_report = None
+        self.pulses = 0
+        self.thread = None
+
+    def start(self):
+        # Call before the other threads are started, they inherit the CPUs left to this one
+        self.applied["memory"] = lock_memory()
+        if self.cpu is not None:
+            others = os.sched_getaffinity(0) - {self.cpu}
+            if others:
+                os.sched_setaffinity(0, others)
+        sys.setswitchinterval(RT_SWITCH_INTERVAL)
+        self.thread = threading.Thread(target=self._run, name="PCCS_Pulse", daemon=True)
+        self.thread.start()
+        self.ready.wait()
+        self.announce(f"Pulse engine running: {self.applied}")
+        return self
+
+    def single(self, trigger, done=None):
+        self._put(PulseCommand("single", trigger, None, 1, done))
+
+    def fast(self, trigger, rate_hz, count, done=None):
+        # done(report) is called on the engine thread once the burst is over (done(True) for a single pulse, None if
+        # the pulse failed)
+        self._put(PulseCommand("fast", trigger, rate_hz, count, done))
+
+    def abort(self):
+        # Drop what is queued and stop the burst that is running, returns how many commands were dropped. The done of
+        # every dropped command is called with None (outside the lock), whoever waits on it must not wait forever.
+        with self.lock:
+            dropped = list(self.commands)
+            self.commands.clear()
+            self.stop.set()
+        self.wake.set()
+        for command in dropped:
+            try:
+                if command.done is not None:
+                    command.done(None)
+            except Exception as e:
+                self.announce(f"Pulse engine error dropping {command.kind}: {e}")
+        return len(dropped)
+
+    def _put(self, command):
+        with self.lock:
+            self.commands.append(command)
+        self.wake.set()
+
+    def _take(self):
+        # The next command, or None if there is none. A stop left from an abort is over once a command is taken,
+        # everything queued before the abort was dropped with it.
+        with self.lock:
+            if not self.commands:
+                return None
+            self.stop.clear()
+            return self.commands.popleft()
+
+    def _run(self):
+        self.applied.update(make_realtime(self.cpu, self.priority))
+        # Run the scheduler once on no-op GPIO so its code and buffers are there before the first real burst
+        run_burst(lambda: None, lambda: None, 1000, WARMUP_PULSES)
+        self.ready.set()
+        while True:
+            self.wake.wait()
+            self.wake.clear()
+            while True:
+                command = self._take()
+                if command is None:
+                    break
+                report = None
+                try:
+                    report = self._fire(command)
+                except Exception as e:
+                    self.announce(f"Pulse engine error on {command.kind}: {e}")
+                # done is called either way (with None if the pulse failed), something may be waiting on it
+                try:
+                    if command.done is not None:
+                        command.done(report)
+                except Exception as e:
+                    self.announce(f"Pulse engine error after {command.kind}: {e}")
+
+    def _fire(self, command):
+        if command.kind == "single":
+            fire_pulse(self.lines, command.trigger)
+            self.pulses += 1
+            return True
+        report = fire_burst(self.lines, command.trigger, command.rate_hz, command.count, stop=self.stop)
+        self.pulses += report.count
+        self.last_report = report
+        self.announce(f"Fast Flash Over, {format_report(report)}")
+        return report
+
+    def status(self):
+        # JSON friendly state, for the heartbeat
+        report = self.last_report
+        return {
+            **{key: str(value) for key, value in self.applied.items()},
+            "queued": len(self.commands),
+            "pulses": self.pulses,
+            "last_burst": None if report is None else {
+                "count": report.count, "achieved_hz": round(report.achieved_hz, 3), "jitter_us": report.jitter_us,
+                "missed": report.missed},
+        }
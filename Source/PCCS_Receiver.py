@@ -11,20 +11,46 @@
 import paho.mqtt.client as mqtt
 import struct
 import time
-import spidev
-import gpiod
 import smbus
 import json
 import threading
 import traceback
 import argparse
 import logging
+import numpy as np
+from collections import Counter
+from PCCS_Frame import FrameEncoder, probe_frame, echo_matches
+from PCCS_Return import ReturnHistory
+from PCCS_Pulse import fire_pulse, fire_burst, format_report, PULSE_WIDTH
+from PCCS_GPIO import PulseLines
+from PCCS_RealTime import PulseEngine, RT_PRIORITY
+from PCCS_Work import WorkQueue
+from PCCS_Plan import PlanSlice, DEVICE_IDS
+from PCCS_SPI import (SpiTransport, parse_speeds, load_profile, save_profile, tuned_speed, resync, ReadyPoll,
+                      run_interleaved, SettleStats, TUNE_SPEEDS, DEFAULT_SPEED_HZ, READY_TIMEOUT, SCAN_TIMEOUT,
+                      PROBE_SETTLE)
 
 HEARTBEAT_INTERVAL = 15  # seconds
+PULSE_WAIT_MARGIN = 5  # seconds, on top of how long a pulse / burst should take, before the worker stops waiting for it
+TUNE_PROBES = 20  # Probe frames sent at every clock while tuning
 
 # Command-line argument for the receiver's ID
 parser = argparse.ArgumentParser(description="Start PCCS Receiver with a specific ID")
 parser.add_argument("--id", required=True, help="ID of this receiver (e.g., PCCS_Flasher, PCCS_Sub_1)")
+parser.add_argument("--spi-hz", nargs="+", default=[],
+                    help="SPI clock in Hz, one value for all blade pairs or one per chip select "
+                         "(default: this host's tuned profile, else 50000)")
+parser.add_argument("--tune-spi", action="store_true",
+                    help="Find the fastest SPI clock each blade pair stays in sync at and save it to the host profile")
+parser.add_argument("--poll-settle", action="store_true",
+                    help="Poll the Picos after every frame until they are done instead of sleeping a fixed time "
+                         "(PCCS_SPI.wait_ready, not yet checked on real Picos)")
+parser.add_argument("--realtime", action="store_true",
+                    help="Fire the pulses from a thread of their own, pinned to --pulse-cpu at SCHED_FIFO priority if "
+                         "allowed, with the memory locked (see PCCS_RealTime)")
+parser.add_argument("--pulse-cpu", type=int, default=3, help="CPU the pulse thread runs on with --realtime (default 3)")
+parser.add_argument("--pulse-priority", type=int, default=RT_PRIORITY,
+                    help=f"SCHED_FIFO priority of the pulse thread with --realtime (default {RT_PRIORITY})")
 args = parser.parse_args()
 
 PI_ID = args.id
@@ -48,24 +74,34 @@ TOPIC_STATUS = f"pccs/status/{PI_ID}"
 TOPIC_ERROR = f"pccs/error/{PI_ID}"
 TOPIC_PULSE = f"pccs/pulse/{PI_ID}"
 TOPIC_PREP = f"pccs/prep/{PI_ID}"
-
-
-chip = gpiod.Chip('gpiochip4')
-
-Pulse_En = chip.get_line(14)
-Pulse_En.request(consumer="Pulse_En", type=gpiod.LINE_REQ_DIR_OUT)
-
-Pulse_Send = chip.get_line(23)
-Pulse_Send.request(consumer="Pulse_Send", type=gpiod.LINE_REQ_DIR_OUT)
-
-Sys_Rst = chip.get_line(26)
-Sys_Rst.request(consumer="Sys_Rst", type=gpiod.LINE_REQ_DIR_OUT)
-
-OE = chip.get_line(15)
-OE.request(consumer="OE", type=gpiod.LINE_REQ_DIR_OUT)
-
-Trigger_Send = chip.get_line(24)
-Trigger_Send.request(consumer="Trigger_Send", type=gpiod.LINE_REQ_DIR_OUT)
+TOPIC_ABORT = "pccs/abort"  # To every receiver, stops the burst that is running and drops the queued pulses
+TOPIC_COMMIT = "pccs/commit"  # To every receiver, the event id whose staged data goes onto the Picos now
+TOPIC_PLAN = f"pccs/plan/{PI_ID}"  # Run-upload mode, this device's slice of the whole plan
+TOPIC_GO = "pccs/go"  # Run-upload mode, the event of the plan to stage
+TOPIC_FIRE = f"pccs/fire/{PI_ID}"  # Run-upload mode, fire an event with the pulse settings of the plan
+
+# The controller numbers every event, the id is in front of the data payload and in the pulse message and is sent back
+# with ready_for_flash, pulse_done and flash_done. The data is only staged (decoded and encoded into frames), it goes
+# onto the Picos when the commit with its id comes, so the next event loads while the current one flashes. A data or
+# pulse message older than the newest one already taken is dropped and counted (newest_event is reset by the SYNC of a
+# restarted controller, which starts over from 1).
+EVENT_HEADER = struct.Struct(">I")
+newest_event = {}
+stale_messages = Counter()
+
+# Run-upload mode (see PCCS_Control). With a plan uploaded the data and the pulse settings of every event are already
+# here (run_plan, a PCCS_Plan.PlanSlice), the controller only sends GO (event id, position in the plan, bit mask of the
+# devices that stage it) and FIRE (event id, position), and the answers go back as ACK structs (status code, event id)
+# on TOPIC_ACK instead of JSON. Cleared by a SYNC, a new controller uploads its own plan.
+GO = struct.Struct(">IIB")
+FIRE = struct.Struct(">II")
+ACK = struct.Struct(">BI")
+ACK_CODES = {"ready_for_flash": 1, "pulse_done": 2, "flash_done": 3}
+DEVICE_BIT = 1 << DEVICE_IDS.index(PI_ID) if PI_ID in DEVICE_IDS else 0
+run_plan = None
+
+
+pulse_lines = PulseLines()
 
 bus = smbus.SMBus(1)
 pot_addr = 0x2c
@@ -88,46 +124,20 @@ def send_pulse(trigger):
     # Trigger_Send is the optional triggering of the MilliDAQ - Function
     # Pulse_Send is the signal that starts the one-shots, creating the pulse
 
-    Sys_Rst.set_value(0)
-    Sys_Rst.set_value(1)
+    # The lines are set in bulk from the compiled waveforms, a step per call (see PCCS_GPIO and PCCS_Pulse)
 
-    OE.set_value(0)
-    Pulse_En.set_value(1)
     print("Pulse  Allowed")
-    Trigger_Send.set_value(trigger)
-    Pulse_Send.set_value(1)
-
-    time.sleep(.1)
-
-    Trigger_Send.set_value(0)
-    Pulse_Send.set_value(0)
-    Pulse_En.set_value(0)
-    OE.set_value(1)
+    fire_pulse(pulse_lines, trigger)
     print("Pulse No longer allowed")
 
 
-def send_fastpulse(trigger, flashing_hz=3, number_of_pulses=10):
-    # Same as the regular pulse with a different time.sleep, can become a function
-    for i in range(0,number_of_pulses):
-        Sys_Rst.set_value(0)
-        Sys_Rst.set_value(1)
-
-        OE.set_value(0)
-        Pulse_En.set_value(1)
-        print("Pulse  Allowed")
-
-        Trigger_Send.set_value(trigger)
-        Pulse_Send.set_value(1)
-        time.sleep(1 / flashing_hz)  # 300Hz for DRS, ~ 3 for triggered DAQ
-
-        Trigger_Send.set_value(0)
-        Pulse_Send.set_value(0)
-
-        Pulse_En.set_value(0)
-        OE.set_value(1)
-        print("Pulse No longer allowed")
-
-    print("Fast Flash Over")
+def send_fastpulse(trigger, flashing_hz=3, number_of_pulses=10, stop=None):
+    # The regular pulse number_of_pulses times at flashing_hz (300Hz for DRS, ~ 3 for triggered DAQ). The pulses are
+    # on absolute deadlines (see PCCS_Pulse) so the rate doesn't drift, nothing is printed until the burst is over.
+    # Setting the Event stop ends the burst within a pulse period.
+    report = fire_burst(pulse_lines, trigger, flashing_hz, number_of_pulses, stop=stop)
+    print(f"Fast Flash Over, {format_report(report)}")
+    return report
 def set_length(length):
     # Set the length of the LED pulse.
 
@@ -185,100 +195,69 @@ def set_length(length):
 # TODO 0xF0 - Force Pico Restart
 
 class DetectorLayer:
-    def __init__(self, cs_id, detector_spi):
-        self.data_array = bytearray()
-        self.data_array2 = bytearray()  # New for slab, need 2 frames of data since we have 2*16 pot vals to account for
+    def __init__(self, cs_id, detector_spi, poll_ready=False):
+        # The frames are built into preallocated buffers by the shared encoder (see PCCS_Frame), the slab needs 2
+        # frames of data since we have 2*16 pot vals to account for. The staging encoder holds the frames of the next
+        # event, encoded while the current one flashes, commit() swaps the two.
+        self.encoder = FrameEncoder()
+        self.staging = FrameEncoder()
 
         # The "previous array" will be used to ensure data security and fix desync,
         # The picos will return the first so many values received, these will be compared to the ones here
         self.previous_array = ()
         self.pico_return = None
+        # How many bytes behind the frames the Pico's echo runs, measured by the last resync (see PCCS_SPI.resync)
+        self.echo_shift = 0
+
+        # Shadow copy of the last frame of each opcode that went to the Pico without a desync, keyed by the opcode
+        # byte. A frame that is byte for byte the same as its shadow is already on the Pico and is not sent again.
+        self.shadow = {}
+        self.desync_count = 0
+
+        # With poll_ready (--poll-settle) the Pico is polled with status frames after a frame until it is done with it
+        # instead of sleeping a fixed time (see PCCS_SPI.wait_ready), the settle times it took are kept per opcode.
+        # It stays opt-in until the polling has been checked on real Picos, the fixed sleeps are the default. The
+        # sending is done by tasks (generators) that yield while the Pico is busy, so the Detector can interleave the
+        # blade pairs.
+        self.poll_ready = poll_ready
+        self.settle_stats = SettleStats()
+        self.status_seq = 0
+
+        # Every return decoded (sync state, echo, the channels whose base write failed, see PCCS_Return) and kept in a
+        # ring buffer for the heartbeat
+        self.history = ReturnHistory()
 
         self.spi = detector_spi
         self.cs = cs_id
 
-    def setByteData(self, bool_data):
-
-        # print(bool_data)
-
-        pattern_bytes = bytearray()
-
-        # print(pattern_bytes)
-
-        if len(bool_data) == 32:
-            slab_bool = []
-            print("Slab run bool data raw", bool_data)
-            for i in range(0, len(bool_data), 2):
-                # Perform OR operation on each pair and append to the result
-                slab_bool.append((1 if bool_data[i] | bool_data[i + 1] else 0))
-            print("Slab run bool data appended: ", slab_bool)
-            bool_data = slab_bool
-
-        # Construct the first byte
-        byte1 = 0
-        for i in range(8):
-            if bool_data[i]:
-                byte1 |= (1 << (7 - i))  # Set the bit at position (7 - i) if the boolean value is True
-
-        # Construct the second byte
-        byte2 = 0
-        for i in range(8, 16):
-            if bool_data[i]:
-                byte2 |= (1 << (15 - i))  # Set the bit at position (15 - i) if the boolean value is True
-    
-        print(byte1)
-        print(byte2)
-        pattern_bytes.append(byte1)
-        pattern_bytes.append(byte2)
-
-        self.data_array.extend(pattern_bytes)
-        self.data_array2.extend(pattern_bytes)
-        print(self.data_array)
-        print(self.data_array2)
-
-    def setVoltage(self, voltage):
-        voltage_bytes = bytearray()
-
-        for value in voltage:
-            value = int(value)  # Convert value to integer
-            voltage_bytes.append((value >> 8) & 0xFF)  # High byte
-            voltage_bytes.append(value & 0xFF)  # Low byte
-
-        print(f"Voltage bytes length: {len(voltage_bytes)}")
-        print(f"Voltage bytes content: {voltage_bytes}")
-
-        if len(voltage) == 32:
-            self.data_array.extend(voltage_bytes[:32])  # First 32 bytes
-            self.data_array2.extend(voltage_bytes[32:64])  # Next 32 bytes
-        else:
-            self.data_array.extend(voltage_bytes)
-
-        print(self.data_array)
-        print(self.data_array2)
+    def force_refresh(self):
+        # Forget what the Pico holds, the next frames are all sent. Needed whenever the Pico state is not what the
+        # shadow says anymore, a desync (the Pico zeros everything), a reset or a different kind of frame.
+        self.shadow.clear()
 
     def set_data(self, chan_val):
-        print("Chan Val in Set Data", chan_val)
-        bool_data = [(val != 0 and val != '') for val in chan_val]  # lets pulse go to non zero channels
-        print("Bool Data in Set Data", bool_data)
-        voltage_data = chan_val
-        self.setByteData(bool_data)
-        self.setVoltage(voltage_data)
+        # Pattern bytes (non zero channels let the pulse through) and voltages, written into the frame buffers
+        # Debug
+        # print("Chan Val in Set Data", chan_val)
+        self.encoder.set_data(chan_val)
 
-    def send_data(self):
-        # Enable SPI
-        self.spi.open(0, self.cs)
-        self.spi.max_speed_hz = 50 * 1000
-        self.spi.mode = 0
+    def stage_data(self, chan_val):
+        # Like set_data, into the staging encoder, nothing is sent
+        self.staging.set_data(chan_val)
+
+    def commit(self):
+        # The staged frames become the ones slab_task sends (the old ones were cleared after they were sent)
+        self.encoder, self.staging = self.staging, self.encoder
 
+    def send_data(self):
         # print(data)
         # for byte in data:
-        #     self.spi.xfer3([byte])
-        opcode_data = bytearray()
-        opcode_data.extend([0xff, 0xff])
-        opcode_data.extend(self.data_array)
-        self.pico_return = self.spi.xfer3(opcode_data)
-        self.spi.close()
+        #     self.spi.transfer(self.cs, [byte])
+        opcode_data = self.encoder.bar_frame()
+        self.pico_return = self.spi.transfer(self.cs, opcode_data)
 
+        # A bar frame overwrites the slab settings on the Pico
+        self.force_refresh()
         self.verification(opcode_data)
 
         self.clear()
@@ -288,177 +267,305 @@ class DetectorLayer:
 
         # This function does some checks on the Pico's returned data
         # It and also can detect if a pico is actually connected and if it is desynced.
-        # TODO Extract new error Pico Codes and Base infomation from the remaining pico return values
-        #  Use these in the MQTT Server
+        # The whole return (sync state, echo, the Pico's status with the failing channels and bases found) is decoded
+        # into the history (see PCCS_Return), summarised in the heartbeat
 
         # Debug
         # print(self.pico_return)
         # print(self.previous_array)
 
+        # Returns True when the frame can be trusted to be on the Pico (used for the shadow frames), False otherwise
+
+        self.history.add(self.pico_return, self.previous_array, self.echo_shift, new_previous[1])
+
         if (sum(self.pico_return) == 0):
             # If the return is all zeros, either the Pico is dead or there is none connected
             print("No Pico in this")
             self.previous_array = tuple(new_previous)
-            return
+            return False
         elif (self.pico_return[4] == [255] or self.previous_array == ()):
             # The defult value on startup from the Pico, tells us something is connected
             print("initial loops")
             self.previous_array = tuple(new_previous)
-            return
-        elif (self.pico_return[0:3] == self.previous_array[0:3]):
+            return True
+        elif (self.pico_return[self.echo_shift:self.echo_shift + 3] == self.previous_array[0:3]):
             # For the second flashing onwards, the pico return's first 4 bytes should match up with the previous
             # frames first 4 values
             print("Verified Correct")
             # update the previous array with the new array provided to the function
             self.previous_array = tuple(new_previous)
-            return
+            return True
         else:
             # If none of the conditions are met, that is we get random values, we enter the desync mode
             # Currently we do a pretty complex process to fix the desync
             # TODO Figure our if just having the Pico restart is a better solution
             log_timestamp(event="Desync detected")
             publish_error(err_msg=f"Desync Error in Pico {self.cs}", context="Failed Pico Verification")
+            # A raised (tuned) clock may be what caused it, drop it before fixing the desync
+            slower = self.spi.fallback(self.cs)
+            if slower is not None:
+                print(f"SPI clock of Pico {self.cs} lowered to {slower} Hz")
+                log_timestamp(event=f"SPI clock of Pico {self.cs} lowered to {slower} Hz")
             print("Entering Desync Fixing")
             self.desync_protocol()
+            return False
+
+    def settle(self, frame, fixed, timeout=READY_TIMEOUT):
+        # Task that waits for the Pico to be done with frame (sent and verified), fixed is the sleep used without
+        # polling. Returns False if the Pico never came back, the verification of the next frame finds the desync.
+        if not self.poll_ready:
+            yield time.monotonic() + fixed
+            return True
+        self.status_seq += 1
+        result = yield ReadyPoll(self.spi, self.cs, frame, self.status_seq, timeout)
+        self.settle_stats.record(frame[1], result, fixed)
+        if result.ready:
+            self.previous_array = tuple(result.last_frame)
+            self.echo_shift = result.shift
+            # The Pico prints the status page before it takes the next frame
+            yield time.monotonic() + PROBE_SETTLE
+        else:
+            print(f"Pico {self.cs} not done with frame 0x{frame[1]:02x} after {result.settle * 1000:.0f} ms")
+            log_timestamp(event=f"Pico {self.cs} not ready after frame 0x{frame[1]:02x}")
+        return result.ready
+
+    def probe_link(self, probes=TUNE_PROBES):
+        # Send probe frames (no-op opcode, nothing changes on the Pico) and check every echo with the same comparison
+        # the verification does. The first transfer only syncs up to the previous frame, its echo is not checked.
+        previous = probe_frame(0)
+        self.spi.transfer(self.cs, previous)
+        for seq in range(1, probes + 1):
+            frame = probe_frame(seq)
+            self.pico_return = self.spi.transfer(self.cs, frame)
+            if sum(self.pico_return) == 0 or not echo_matches(self.pico_return, previous, self.echo_shift):
+                return False
+            previous = frame
+        self.previous_array = tuple(previous)
+        return True
+
+    def calibrate_speed(self, speeds=TUNE_SPEEDS, probes=TUNE_PROBES):
+        # Step the clock of this chip select up through speeds until the probe echoes stop matching. Returns the
+        # highest clock that passed (None if not even the first one did), the clock is left at the tuned value.
+        highest = None
+        for speed in speeds:
+            self.spi.set_speed(self.cs, speed)
+            if not self.probe_link(probes):
+                print(f"Pico {self.cs}: lost sync at {speed} Hz")
+                break
+            print(f"Pico {self.cs}: in sync at {speed} Hz")
+            highest = speed
+
+        # Back to a clock with margin, realign the Pico in case the failing clock desynced it and check it once more
+        self.spi.set_speed(self.cs, tuned_speed(highest or speeds[0]))
+        if not self.probe_link(probes):
+            self.desync_protocol()
+            if not self.probe_link(probes):
+                print(f"Pico {self.cs}: not in sync after tuning, no Pico or not answering")
+                highest = None
+        # Whatever the probes did, the settings on the Pico are sent again
+        self.force_refresh()
+        return highest
+
     def desync_protocol(self):
         ## When desynced the pico is recieving the opcode and data in the wrong order.
+        # The offset is read from the echo of resync frames, a short transfer realigns the Pico and probe frames check
+        # it worked, retried with a backoff if not (see PCCS_SPI.resync)
+
+        result = resync(self.spi, self.cs)
+        self.previous_array = tuple(result.last_frame)
+
+        # The Pico applies zeroed pins and voltages when it desyncs, everything has to be sent again
+        self.force_refresh()
+        self.desync_count += 1
+
+        if result.ok:
+            self.echo_shift = result.shift
+            print(f"Desync of Pico {self.cs} fixed in {result.elapsed * 1000:.0f} ms ({result.attempts} attempts), "
+                  f"echo {result.shift} bytes behind")
+            log_timestamp(event=f"Desync fixed in {result.elapsed * 1000:.0f} ms, {result.attempts} attempts, "
+                                f"echo shift {result.shift}")
+        else:
+            print(f"Desync of Pico {self.cs} NOT fixed after {result.attempts} attempts")
+            log_timestamp(event=f"Desync not fixed after {result.attempts} attempts")
+            publish_error(err_msg=f"Pico {self.cs} still desynced after {result.attempts} resync attempts",
+                          context="Desync Protocol")
+        return result.ok
+
+    def send_slab_data(self, force_refresh=False):
+        # This blade pair on its own, see slab_task
+        return run_interleaved([self.slab_task(force_refresh)])[0]
 
-        self.spi.open(0, self.cs)
-        self.spi.max_speed_hz = 50 * 1000
-        self.spi.mode = 0
-
-        desync_test = bytearray()
-        desync_fix = bytearray()
-
-        desync_test.extend([i for i in range(36)])  # An array 0-35 in bytes
-        print(desync_test)
-        time.sleep(0.5)
-        print("Zeroth Test send", self.spi.xfer3(desync_test))
-        time.sleep(0.5)
-        test_return1 = self.spi.xfer3(desync_test)
-        print(test_return1)
-        print("CALCULATED DESYNC = ", test_return1[-1])
-
-        time.sleep(0.5)
-        # int(test_return1[-1])
-        desync_fix.extend([i for i in range(test_return1[-1] + 1)])
-        print(desync_fix)
-        time.sleep(0.5)
-        test_return2 = self.spi.xfer3(desync_fix)
-
-        print(test_return2)
-        time.sleep(0.5)
-        revert_array = bytearray()
-        revert_array.extend([255, 255])
-        revert_array.extend([0 for i in range(34)])
-        test_return3 = self.spi.xfer3(revert_array)
-        self.previous_array = tuple(revert_array)
-        print(test_return3[-1])
-
-        self.spi.close()
-
-        print("Desync Hopefully fixed")
-        log_timestamp(event="Hopefully fixed")
-        print("prev_return = ", self.previous_array)
-
-    def send_slab_data(self):
+    def slab_task(self, force_refresh=False):
 
         # New code to send 2 frames to the Pico,
         # This is needed as 1 layer on the slab is 16*2 PMTs, need 2x the DAC data.
+        # Only the frames that differ from the shadow copy are sent, together with the settle time after them, so a
+        # blade pair with no changes costs no SPI time at all. Every frame is settled (the Pico is done with its DAC
+        # writes) before the next one and before the task ends. Returns the number of frames sent.
 
-        # Enable SPI
+        if force_refresh:
+            self.force_refresh()
 
-        self.spi.open(0, self.cs)
-        self.spi.max_speed_hz = 50 * 1000
-        self.spi.mode = 0
+        opcode_data1, opcode_data2 = self.encoder.slab_frames()
+
+        frames = [frame for frame in (opcode_data1, opcode_data2) if self.shadow.get(frame[1]) != frame]
+        if not frames:
+            self.clear()
+            print(f"Pico {self.cs} already holds this data, nothing sent")
+            return 0
+
+        desyncs = self.desync_count
+        sent = yield from self.send_frames(frames)
+
+        if self.desync_count != desyncs:
+            # A desync wiped the Pico (and the shadow) part way through, send both frames of this layer once more
+            sent += yield from self.send_frames((opcode_data1, opcode_data2))
 
-        # print(data)
-        # for byte in data:
-        #     self.spi.xfer3([byte])
-        opcode_data1 = bytearray()
-        opcode_data1.extend([0xff, 0xfc])
-        opcode_data1.extend(self.data_array)
-        self.pico_return = self.spi.xfer3(opcode_data1)
-        self.verification(opcode_data1)
-
-        time.sleep(0.4)
-
-        opcode_data2 = bytearray()
-        opcode_data2.extend([0xff, 0xfd])
-        opcode_data2.extend(self.data_array2)
-        self.pico_return = self.spi.xfer3(opcode_data2)
-        self.verification(opcode_data2)
-
-        self.spi.close()
         self.clear()
+        return sent
+
+    def send_frames(self, frames):
+        # Task that sends frames, each verified and settled before the next. The fixed settles are the old 0.4 s
+        # between the frames and 0.3 s after the last one.
+        for n, frame in enumerate(frames, 1):
+            self.pico_return = self.spi.transfer(self.cs, frame)
+            if self.verification(frame):
+                self.shadow[frame[1]] = bytes(frame)
+                yield from self.settle(frame, 0.4 if n < len(frames) else 0.3)
+        return len(frames)
 
     def layer_scan(self, bad_chans):
+        run_interleaved([self.scan_task(bad_chans)])
 
-        self.spi.open(0, self.cs)
-        self.spi.max_speed_hz = 50 * 1000
-        self.spi.mode = 0
+    def scan_task(self, bad_chans):
 
         # print(data)
         # for byte in data:
-        #     self.spi.xfer3([byte])
-        opcode_scan = bytearray()
-        opcode_scan.extend([0xff, 0xfe])
-        opcode_scan.extend(bad_chans) # 16 values
-        opcode_scan.extend([0x00 for _ in range(18)])
+        #     self.spi.transfer(self.cs, [byte])
+        opcode_scan = self.encoder.scan_frame(bad_chans)  # 16 values then zeros
         # self.display(opcode_scan)
-        self.pico_return = self.spi.xfer3(opcode_scan)
-        self.verification(opcode_scan)
-        self.spi.close()
+        self.pico_return = self.spi.transfer(self.cs, opcode_scan)
+        # The scan comes right after a reset, whatever was on the Pico before is gone
+        self.force_refresh()
+        if self.verification(opcode_scan):
+            # The scan goes over every I2C address, the first frames after it would otherwise arrive mid scan
+            yield from self.settle(opcode_scan, 0, SCAN_TIMEOUT)
         self.clear()
 
     def clear(self):
-        self.data_array.clear()
-        self.data_array2.clear()
+        self.encoder.clear()
 
 
 class Detector:
-    def __init__(self, number_of_layers):
+    def __init__(self, number_of_layers, spi=None, poll_ready=False):
         self.number_of_layers = number_of_layers
-        self.spi = spidev.SpiDev()
-        self.olayer = [DetectorLayer(_, self.spi) for _ in range(number_of_layers)]
+        # One open SPI handle per chip select for the whole run (see PCCS_SPI)
+        self.spi = spi if spi is not None else SpiTransport()
+        self.poll_ready = poll_ready
+        self.olayer = [DetectorLayer(_, self.spi, poll_ready) for _ in range(number_of_layers)]
         # self.i2c_scan()
 
     def i2c_scan(self, bad_chans):
-        for index in range(self.number_of_layers):
-            self.olayer[index].layer_scan(bad_chans[index * 16:(index+1) * 16])
+        # The Picos scan at the same time
+        run_interleaved([self.olayer[index].scan_task(bad_chans[index * 16:(index+1) * 16])
+                         for index in range(self.number_of_layers)])
 
     def set_slab_blade_data(self, chan_val):
         for i in range(self.number_of_layers):
-            print("Chan ", i, "is getting data ", chan_val[i * 32:(i + 1) * 32])
+            # print("Chan ", i, "is getting data ", chan_val[i * 32:(i + 1) * 32])
             self.olayer[i].set_data(chan_val[i * 32:(i + 1) * 32])
 
-
-    def send_slab_data(self):
-        # Tells the layer objects to send their data to the Picos
-        for _ in range(len(self.olayer)):
-            self.olayer[_].send_slab_data()
+    def stage_slab_blade_data(self, chan_val):
+        for i in range(self.number_of_layers):
+            self.olayer[i].stage_data(chan_val[i * 32:(i + 1) * 32])
+
+    def commit_slab_data(self):
+        # The staged frames onto the Picos, see send_slab_data
+        for layer in self.olayer:
+            layer.commit()
+        return self.send_slab_data()
+
+    def send_slab_data(self, force_refresh=False):
+        # Tells the layer objects to send their data to the Picos, returns the number of frames that actually went out.
+        # The blade pairs are interleaved (see PCCS_SPI.run_interleaved), while one Pico does its DAC writes the next
+        # one gets its frame, so the staging takes about as long as the slowest blade pair instead of all of them.
+        return sum(run_interleaved([layer.slab_task(force_refresh) for layer in self.olayer]))
+
+    def force_refresh(self):
+        for layer in self.olayer:
+            layer.force_refresh()
+
+    def settle_summary(self):
+        # Settle times of every blade pair, {chip select: SettleStats.summary()}
+        return {layer.cs: layer.settle_stats.summary() for layer in self.olayer}
+
+    def return_summary(self):
+        # What the Picos sent back recently, {chip select: ReturnHistory.summary()}
+        return {layer.cs: layer.history.summary() for layer in self.olayer}
+
+    def tune_spi(self):
+        # Calibrate every blade pair and save the tuned clocks to this host's profile. A blade pair that could not be
+        # tuned keeps the default clock and is left out of the profile.
+        speeds, highest = {}, {}
+        for layer in self.olayer:
+            fastest = layer.calibrate_speed()
+            if fastest is not None:
+                highest[layer.cs] = fastest
+                speeds[layer.cs] = self.spi.speed(layer.cs)
+        path = save_profile(speeds, highest)
+        print(f"SPI clocks {speeds} (highest in sync {highest}) saved to {path}")
+        return speeds
 
 class PCCS_Receiver:
     def __init__(self):
-        self.odetector = Detector(2)
+        # Clocks given on the command line win over the tuned profile of this host
+        speeds, default_speed_hz = parse_speeds(args.spi_hz) if args.spi_hz else (load_profile(), None)
+        self.odetector = Detector(2, SpiTransport(speeds, default_speed_hz or DEFAULT_SPEED_HZ),
+                                  poll_ready=args.poll_settle)
+        if args.tune_spi:
+            self.odetector.tune_spi()
+        # The event staged on the layers' staging encoders (None once committed) and its pulse length (flasher only)
+        self.staged_event = None
+        self.staged_length = None
 
     def set_layer(self,data):
         self.slab_run(data)
 
+    def stage(self, event, data, length=None):
+        # Encode the frames of event without touching the Picos, the current event may still be flashing
+        self.odetector.stage_slab_blade_data(data)
+        self.staged_event = event
+        self.staged_length = length
+
+    def commit(self, event):
+        # Send the frames staged for event (and set its pulse length). False if what is staged is for another event,
+        # e.g. this device got no new data for it and holds the right data already.
+        if event is None or self.staged_event != event:
+            return False
+        self.staged_event = None
+        if self.staged_length is not None:
+            set_length(self.staged_length)
+        self.odetector.commit_slab_data()
+        return True
+
     def initialize(self,bad_chans):
-        Sys_Rst.set_value(0)
-        Sys_Rst.set_value(1)
-        time.sleep(1)
+        # Nothing on the Picos can be trusted after the reset (layer_scan also forgets it, this covers a failing scan)
+        self.odetector.force_refresh()
+        pulse_lines.play("reset")
+        # The reset line is pulsed without a wait before every pulse too, the wait here was for the Picos, which are
+        # polled until the scan is done when polling
+        if not self.odetector.poll_ready:
+            time.sleep(1)
         self.odetector.i2c_scan(bad_chans)
 
 
     def slab_run(self, data):
         print("Entered Slab Run")
-        print("Processed chan val", data)
+        # print("Processed chan val", data)
 
         self.odetector.set_slab_blade_data(data)
+        # Every frame sent has been settled by the time this returns, blade pairs with no changes took no time at all
         self.odetector.send_slab_data()
-        time.sleep(0.3)
 
 
 def publish_heartbeat():
@@ -467,7 +574,20 @@ def publish_heartbeat():
             payload = {
                 "status": "alive",
                 "timestamp": int(time.time()),
-                "hostname": PI_ID
+                "hostname": PI_ID,
+                # Settle times per blade pair and the dead time the polling removed
+                "settle": pccs_receiver.odetector.settle_summary(),
+                # Sync states, desync rate and channels with failing base writes per blade pair
+                "returns": pccs_receiver.odetector.return_summary(),
+                # What the worker is doing and has queued, the data coalesced and pulses cancelled
+                "work": work.status(),
+                # Newest event taken and the older data / pulse messages dropped
+                "events": {"newest": dict(newest_event), "stale": dict(stale_messages)},
+                # The uploaded plan, in run-upload mode
+                "plan": None if run_plan is None else {"plan_id": run_plan.plan_id, "events": len(run_plan),
+                                                       "payloads": len(run_plan.payloads)},
+                # Scheduling of the pulse thread and its last burst, with --realtime
+                "pulse": pulse_engine.status() if pulse_engine is not None else None,
             }
             client.publish(TOPIC_STATUS, json.dumps(payload))
         except Exception as e:
@@ -483,25 +603,191 @@ def publish_error(err_msg, context="general"):
     }
     client.publish(TOPIC_ERROR, json.dumps(error))
 
-def publish_ready_for_flash():
+def publish_ack(status, event):
+    # The answers of the run-upload mode, 5 bytes instead of the JSON
+    client.publish(TOPIC_ACK, ACK.pack(ACK_CODES[status], event))
+
+
+def publish_ready_for_flash(event):
+    if run_plan is not None:
+        return publish_ack("ready_for_flash", event)
     ready_msg = {
         "status": "ready_for_flash",
         "timestamp": int(time.time()),
-        "hostname": PI_ID
+        "hostname": PI_ID,
+        "event": event
     }
     client.publish(TOPIC_STATUS, json.dumps(ready_msg))
 
 
-def publish_flash_done():
+def publish_flash_done(event):
+    if run_plan is not None:
+        return publish_ack("flash_done", event)
     ready_msg = {
         "status": "flash_done",
         "timestamp": int(time.time()),
-        "hostname": PI_ID
+        "hostname": PI_ID,
+        "event": event
     }
     client.publish(TOPIC_STATUS, json.dumps(ready_msg))
 
 
+def publish_pulse_done(event):
+    # A single pulse is over, event is the id the controller sent it with
+    if run_plan is not None:
+        return publish_ack("pulse_done", event)
+    done_msg = {
+        "status": "pulse_done",
+        "timestamp": int(time.time()),
+        "hostname": PI_ID,
+        "event": event,
+    }
+    client.publish(TOPIC_STATUS, json.dumps(done_msg))
+
+
+def publish_prep_done(elapsed):
+    # The reset and the I2C scan of the prep are done, the controller starts the run once every device said so
+    prep_msg = {
+        "status": "prep_done",
+        "timestamp": int(time.time()),
+        "hostname": PI_ID,
+        "elapsed": round(elapsed, 3),
+    }
+    client.publish(TOPIC_STATUS, json.dumps(prep_msg))
+
+
+def publish_plan_loaded(plan):
+    plan_msg = {
+        "status": "plan_loaded",
+        "timestamp": int(time.time()),
+        "hostname": PI_ID,
+        "plan_id": plan.plan_id,
+        "events": len(plan),
+        "payloads": len(plan.payloads),
+    }
+    client.publish(TOPIC_STATUS, json.dumps(plan_msg))
+
+
+def load_plan(data):
+    # Work queue job, unpack the uploaded slice. A slice that doesn't unpack raises, the error goes out with the
+    # context "plan" and the controller sends this device its data event by event.
+    global run_plan
+    run_plan = None
+    plan = PlanSlice(data)
+    run_plan = plan
+    print(f"Plan {plan.plan_id:08x} loaded, {len(plan)} events, {len(plan.payloads)} distinct payloads")
+    publish_plan_loaded(plan)
+
+
+def decode_data(data):
+    # The 48 voltages (and the pulse length for the flasher) of a data payload, without the event id. The voltages
+    # are padded to the 64 the 2 blade pairs take, read straight out of the payload.
+    offset = 0
+    length = None
+    if PI_ID == "PCCS_Flasher":
+        length = struct.unpack_from(">H", data)[0]
+        offset = 2
+    slab_layer_data = np.zeros(64, dtype=">u2")
+    slab_layer_data[:48] = np.frombuffer(data, dtype=">u2", count=48, offset=offset)  # 48 values
+    return slab_layer_data, length
+
+
+def stage_data(event, slab_layer_data, length=None):
+    # Work queue job, the pulse length (flasher only) and the voltages encoded into the staging frames
+    pccs_receiver.stage(event, slab_layer_data, length)
+
+
+def commit_data(event):
+    # Work queue job, the staged frames onto the hardware, then tell the controller. A device without staged data
+    # for the event is not waited for and says nothing.
+    if pccs_receiver.commit(event):
+        publish_ready_for_flash(event)
+
+
+def prep_devices(bad_chans):
+    # Work queue job, the reset and scan of the prep, acknowledged with prep_done (a failing scan raises and is
+    # published as an error instead)
+    start = time.perf_counter()
+    pccs_receiver.initialize(bad_chans)
+    publish_prep_done(time.perf_counter() - start)
+
+
+def wait_for_engine(finished, timeout, what):
+    # Wait for the pulse thread to call done, bounded so a lost callback can't block the worker (and every job queued
+    # behind it) for good. False, with an error published, if it took longer than timeout.
+    if finished.wait(timeout):
+        return True
+    print(f"Pulse engine did not finish the {what} within {timeout:.1f} s, going on")
+    publish_error(f"Pulse engine did not finish the {what} within {timeout:.1f} s", context="pulse")
+    return False
+
+
+def run_pulse(trigger, event=None):
+    # Work queue job, a single pulse, acknowledged with pulse_done if the controller numbered it. With --realtime it
+    # is fired by the pulse thread, the worker waits for it so nothing queued after the pulse runs before it is over.
+    fired = True
+    if pulse_engine is None:
+        send_pulse(trigger)
+    else:
+        finished = threading.Event()
+        result = []
+        pulse_engine.single(trigger, done=lambda report: (result.append(report), finished.set()))
+        fired = wait_for_engine(finished, PULSE_WIDTH + PULSE_WAIT_MARGIN, "pulse") and result[0] is not None
+    if fired and event is not None:
+        publish_pulse_done(event)
+
+
+def run_fastpulse(trigger, rate, count, event=None):
+    # Work queue job, a burst, flash_done once it is over (also when it was aborted)
+    if pulse_engine is None:
+        send_fastpulse(trigger, rate, count, stop=abort_burst)
+        publish_flash_done(event)
+        return
+    finished = threading.Event()
+    expired = threading.Event()
+
+    def done(report):
+        # A burst that only ends after the worker gave up on it is not reported as done
+        if report is not None and not expired.is_set():
+            publish_flash_done(event)
+        finished.set()
+
+    pulse_engine.fast(trigger, rate, count, done=done)
+    # The burst starts a period after it is taken and takes count periods
+    if not wait_for_engine(finished, (count + 1) / max(rate, 1) + PULSE_WAIT_MARGIN, f"burst of {count}"):
+        expired.set()
+
+
+def abort_pulses():
+    # Drop the queued pulses and stop the running burst within a pulse period. The stop is cleared by a job queued
+    # behind the burst, so an abort never carries over to a burst queued later.
+    dropped = work.cancel("pulse")
+    if pulse_engine is not None:
+        dropped += pulse_engine.abort()
+    abort_burst.set()
+    work.put("abort", abort_burst.clear)
+    print(f"Abort received, {dropped} queued pulse commands dropped")
+
+
+def is_stale(kind, event):
+    # Whether a data / pulse message is older than the newest of its kind already taken (counted if so). Only called
+    # from the MQTT callback.
+    if event is not None and event < newest_event.get(kind, 0):
+        stale_messages[kind] += 1
+        print(f"Dropped stale {kind} message for event {event} (newest {newest_event[kind]})")
+        return True
+    if event is not None:
+        newest_event[kind] = event
+    return False
+
+
+def on_work_error(kind, tb):
+    print(f"[{PI_ID}] Error in {kind} job: {tb}")
+    publish_error(tb, context=kind)
+
+
 def on_message(client, userdata, message):
+    global run_plan
     try:
         topic = message.topic
 
@@ -509,29 +795,64 @@ def on_message(client, userdata, message):
             msg = message.payload.decode()
             if msg == "SYNC":
                 print(f"Handshake request received, responding with READY from {PI_ID}")
+                # A (re)started controller numbers its events from 1 again, and uploads its own plan
+                newest_event.clear()
+                run_plan = None
                 client.publish(TOPIC_HANDSHAKE, f"READY_{PI_ID}")
 
 
+        # Everything that touches the hardware is queued for the worker thread (see PCCS_Work), this callback only
+        # decodes the message
         elif topic == TOPIC_PREP:
             bad_channel_packed = message.payload
             bad_channels = struct.unpack(">24B", bad_channel_packed)
             bad_channels_data = list(bad_channels) + [0] * 16
-            pccs_receiver.initialize(bad_channels_data)
+            work.put("prep", prep_devices, bad_channels_data)
 
         elif topic == TOPIC_DATA:
 
             data = message.payload
-            if PI_ID == "PCCS_Flasher":
-                unpacked = struct.unpack(">49H", data)
-                length = unpacked[0]
-                set_length(length)
-                voltages = unpacked[1:]  # 48 values
+            event = EVENT_HEADER.unpack_from(data)[0]
+            if is_stale("data", event):
+                return
+            slab_layer_data, length = decode_data(data[EVENT_HEADER.size:])
+            # Data still waiting behind a busy worker is replaced, only the newest configuration gets staged
+            work.put("data", stage_data, event, slab_layer_data, length, coalesce=True)
+
+        elif topic == TOPIC_PLAN:
+            work.put("plan", load_plan, message.payload)
+
+        elif topic == TOPIC_GO:
+            # The same as a data message, with the data out of the uploaded plan
+            event, position, mask = GO.unpack(message.payload)
+            if not mask & DEVICE_BIT or is_stale("data", event):
+                return
+            if run_plan is None or position >= len(run_plan):
+                publish_error(f"No plan with event {position} on {PI_ID}", context="plan")
+                return
+            slab_layer_data, length = decode_data(run_plan.payload(position))
+            work.put("data", stage_data, event, slab_layer_data, length, coalesce=True)
+
+        elif topic == TOPIC_FIRE:
+            # The same as a pulse message, with the pulse settings out of the uploaded plan
+            event, position = FIRE.unpack(message.payload)
+            if is_stale("pulse", event):
+                return
+            if run_plan is None or run_plan.pulses is None or position >= len(run_plan):
+                publish_error(f"No plan with event {position} on {PI_ID}", context="plan")
+                return
+            trigger, rate, count = run_plan.pulse(position)
+            if count == 1:
+                work.put("pulse", run_pulse, trigger, event)
             else:
-                voltages = struct.unpack(">48H", data)
+                work.put("pulse", run_fastpulse, trigger, rate, count, event)
+
+        elif topic == TOPIC_COMMIT:
+            event = EVENT_HEADER.unpack_from(message.payload)[0]
+            work.put("commit", commit_data, event)
 
-            slab_layer_data = list(voltages) + [0] * 16
-            pccs_receiver.set_layer(slab_layer_data)
-            publish_ready_for_flash()
+        elif topic == TOPIC_ABORT:
+            abort_pulses()
 
         elif topic == TOPIC_PULSE:
             try:
@@ -542,16 +863,18 @@ def on_message(client, userdata, message):
 
             pulse_type = msg.get("type", "")
             trigger = msg.get("trigger", 0)
+            event = msg.get("event")
+            if is_stale("pulse", event):
+                return
 
             if pulse_type == "single":
-                send_pulse(trigger)
+                work.put("pulse", run_pulse, trigger, event)
 
             elif pulse_type == "fast":
                 rate = msg.get("rate", None)
                 count = msg.get("count", None)
                 if rate is not None and count is not None:
-                    send_fastpulse(trigger, rate, count)  # Define this function to handle fast pulses
-                    publish_flash_done()
+                    work.put("pulse", run_fastpulse, trigger, rate, count, event)
                 else:
                     print(f"Incomplete fast pulse info: {msg}")
 
@@ -593,15 +916,26 @@ if __name__ == '__main__':
 
     pccs_receiver = PCCS_Receiver()
 
+    # Started before paho's and the heartbeat thread, they stay off the pulse CPU
+    pulse_engine = PulseEngine(pulse_lines, args.pulse_cpu, args.pulse_priority).start() if args.realtime else None
+    # The hardware work of the messages, off paho's network thread
+    abort_burst = threading.Event()
+    work = WorkQueue(on_error=on_work_error).start()
+
     client.on_message = on_message
     client.connect(broker_ip, 1883, 60)
     client.on_disconnect = on_disconnect
     client.subscribe(TOPIC_HANDSHAKE)
     client.subscribe(TOPIC_DATA)
     client.subscribe(TOPIC_PREP)
+    client.subscribe(TOPIC_ABORT)
+    client.subscribe(TOPIC_COMMIT)
+    client.subscribe(TOPIC_PLAN)
+    client.subscribe(TOPIC_GO)
 
     if PI_ID == "PCCS_Flasher":
         client.subscribe(TOPIC_PULSE)
+        client.subscribe(TOPIC_FIRE)
 
     # client.publish(TOPIC_HANDSHAKE, f"READY_{PI_ID}")
 
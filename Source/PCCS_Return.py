@@ -0,0 +1,132 @@
+# PCCS Return - Decoding of the 36 bytes a Pico sends back on every transfer, and a history of them per chip select.
+# The verification only looks at the echo, the rest of the buffer has the Pico's status in it (see PCCS_Frame
+# STATUS_OFFSET): which channels failed their last base write and which channels the scan found a base on.
+#
+# decode_return turns a return into a compact record: the sync state (no Pico, startup buffer, in sync, echo shifted,
+# desync), whether the echo (head and tail) matched, where the echo was found and the 2 channel maps. ReturnHistory
+# keeps the last RETURN_HISTORY records of a chip select in a NumPy structured array that is allocated once and written
+# in place as a ring, the queries (desync rate, faults per channel, summary for the heartbeat) work on views of it.
+#
+# Firmware from before the status (the LV_Dist_Spi.uf2 in Source/Pico is still such a build, it has to be rebuilt from
+# main.c to get it) zeros bytes 5-31 instead, so there is no version byte. Those returns are kept with status False,
+# and the summary reports the channel maps as unknown (None) instead of "no faults, no bases" when none had a status.
+
+import time
+
+import numpy as np
+
+from PCCS_Frame import FRAME_CHANNELS, STATUS_OFFSET, STATUS_VERSION, ECHO_BEACON, echo_shift, echo_matches
+
+RETURN_HISTORY = 1024  # Records kept per chip select
+
+# Sync states of a return
+NO_PICO = 0  # All zeros, dead or not connected
+STARTUP = 1  # The buffer the Pico starts with, nothing received yet
+IN_SYNC = 2  # The echo of the previous frame where it was expected
+SHIFTED = 3  # The echo is there but further behind than expected
+DESYNC = 4  # No echo of the previous frame
+STATE_NAMES = ("no_pico", "startup", "in_sync", "shifted", "desync")
+
+STARTUP_HEAD = bytes([0xFF, 0xFE, 0xFD, 0xFC])  # ~0, ~1, ~2, ~3
+
+RECORD_DTYPE = np.dtype([
+    ("time", "f8"),
+    ("opcode", "u1"),  # Opcode of the frame the return came back on
+    ("state", "u1"),
+    ("echo", "?"),  # Head and tail of the echo matched
+    ("shift", "i1"),  # Where the echo was found, -1 if it wasn't
+    ("faults", "u2"),  # Channel maps, bit 15 - channel
+    ("present", "u2"),
+    ("status", "?"),  # The return had the firmware status in it (the channel maps are only meaningful then)
+])
+
+
+def decode_return(pico_return, previous, shift=0):
+    # (state, echo, shift, faults, present, status) of a return, previous is the frame sent before it (empty if none)
+    # and shift where its echo is expected. status is False (and the channel maps 0) if the firmware sends no status
+    # or there is no echo to find it from.
+    if not any(pico_return):
+        return NO_PICO, False, -1, 0, 0, False
+    found = None
+    if previous:
+        if (pico_return[shift + 4] == ECHO_BEACON
+                and bytes(pico_return[shift:shift + 4]) == bytes(previous[0:4])):
+            found = shift
+        else:
+            found = echo_shift(pico_return, previous)
+    if found is None:
+        state = STARTUP if bytes(pico_return[0:4]) == STARTUP_HEAD else DESYNC
+        return state, False, -1, 0, 0, False
+
+    state = IN_SYNC if found == shift else SHIFTED
+    echo = echo_matches(pico_return, previous, found)
+    status = STATUS_OFFSET + found
+    if len(pico_return) < status + 5 or pico_return[status] != STATUS_VERSION:
+        return state, echo, found, 0, 0, False
+    faults = pico_return[status + 1] << 8 | pico_return[status + 2]
+    present = pico_return[status + 3] << 8 | pico_return[status + 4]
+    return state, echo, found, faults, present, True
+
+
+def channel_list(bits):
+    # The channels set in a channel map
+    return [chan for chan in range(FRAME_CHANNELS) if bits >> (15 - chan) & 1]
+
+
+class ReturnHistory:
+    # The last size records of one chip select, oldest overwritten first
+    def __init__(self, size=RETURN_HISTORY):
+        self.records = np.zeros(size, dtype=RECORD_DTYPE)
+        self.size = size
+        self.count = 0  # Records ever added, the next one goes to count % size
+        # Masks of the 16 channel bits, for the fault counts
+        self.channel_bits = (1 << (15 - np.arange(FRAME_CHANNELS))).astype(np.uint16)
+
+    def add(self, pico_return, previous, shift=0, opcode=0, now=None):
+        # Decode a return and keep it, returns the decoded tuple (see decode_return)
+        decoded = decode_return(pico_return, previous, shift)
+        self.records[self.count % self.size] = (time.time() if now is None else now, opcode, *decoded)
+        self.count += 1
+        return decoded
+
+    def recent(self, n=None):
+        # The last n records (all kept if None), oldest first. A view when they don't wrap around the end.
+        n = min(self.count, self.size) if n is None else min(n, self.count, self.size)
+        end = self.count % self.size
+        if n <= end:
+            return self.records[end - n:end]
+        return np.concatenate((self.records[self.size - (n - end):], self.records[:end]))
+
+    def desync_rate(self, n=None):
+        # Fraction of the last n returns that had no echo of the frame before (from a Pico that answered at all)
+        states = self.recent(n)["state"]
+        answered = int(np.count_nonzero(states != NO_PICO))
+        return int(np.count_nonzero(states == DESYNC)) / answered if answered else 0.0
+
+    def channel_faults(self, n=None):
+        # How many of the last n returns had each channel's fault bit set, an array of 16 counts
+        records = self.recent(n)
+        faults = records["faults"][records["status"]]
+        return np.count_nonzero(faults[:, None] & self.channel_bits, axis=0)
+
+    def summary(self, n=None):
+        # JSON friendly summary of the last n returns, for the heartbeat
+        records = self.recent(n)
+        if not len(records):
+            return {"returns": 0}
+        states = np.bincount(records["state"], minlength=len(STATE_NAMES))
+        answered = int(np.count_nonzero(records["state"] != NO_PICO))
+        faults = self.channel_faults(n)
+        # The bases from the latest return that had a status in it
+        present = records["present"][records["status"]]
+        # Without a single status (firmware without it) the channel maps are unknown, not empty
+        status = bool(records["status"].any())
+        return {
+            "returns": int(len(records)),
+            "states": {name: int(count) for name, count in zip(STATE_NAMES, states) if count},
+            "desync_rate": round(self.desync_rate(n), 4),
+            "echo_ok": round(int(np.count_nonzero(records["echo"])) / answered, 4) if answered else 0.0,
+            "firmware_status": status,
+            "channel_faults": {int(chan): int(count) for chan, count in enumerate(faults) if count} if status else None,
+            "bases": channel_list(int(present[-1])) if status else None,
+        }
@@ -0,0 +1,373 @@
+# PCCS SPI - The SPI transport shared by the programs that talk to the Pico blades.
+# Instead of every send opening the bus, setting the clock and mode and closing it again, the transport keeps one
+# SpiDev handle open per chip select for the life of the process, configured once when it is first used.
+# The clock is set per chip select (blade pair), the 50 kHz everything used to run at is only the default, the
+# overlay in Setup/spi-cs-extend.dts allows up to 125 MHz on every chip select.
+#
+# spidev is only imported when the first handle is opened, and the class used for the handles can be swapped out
+# (spi_factory), e.g. for something that emulates a Pico.
+#
+# The clocks can be tuned per chip select (PCCS_Receiver --tune-spi steps each blade pair up through TUNE_SPEEDS and
+# keeps the highest clock every probe frame was echoed at) and saved in a per-host profile, which normal runs start
+# from. When a desync shows up at a raised clock, fallback() halves it again for the rest of the run.
+#
+# resync() realigns a Pico whose pages no longer start with the frames (a desync). Resync frames (a ramp of bytes) are
+# sent until the echo of a page made of them comes back the same twice in a row, the ramp value it starts with is the
+# byte of the frame the Pico's pages start at, a short transfer of that many bytes moves the page boundary back onto
+# the frames. Probe frames
+# then check the echo is there again (and how far behind it runs, see PCCS_Frame.echo_shift, the verification has to
+# look for it there from then on) and run out the pages the Pico only echoes after a desync. If that fails it is
+# tried again after a growing backoff. It all runs at the 50 kHz default clock (at higher clocks bytes arrive while the
+# Pico prints a page and are lost). Against the emulated Pico (python PCCS_Bench.py resync) a resync takes about 80 ms
+# and always worked, the old desync_protocol took 2.5 s and never did (also on an instant Pico, it follows from the
+# main.c echo rules). The emulator's FIFO and timing model has not been checked on a Pico yet, see PCCS_Emulator.
+#
+# wait_ready() replaces the fixed sleeps after a frame (the time the Pico spends on the I2C DAC writes). It sends a
+# probe frame as a status frame and reads back the echo of the frame before it, the echo only starts once the Pico is
+# back in spi_write_read_blocking. The Pico can't be asked without clocking bytes into it, the first 8 bytes sent while
+# it is busy wait in its RX FIFO and the rest are lost, but where the echo shows up says exactly how many were lost, so
+# the status page is completed with that many bytes and the Pico stays aligned (a probe page is only echoed, nothing is
+# applied). The status frame goes out in short chunks until the echo is there, up to a timeout. SettleStats keeps the
+# settle times per blade pair and the dead time the polling removed compared to the old sleeps.
+# The RX FIFO overrun model this relies on (ReadyPoll) has only been checked against PCCS_Emulator, not on a Pico,
+# so the polling is opt-in (poll_ready, the Receiver's --poll-settle) and the fixed sleeps stay the default.
+# run_interleaved() does that for several Picos at once, a blade pair gets its next frame while the others are busy.
+
+import json
+import os
+import socket
+import time
+from collections import namedtuple, Counter, defaultdict
+
+from PCCS_Frame import FRAME_SIZE, resync_frame, page_offset, probe_frame, echo_shift
+
+SPI_BUS = 0
+SPI_MODE = 0  # Clock phase, don't change
+DEFAULT_SPEED_HZ = 50 * 1000
+MAX_SPEED_HZ = 125 * 1000 * 1000  # spi-max-frequency in Setup/spi-cs-extend.dts
+
+# Clocks tried by the tuning, doubling up to what an RP2040 SPI slave can follow (clk_peri / 12 at 125 MHz)
+TUNE_SPEEDS = (50_000, 100_000, 200_000, 400_000, 800_000, 1_600_000, 3_200_000, 6_400_000, 10_000_000)
+# The tuned clock is this fraction of the highest one that passed
+TUNE_MARGIN = 0.75
+SPI_PROFILE_DIR = "spi_profiles"
+
+RESYNC_ATTEMPTS = 4
+RESYNC_READS = 5  # Resync frames read back per attempt before giving up on finding the page offset
+RESYNC_AGREE = 2  # Reads in a row that have to give the same offset
+RESYNC_BACKOFF = 0.01  # Wait before the 2nd attempt, doubled for every one after
+RESYNC_SETTLE = 0.005  # After the realigning transfer, the Pico may be applying the zeroed desync settings
+PROBE_SETTLE = 0.001  # Between probe frames, the Pico prints every page it gets
+DESYNC_PAGES = 4  # Pages the firmware only echoes after a desync (desync_flag)
+
+MAX_ECHO_SHIFT = 8  # The TX FIFO depth, an echo further behind than that is not an echo
+
+READY_TIMEOUT = 0.4  # Longest wait for a Pico to be done with a frame, the fixed settle it replaces
+SCAN_TIMEOUT = 2.0  # The I2C scan goes through every address of every channel
+READY_POLL = 0.0005  # Between the status chunks while the Pico is still busy
+STATUS_CHUNK = 4  # Bytes of the status frame per poll after the first 8
+
+ResyncResult = namedtuple("ResyncResult", ["ok", "elapsed", "attempts", "last_frame", "shift"])
+ReadyResult = namedtuple("ReadyResult", ["ready", "settle", "last_frame", "shift"])
+
+
+class SpiTransport:
+    def __init__(self, speeds=None, default_speed_hz=DEFAULT_SPEED_HZ, bus=SPI_BUS, spi_factory=None):
+        # speeds - {chip select: clock in Hz}, chip selects not in it run at default_speed_hz
+        self.bus = bus
+        self.default_speed_hz = check_speed(default_speed_hz)
+        self.speeds = {cs: check_speed(hz) for cs, hz in (speeds or {}).items()}
+        self.spi_factory = spi_factory
+        self.handles = {}
+
+    def handle(self, cs):
+        # The open handle of a chip select, opened and configured the first time it is asked for
+        spi = self.handles.get(cs)
+        if spi is None:
+            if self.spi_factory is None:
+                import spidev
+                self.spi_factory = spidev.SpiDev
+            spi = self.spi_factory()
+            spi.open(self.bus, cs)
+            spi.mode = SPI_MODE
+            spi.max_speed_hz = self.speed(cs)
+            self.handles[cs] = spi
+        return spi
+
+    def speed(self, cs):
+        return self.speeds.get(cs, self.default_speed_hz)
+
+    def set_speed(self, cs, speed_hz):
+        # Change the clock of one chip select, applied right away if its handle is already open
+        self.speeds[cs] = check_speed(speed_hz)
+        if cs in self.handles:
+            self.handles[cs].max_speed_hz = self.speeds[cs]
+
+    def fallback(self, cs):
+        # Halve the clock of a chip select (not below the 50 kHz default), returns the new clock or None if already there
+        if self.speed(cs) <= DEFAULT_SPEED_HZ:
+            return None
+        self.set_speed(cs, max(self.speed(cs) // 2, DEFAULT_SPEED_HZ))
+        return self.speed(cs)
+
+    def transfer(self, cs, data):
+        # Full duplex transfer, returns the bytes the Pico clocked back (one for every byte sent)
+        return self.handle(cs).xfer3(data)
+
+    def close(self, cs=None):
+        # Close the handle of one chip select, or with no cs all of them
+        for key in ([cs] if cs is not None else list(self.handles)):
+            spi = self.handles.pop(key, None)
+            if spi is not None:
+                spi.close()
+
+
+def resync(spi, cs, sleep=time.sleep, clock=time.monotonic, attempts=RESYNC_ATTEMPTS):
+    # Realign the Pico on chip select cs, see the top of the file. Returns a ResyncResult, ok is only True once the
+    # probe echoes matched, last_frame is the last frame sent (what the next echo has to match) and shift how far
+    # behind the echoes are (see echo_shift).
+    start = clock()
+    speed = spi.speed(cs)
+    spi.set_speed(cs, min(speed, DEFAULT_SPEED_HZ))
+    ramp = resync_frame()
+    last_frame = ramp
+    try:
+        for attempt in range(1, attempts + 1):
+            if attempt > 1:
+                sleep(RESYNC_BACKOFF * 2 ** (attempt - 2))
+            offset = read_page_offset(spi, cs, ramp)
+            last_frame = ramp
+            if offset is None:
+                continue
+            sleep(RESYNC_SETTLE)
+            if offset:
+                # The page started at byte offset of the last frame is missing offset bytes, complete it
+                spi.transfer(cs, ramp[:offset])
+                sleep(RESYNC_SETTLE)
+
+            last_frame, shift = check_echoes(spi, cs, DESYNC_PAGES + 1, sleep)
+            if shift is not None:
+                # The Pico prints the last probe page, a frame sent right after it at a raised clock would be cut
+                sleep(PROBE_SETTLE)
+                return ResyncResult(True, clock() - start, attempt, last_frame, shift)
+        return ResyncResult(False, clock() - start, attempts, last_frame, None)
+    finally:
+        spi.set_speed(cs, speed)
+
+
+def read_page_offset(spi, cs, ramp, agree=RESYNC_AGREE):
+    # Send resync frames until the same page offset was read agree times in a row, while bytes are still being lost
+    # (the Pico busy with a page) the page boundary keeps moving. The first return can still hold the echo of an older
+    # page, it is not used. An echo can straddle two returns, so the end of the previous one is searched too. None if
+    # it did not settle within RESYNC_READS frames.
+    spi.transfer(cs, ramp)
+    previous = ()
+    offsets = []
+    for _ in range(RESYNC_READS):
+        pico_return = tuple(spi.transfer(cs, ramp))
+        offsets.append(page_offset(previous[-8:] + pico_return))
+        previous = pico_return
+        if offsets[-1] is not None and offsets[-agree:] == offsets[-1:] * agree:
+            return offsets[-1]
+    return None
+
+
+def check_echoes(spi, cs, probes, sleep=time.sleep):
+    # Send probe frames and find the echo of each one after the first. Returns the last frame sent and the shift of
+    # the echoes, None unless every echo was there with the same shift.
+    previous = probe_frame(0)
+    spi.transfer(cs, previous)
+    shift = None
+    for seq in range(1, probes + 1):
+        sleep(PROBE_SETTLE)
+        frame = probe_frame(seq)
+        found = echo_shift(spi.transfer(cs, frame), previous)
+        if found is None or found > MAX_ECHO_SHIFT or (shift is not None and found != shift):
+            return frame, None
+        shift = found
+        previous = frame
+    return previous, shift
+
+
+class ReadyPoll:
+    # wait_ready one step at a time. The status frame goes out in chunks, poll() sends the next one and looks for the
+    # echo of previous, so the Picos of several chip selects can be waited on together (see run_interleaved). The
+    # first chunk is what the Pico's RX FIFO holds while it is busy, the rest are small so a page is never overfilled.
+    # result is None while the Pico is busy, then the ReadyResult (see wait_ready).
+    def __init__(self, spi, cs, previous, seq=0, timeout=READY_TIMEOUT, clock=time.monotonic):
+        self.spi = spi
+        self.cs = cs
+        self.previous = previous
+        self.status = probe_frame(seq)
+        self.timeout = timeout
+        self.clock = clock
+        self.start = clock()
+        self.sent = bytearray()
+        self.returned = bytearray()
+        self.result = None
+        self.poll(MAX_ECHO_SHIFT)
+
+    def _next_bytes(self, count):
+        # The status frame, then zeros
+        chunk = bytes(self.status[len(self.sent):len(self.sent) + count])
+        return chunk + bytes(count - len(chunk))
+
+    def poll(self, count=STATUS_CHUNK):
+        if self.result is not None:
+            return self.result
+        chunk = self._next_bytes(count)
+        self.sent += chunk
+        self.returned += bytes(self.spi.transfer(self.cs, chunk))
+
+        found = echo_shift(self.returned, self.previous)
+        if found is None:
+            if self.clock() - self.start > self.timeout:
+                self.result = ReadyResult(False, self.clock() - self.start, None, None)
+            return self.result
+
+        # The echo starts after the bytes clocked while the Pico was busy (or the old shift if it wasn't), the first 8
+        # of them waited in its RX FIFO and the rest were lost. The echo runs that far behind from now on.
+        kept = min(found, MAX_ECHO_SHIFT)
+        page = self.sent[:kept] + self.sent[found:]
+        if len(page) > FRAME_SIZE:
+            self.result = ReadyResult(False, self.clock() - self.start, None, None)
+            return self.result
+        if len(page) < FRAME_SIZE:
+            fill = self._next_bytes(FRAME_SIZE - len(page))
+            self.spi.transfer(self.cs, fill)
+            page += fill
+        self.result = ReadyResult(True, self.clock() - self.start, bytes(page), kept)
+        return self.result
+
+
+def wait_ready(spi, cs, previous, seq=0, timeout=READY_TIMEOUT, sleep=time.sleep, clock=time.monotonic):
+    # Wait for the Pico on chip select cs to be done with the frame previous (see the top of the file). Returns a
+    # ReadyResult, settle is the time it took, last_frame the status page the Pico got (what the next echo has to
+    # match) and shift how far behind the echo runs now. ready is False if the echo of previous did not show up within
+    # timeout, the Pico is then desynced (or not there) and last_frame None.
+    poll = ReadyPoll(spi, cs, previous, seq, timeout, clock)
+    while poll.result is None:
+        sleep(READY_POLL)
+        poll.poll()
+    if poll.result.ready:
+        sleep(PROBE_SETTLE)
+    return poll.result
+
+
+def run_interleaved(tasks, sleep=time.sleep, clock=time.monotonic):
+    # Run the tasks of several Picos together, e.g. the frames of every blade pair of a crate. A task is a generator
+    # that does its transfers and yields whenever its Pico needs time, a ReadyPoll (polled here, the task gets the
+    # ReadyResult back) or the clock() time it can go on at. While one Pico is busy with a frame the others get theirs,
+    # the staging takes about as long as the slowest blade instead of all of them. Returns what each task returned.
+    waits = [None] * len(tasks)
+    results = [None] * len(tasks)
+    running = list(range(len(tasks)))
+    while running:
+        progressed = False
+        for i in list(running):
+            wait = waits[i]
+            if isinstance(wait, ReadyPoll):
+                if wait.poll() is None:
+                    continue
+                value = wait.result
+            else:
+                if wait is not None and clock() < wait:
+                    continue
+                value = None
+            progressed = True
+            try:
+                waits[i] = tasks[i].send(value)
+            except StopIteration as stop:
+                results[i] = stop.value
+                running.remove(i)
+        if running and not progressed:
+            sleep(READY_POLL)
+    return results
+
+
+class SettleStats:
+    # Settle times of one blade pair per opcode, and how much dead time they saved against the fixed sleeps
+    def __init__(self):
+        self.count = Counter()
+        self.total = defaultdict(float)
+        self.longest = defaultdict(float)
+        self.timeouts = Counter()
+        self.saved = 0.0
+
+    def record(self, opcode, result, fixed=0):
+        # fixed is the sleep the wait replaced, 0 if there was none (a wait that used to be missing saves nothing)
+        self.count[opcode] += 1
+        self.total[opcode] += result.settle
+        self.longest[opcode] = max(self.longest[opcode], result.settle)
+        if not result.ready:
+            self.timeouts[opcode] += 1
+        if fixed:
+            self.saved += fixed - result.settle
+
+    def summary(self):
+        # JSON friendly, times in ms. Also read by the heartbeat thread, hence the copy of the counts.
+        return {
+            "saved_ms": round(self.saved * 1000, 1),
+            "opcodes": {f"0x{opcode:02x}": {"count": count,
+                                            "mean_ms": round(self.total[opcode] / count * 1000, 2),
+                                            "max_ms": round(self.longest[opcode] * 1000, 2),
+                                            "timeouts": self.timeouts[opcode]}
+                        for opcode, count in list(self.count.items())},
+        }
+
+
+def check_speed(speed_hz):
+    speed_hz = int(speed_hz)
+    if not 0 < speed_hz <= MAX_SPEED_HZ:
+        raise ValueError(f"SPI clock of {speed_hz} Hz is outside 1 Hz - {MAX_SPEED_HZ} Hz")
+    return speed_hz
+
+
+def tuned_speed(highest_hz):
+    # The clock kept from a tuning, TUNE_MARGIN below the highest passing one, never below the default
+    return max(int(highest_hz * TUNE_MARGIN), DEFAULT_SPEED_HZ)
+
+
+def profile_path(host=None):
+    return os.path.join(SPI_PROFILE_DIR, f"{host or socket.gethostname()}.json")
+
+
+def load_profile(path=None):
+    # {chip select: clock} of this host's saved profile, empty if it was never tuned
+    path = path or profile_path()
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path) as f:
+            profile = json.load(f)
+        return {int(cs): check_speed(hz) for cs, hz in profile["speeds"].items()}
+    except (OSError, ValueError, KeyError) as e:
+        print(f"SPI profile {path} is not usable ({e}), using the default clock")
+        return {}
+
+
+def save_profile(speeds, highest, path=None):
+    # Save the tuned clocks (and the highest passing ones, for reference) of this host
+    path = path or profile_path()
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    profile = {
+        "host": socket.gethostname(),
+        "tuned": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "margin": TUNE_MARGIN,
+        "speeds": {str(cs): hz for cs, hz in speeds.items()},
+        "highest": {str(cs): hz for cs, hz in highest.items()},
+    }
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(profile, f, indent=2)
+    os.replace(tmp_path, path)
+    return path
+
+
+def parse_speeds(values):
+    # Command line form of the clocks: one value for every chip select, or one value per chip select in order
+    if not values:
+        return {}, DEFAULT_SPEED_HZ
+    if len(values) == 1:
+        return {}, int(values[0])
+    return {cs: int(hz) for cs, hz in enumerate(values)}, DEFAULT_SPEED_HZ
@@ -22,17 +22,21 @@
 
 # from rpi5 import Run
 import paho.mqtt.client as mqtt
-import struct
 import json
+import struct
 import threading
 import time
-import spidev
 import datetime
-import csv
 import sys
-import gpiod
 import smbus
 import logging
+from PCCS_Plan import iter_segments, payload_counts
+from PCCS_Frame import FrameEncoder
+from PCCS_Return import ReturnHistory
+from PCCS_Pulse import fire_pulse, fire_burst, format_report
+from PCCS_GPIO import PulseLines
+from PCCS_SPI import (SpiTransport, resync, ReadyPoll, run_interleaved, SettleStats, READY_TIMEOUT, SCAN_TIMEOUT,
+                      PROBE_SETTLE)
 
 broker_ip = "192.168.110.110"  # Replace with Pi's IP (Or where ever the MQTT Broker is initialized), see GitHub readme
 
@@ -45,24 +49,15 @@ TOPIC_LIGHTBAR_DATA = "pccs/lightbar/data"
 TOPIC_STATUS = "pccs/status/+"
 TOPIC_ERROR = "pccs/error/+"
 
-# Defining of the GPIO Pins that are used throughout
-
-chip = gpiod.Chip('gpiochip4')
-
-Pulse_En = chip.get_line(14)
-Pulse_En.request(consumer="Pulse_En", type=gpiod.LINE_REQ_DIR_OUT)
+# The Subs expect the event id in front of the data and send it back with ready_for_flash (see PCCS_Control), a ready
+# for another event than the current one is not counted. The data is only staged on the Subs until the commit with
+# the same id.
+TOPIC_COMMIT = "pccs/commit"
+EVENT_HEADER = struct.Struct(">I")
+current_event = 0
 
-Pulse_Send = chip.get_line(23)
-Pulse_Send.request(consumer="Pulse_Send", type=gpiod.LINE_REQ_DIR_OUT)
-
-Sys_Rst = chip.get_line(26)
-Sys_Rst.request(consumer="Sys_Rst", type=gpiod.LINE_REQ_DIR_OUT)
-
-OE = chip.get_line(15)
-OE.request(consumer="OE", type=gpiod.LINE_REQ_DIR_OUT)
-
-Trigger_Send = chip.get_line(24)
-Trigger_Send.request(consumer="Trigger_Send", type=gpiod.LINE_REQ_DIR_OUT)
+# The GPIO Pins that are used throughout, requested together (see PCCS_GPIO)
+pulse_lines = PulseLines()
 
 # Defining of the bus and address for the length control Potentiometer.
 bus = smbus.SMBus(1)
@@ -85,50 +80,26 @@ def send_pulse(trigger):
     # Trigger_Send is the optional triggering of the MilliDAQ - Function
     # Pulse_Send is the signal that starts the one-shots, creating the pulse
 
-    Sys_Rst.set_value(0)
-    Sys_Rst.set_value(1)
+    # The lines are set in bulk from the compiled waveforms, a step per call (see PCCS_GPIO and PCCS_Pulse)
 
-    OE.set_value(0)
-    Pulse_En.set_value(1)
     print("Pulse  Allowed")
-    Trigger_Send.set_value(trigger)
-    Pulse_Send.set_value(1)
-
-    time.sleep(.1)
-
-    Trigger_Send.set_value(0)
-    Pulse_Send.set_value(0)
-    Pulse_En.set_value(0)
-    OE.set_value(1)
+    fire_pulse(pulse_lines, trigger)
     print("Pulse No longer allowed")
 
 
-def send_fastpulse(trigger):
-    # Same as the regular pulse with a different time.sleep, can become a function
-    Sys_Rst.set_value(0)
-    Sys_Rst.set_value(1)
-
-    OE.set_value(0)
-    Pulse_En.set_value(1)
-    print("Pulse  Allowed")
-
-    Trigger_Send.set_value(trigger)
-    Pulse_Send.set_value(1)
-    time.sleep(1 / 300)  # 300Hz for DRS
-
-    Trigger_Send.set_value(0)
-    Pulse_Send.set_value(0)
-
-    Pulse_En.set_value(0)
-    OE.set_value(1)
-    print("Pulse No longer allowed")
+def send_fastpulse(trigger, flashing_hz=300, number_of_pulses=1):
+    # The regular pulse number_of_pulses times at flashing_hz (300Hz for DRS). The pulses are on absolute deadlines
+    # (see PCCS_Pulse) so the rate doesn't drift, nothing is printed until the burst is over.
+    report = fire_burst(pulse_lines, trigger, flashing_hz, number_of_pulses)
+    print(f"Fast Flash Over, {format_report(report)}")
+    return report
 
 
 def set_length(length):
     # Set the length of the LED pulse.
 
-    # First validate that length is a digit and within the range 100-1100
-    if not length.isdigit() or int(length) < 100 or int(length) > 1100:
+    # First validate that length is a number and within the range 100-1100
+    if not isinstance(length, int) or length < 100 or length > 1100:
         # if it is not a number, too big or too small make it 500
         length = 500
 
@@ -156,8 +127,8 @@ class Import_csv:
     # Aditionally a repeat column could be added to each flashing event in the csv file to allow more compression.
 
     def __init__(self, csv_file, repeat_times=1):
-        # Data array that will store the csv file
-        self.data = []
+        # The csv file is not loaded into memory, start_csv_run streams the rows from it one at a time
+        self.csv_file = csv_file
         # The Import_csv object itself initializes a Detector object
         # The detector object was coded around the bar detector, with a number of "bar layers" (16 channels) as a param
         # For the case of the Slab detector, we only need 24 channels (each of which have 2 PMTs on them) so we
@@ -166,16 +137,6 @@ class Import_csv:
         self.repeat = repeat_times
         self.good_events = 0
 
-        # Opening the CSV file and emptying each row into the self.data array
-        with open(csv_file, newline='') as csvfile:
-            reader = csv.reader(csvfile)
-            # Skip the header row
-            next(reader)
-            # Iterate over each row in the CSV file
-            for row in reader:
-                # Append each row to the data list
-                self.data.append(row)
-
     # This function is utilized to sort the data into ones that "necessarily" need the data to be transmitted
     # throughout the system and which ones we can just flash the same settings again. We also use the code in
     # the first column of the csv to categorize the data as regular slab data or as lightbar data (other PCCS use-case).
@@ -184,60 +145,60 @@ class Import_csv:
     def start_csv_run(self):
         # repeat the number specified in the object init
         for repeat_times in range(0, self.repeat):
-            # loop through every row (flashing event)
-            for flashing_event in range(len(self.data)):
-                datai = self.data[flashing_event]
+            # loop through every segment, the file is re-opened for every repeat and the rows come already cleaned
+            # (4000 DAC count limit, 65535 for lightbar) and with identical consecutive rows collapsed into one
+            # segment (flashing setup + number of flashes) from the PCCS_Plan pipeline
+            for segment in iter_segments(self.csv_file):
 
                 # detector/use-case mentioned above
-                detecor_type = datai[0]
+                detecor_type = segment.detector_type
 
                 # Debug
-                # print(datai, detecor_type)
-
-                # If the info in for example 1000 flashing events are the same, this makes it so only 6 times is
-                # data actually moved to the pico and then bases. for tthe rest we just fire the LED pulse. Also ensure
-                # that previous event transfer from to the sub PCCS was successful.
-                if flashing_event > 6 and self.data[flashing_event - 5] == datai and self.good_events == 1:
-                    send_fastpulse()
-                    print("Fast Flash")
-                # If not, give the data to the respective use-case
+                # print(segment, detecor_type)
+
+                # Give the data to the respective use-case, which moves it to the picos and bases and fires the
+                # first pulse
+                if segment.repeat == 0:
+                    continue
                 elif detecor_type == 'lightbar':
                     print("Slow_Flash")
-                    self.lightbar_run(datai)
+                    self.lightbar_run(segment)
                 # This is the one we are interested in, the slab_run function is the next step of the data pipeline.
                 elif detecor_type == 'slab':
-                    self.slab_run(datai)
+                    self.slab_run(segment)
                 else:
                     print("Wrong detector type format given")
                     exit()
+
+                # If the info in for example 1000 flashing events are the same, the data is only moved to the pico
+                # and then bases once, for the rest we just fire the LED pulse. Only if the data transfer to the
+                # sub PCCS was successful.
+                if self.good_events == 1 and segment.repeat > 1:
+                    send_fastpulse(segment.trigger, number_of_pulses=segment.repeat - 1)
             time.sleep(0.5)
 
+        # How long the Picos took to apply the frames, and the dead time the polling removed against the fixed sleeps
+        for layer in self.odetector.olayer:
+            print(f"Pico {layer.cs} settle times: {layer.settle_stats.summary()}")
+            print(f"Pico {layer.cs} returns: {layer.history.summary()}")
+
     # Process the data in the csv for the different detector functions
-    def slab_run(self, datai):
+    def slab_run(self, event):
         time.sleep(1)
         print("Entered Slab Run")
 
         # If we trigger MilliDAQ or not
-        trigger = int(datai[3])
+        trigger = event.trigger
         # Length of LED Pulse ~ 100-1100 ns
-        pulse_length = datai[4]
+        pulse_length = event.pulse_length
         set_length(pulse_length)
-        # The data for each of the 192 channels (PMT Leds) in the Slab detector
-        chan_val = datai[5:197]
-
-        # Clean up the CSV, limit the voltage to be 4000 DAC counts (voltage setter).
-        processed_chan_val = [
-            '0' if val.strip() == '' or not val.strip().isdigit()
-            else ('4000' if int(val) > 4000 else val.strip())
-            for val in chan_val
-        ]
-
-        # Split the Data for the whole detector into 4 parts for each slab layer. The zeros are needed here because
-        # the detector objects expects data in 32 value amounts - corresponding to the maximum channels on a single
-        # blade pair.
-        data_segments_main = processed_chan_val[0:48] + ['0'] * 16
-        data_sub = [int(x) for x in processed_chan_val[48:192]]
-        data_slices = [data_sub[i * 48:(i + 1) * 48] for i in range(3)]
+
+        # The data for each of the 192 channels (PMT Leds) in the Slab detector has already been cleaned (limited to
+        # 4000 DAC counts) and split into the 4 packed ">48H" slices for each slab layer.
+        # The zeros are needed here because the detector objects expects data in 32 value amounts - corresponding to
+        # the maximum channels on a single blade pair.
+        data_segments_main = payload_counts(event.payloads[0]) + [0] * 16
+        data_slices = event.payloads[1:]
 
         # Pass the main data segment to the detector object's function
         # Then actually send the data to the picos and the detector's bases
@@ -250,15 +211,18 @@ class Import_csv:
 
         # Ready_lock is a blocking method for the set ready_for_flash. It is used to keep track of when all hand-shook
         # devices have successfully sent their data to the picos and received good responses.
+        global current_event
         with ready_lock:
+            current_event += 1
             ready_for_flash.clear()
+        header = EVENT_HEADER.pack(current_event)
 
-        for i, slice_ in enumerate(data_slices):
-            # For each Sub PCCS, format the Data it needs into the MQTT req struct
+        for i, packed in enumerate(data_slices):
+            # For each Sub PCCS, the Data it needs is already in the MQTT req struct
             # Publish the data to the topic below, with /{device_id}
-            packed = struct.pack(">48H", *slice_)
             device_id = f"PCCS_Sub_{i + 1}"
-            client.publish(f"pccs/data/{device_id}", packed)
+            client.publish(f"pccs/data/{device_id}", header + packed)
+        client.publish(TOPIC_COMMIT, header)
 
         # After sending all the instructions, we wait for the Sub PCCS to respond ready, if within 10 seconds
         # not every PCCS has responded, we will not send the pulse and instead skip the pulse, moving to the
@@ -273,26 +237,19 @@ class Import_csv:
             self.good_events = 0
             time.sleep(0.50)
 
-    def lightbar_run(self, datai):
+    def lightbar_run(self, event):
         # Will not be described here, a similar idea expect now the previous voltage values are now 2 bytes which
         # we used the first to denote the location/LED on in the lightbar and the second as a voltage
+        # (the cleaning stage limits lightbar rows to 65535 instead of 4000)
         print("Entered Lightbar Run")
-        trigger = datai[3]
-        pulse_length = datai[4]
-        chan_val = datai[5:197]
-
-        processed_chan_val = [
-            '0' if val.strip() == '' or not val.strip().isdigit()
-            else ('65535' if int(val) > 65535 else val.strip())
-            for val in chan_val
-        ]
+        trigger = event.trigger
+        pulse_length = event.pulse_length
 
-        data_segments_main = processed_chan_val[0:48] + ['0'] * 16
-        data_sub = [int(x) for x in processed_chan_val[48:192]]
+        data_segments_main = payload_counts(event.payloads[0]) + [0] * 16
 
         # print("data_main", data_segments_main)
-        # print("data_sub", data_sub)
-        packed_data = struct.pack(">144H", *data_sub)
+        # The 144 sub values are the 3 sub payloads back to back, the same as packing them as ">144H"
+        packed_data = b"".join(event.payloads[1:])
 
         client.publish("pccs/lightbar/data", packed_data)
 
@@ -302,6 +259,7 @@ class Import_csv:
 
         self.odetector.send_lightbar_data()
         send_pulse(trigger)
+        self.good_events = 1
 
         time.sleep(0.50)
 
@@ -318,16 +276,19 @@ class Detector:
     # the slab layer that is connected to as the "Detector" object with the first 8 slabs being "DetectorLayer 1" object
     # and the last 4 being "DetectorLayer 2" object.
 
-    def __init__(self, number_of_layers):
+    def __init__(self, number_of_layers, spi=None, poll_ready=False):
         # Transfer the called number of layers into a variable able to be used in the functions
         self.number_of_layers = number_of_layers
 
-        # Open the SPI object, this object is used for every communication
-        self.spi = spidev.SpiDev()
+        # The SPI transport, this object is used for every communication. It keeps one open handle per chip select
+        # (DetectorLayer) for the whole run, each with its own clock, see PCCS_SPI
+        self.spi = spi if spi is not None else SpiTransport()
 
         # Create an array of the DetectorLayer Objects to be used in loops.
         # We assign the SPI object to each DetectorLayer where the communication happens.
-        self.olayer = [DetectorLayer(_, self.spi) for _ in range(number_of_layers)]
+        # poll_ready - wait for the Picos to be done with every frame by polling them instead of fixed sleeps (off by
+        # default, the polling has not been checked on real Picos yet)
+        self.olayer = [DetectorLayer(_, self.spi, poll_ready) for _ in range(number_of_layers)]
 
         # TODO Figure out if this fixes having to run rpi5.py
         #  self.i2c_scan()
@@ -336,10 +297,9 @@ class Detector:
     # and splitting the function input into 4, I will instead focus on describing the way the functions work in the
     # DetectorLayer Object
 
-    # Scans the I2C devices in each DetectorLayer Object
+    # Scans the I2C devices in each DetectorLayer Object, all Picos at the same time
     def i2c_scan(self):
-        for index in range(self.number_of_layers):
-            self.olayer[index].layer_scan()
+        run_interleaved([layer.scan_task() for layer in self.olayer])
 
     # Sends the flashing_trial data for formatting into Pico acceptable arrays for each DetectorLayer Object
     # Each "DetectorLayer" Object Controls one blade pair, which is 16 channels, slab = 32 PMTs.
@@ -348,14 +308,14 @@ class Detector:
             self.olayer[i].set_data(chan_val[i * 32:(i + 1) * 32])
 
     # Sends the formatted arrays of data from each DetectorLayer Object to its respective Pico via SPI
+    # The layers are interleaved (see PCCS_SPI.run_interleaved), while one Pico does its DAC writes the next one gets
+    # its frame, so this takes about as long as the slowest blade pair instead of all of them one after the other.
     def send_slab_data(self):
-        for _ in range(len(self.olayer)):
-            self.olayer[_].send_slab_data()
+        run_interleaved([layer.slab_task() for layer in self.olayer])
 
     # Same idea but for lightbar use-case
     def send_lightbar_data(self):
-        for _ in range(len(self.olayer)):
-            self.olayer[_].send_lightbar_data()
+        run_interleaved([layer.lightbar_task() for layer in self.olayer])
 
 
 # The DetectorLayer object is the lowest level object this code.
@@ -397,16 +357,28 @@ class Detector:
 
 class DetectorLayer:
     # The detector Layer class is initialized with an ID and the SPI object created by the detector object.
-    def __init__(self, cs_id, detector_spi):
-        # Two data arrays, which will be filled with the SPI frame bytes are created.
-        # We create two serperate arrays to allow for the two frame setup needed for the Slab detector's 2 bases per ch
-        self.data_array = bytearray()
-        self.data_array2 = bytearray()
+    def __init__(self, cs_id, detector_spi, poll_ready=False):
+        # The SPI frames are built into preallocated buffers by the shared frame encoder (see PCCS_Frame).
+        # It holds the two frames needed for the Slab detector's 2 bases per ch, plus the bar and scan frames.
+        self.encoder = FrameEncoder()
 
         # The "previous array" will be used to ensure data security and fix desync,
         # The picos will return the first and last four values received in the last frame stored in Pico Return
         self.previous_array = ()
         self.pico_return = None
+        # How many bytes behind the frames the Pico's echo runs, measured by the last resync (see PCCS_SPI.resync)
+        self.echo_shift = 0
+
+        # After a frame the Pico spends some time on the DAC writes (I2C), with poll_ready it is polled with status
+        # frames until it is done instead of sleeping a fixed time (see PCCS_SPI.wait_ready). The settle times are kept
+        # per opcode. The frames are sent by tasks (the *_task generators) that yield while the Pico is busy, so the
+        # Detector can interleave the layers, the send_* functions run one on its own.
+        self.poll_ready = poll_ready
+        self.settle_stats = SettleStats()
+        self.status_seq = 0
+
+        # Every Pico return is decoded and kept in a ring buffer (see PCCS_Return)
+        self.history = ReturnHistory()
 
         # Taking object parameters to variables to use
         self.spi = detector_spi
@@ -414,167 +386,82 @@ class DetectorLayer:
 
     def set_data(self, chan_val):
         # One of the Main Functions used by the Detector Object,
-        # It creates the boolean mask of the data calls the functions that create the SPI frame (other than opcode)
-
-        print("Chan Val in Set Data", chan_val)
-        bool_data = [(val != '0' and val != '') for val in chan_val]  # lets pulse go to non zero channels
-        print("Bool Data in Set Data", bool_data)
-        voltage_data = chan_val
-        # These functions are described below
-        self.setByteData(bool_data)
-        self.setVoltage(voltage_data)
-
-    def setByteData(self, bool_data):
-
-        # This function creates the pattern bytes, (Bytes 2,3) in the SPI frame
-        # We do this by first turning the voltage data in a bool map, 1 for if voltage is non-zero, else 0
-        # we then perform bitwise operations until the outcome is what is described in the frame
-
-        # Debug
-        # print(bool_data)
-
-        # Local bytearray for storing the final values to append to the data arrays
-        pattern_bytes = bytearray()
-
-        # for the slab detector, we have up to 32 voltages to assign with only 16 channels
-        # We must then first do an OR operation on each 2 pairs of bool data
-        # That is, if one of the LEDs is going to be flashed but not the other we must still allow the pulse to go to
-        # that channel. For regular bar frame there are only 16 voltage values.
-        if len(bool_data) == 32:
-            slab_bool = []
-            print("Slab run bool data raw", bool_data)
-            for i in range(0, len(bool_data), 2):
-                # Perform OR operation on each pair and append to the result
-                slab_bool.append((1 if bool_data[i] | bool_data[i + 1] else 0))
-            print("Slab run bool data appended: ", slab_bool)
-            bool_data = slab_bool
-
-        # Construct the first byte
-        byte1 = 0
-        for i in range(8):
-            if bool_data[i]:
-                byte1 |= (1 << (7 - i))  # Set the bit at position (7 - i) if the boolean value is True
-
-        # Construct the second byte
-        byte2 = 0
-        for i in range(8, 16):
-            if bool_data[i]:
-                byte2 |= (1 << (15 - i))  # Set the bit at position (15 - i) if the boolean value is True
+        # It creates the SPI frame (other than opcode) from the voltages. The pattern bytes (Bytes 2,3) are the
+        # bool map of the non-zero voltages, for the slab detector we have up to 32 voltages to assign with only 16
+        # channels so each pair is OR'ed first, if one of the LEDs is going to be flashed but not the other we must
+        # still allow the pulse to go to that channel. The voltages, which are capped at 4000, follow as 2 bytes each
+        # (high byte first), 16 in each frame. All of that is done with a few NumPy operations by the encoder.
 
         # Debug
-        # print(byte1)
-        # print(byte2)
-
-        # Append the bytes to the local array and then extend the data arrays by this local array.
-
-        pattern_bytes.append(byte1)
-        pattern_bytes.append(byte2)
-        self.data_array.extend(pattern_bytes)
-        self.data_array2.extend(pattern_bytes)
-
-
-        # Debug
-        # print(self.data_array)
-        # print(self.data_array2)
-
-    def setVoltage(self, voltage):
-
-        # This Code formats the voltages values, which are capped at 4000 into the two byte format described before
-        # Create a local array which we then extend into the data arrays
-        voltage_bytes = bytearray()
-
-        for value in voltage:
-            value = int(value)  # Convert value to integer
-            voltage_bytes.append((value >> 8) & 0xFF)  # High byte (move the value by 8 bits and mask into 0xFF)
-            voltage_bytes.append(value & 0xFF)  # Low byte
-
-        # Debug
-        # print(f"Voltage bytes length: {len(voltage_bytes)}")
-        # print(f"Voltage bytes content: {voltage_bytes}")
-
-        # If slab data append to both arrays, if bar only to the first
-        if len(voltage) == 32:
-            self.data_array.extend(voltage_bytes[:32])  # First 32 bytes
-            self.data_array2.extend(voltage_bytes[32:64])  # Next 32 bytes
-        else:
-            self.data_array.extend(voltage_bytes)
-
-        # Debug
-        # print(self.data_array)
-        # print(self.data_array2)
+        # print("Chan Val in Set Data", chan_val)
+        self.encoder.set_data(chan_val)
 
     def send_slab_data(self):
+        run_interleaved([self.slab_task()])
+
+    def slab_task(self):
 
         # Sends 2 frames to the Pico, one for each blade in the blade pair
         # This is needed as 1 layer on the slab is 12*2 PMTs, need two 16 PMT frames.
         # A single Frame only supports 16 PMTs/Voltages.
 
-        # Open the SPI Bus, initialize at a slow speed
-        # mode = 0 is for clock phase, don't change
-
-        self.spi.open(0, self.cs)
-        self.spi.max_speed_hz = 50 * 1000
-        self.spi.mode = 0
+        # The SPI handle of this chip select is already open and configured (clock and mode) by the transport
 
         # Debug
         # print(data)
 
-        # Create the SPI Frame, Opcode Data, extend by the Opcode and by the finalized data array which
-        # has the pattern bytes and the voltage bytes.
+        # The SPI Frames, Opcode Data, the opcode followed by the pattern bytes and the voltage bytes, straight out of
+        # the encoder's buffers.
 
-        opcode_data1 = bytearray()
-        opcode_data1.extend([0xff, 0xfc])
-        opcode_data1.extend(self.data_array)
+        opcode_data1, opcode_data2 = self.encoder.slab_frames()
 
-        # Transfer the data to the spi using xfer3
+        # Transfer the data to the spi (xfer3 on this chip select's handle)
         # Since SPI is a two-way communication, for every byte that is sent, a byte is received
         # We write this return into the pico return variable which we then process verify is working correctly with the
         # verification function
-        self.pico_return = self.spi.xfer3(opcode_data1)
-        self.verification(opcode_data1)
-
-        # Give time for the Pico to perform the voltage settings on each base
-        time.sleep(0.5)
+        self.pico_return = self.spi.transfer(self.cs, opcode_data1)
+        if self.verification(opcode_data1):
+            # Give time for the Pico to perform the voltage settings on each base
+            yield from self.settle(opcode_data1, 0.5)
 
-        # Repeat with the second half of the data
-        opcode_data2 = bytearray()
-        opcode_data2.extend([0xff, 0xfd])
-        opcode_data2.extend(self.data_array2)
-        self.pico_return = self.spi.xfer3(opcode_data2)
-        self.verification(opcode_data2)
+        # Repeat with the second half of the data, it is also settled so the bases are set before the pulse
+        self.pico_return = self.spi.transfer(self.cs, opcode_data2)
+        if self.verification(opcode_data2):
+            yield from self.settle(opcode_data2, 0)
 
         # Close the SPI Bus, clear the two data arrays for the next flashing event.
-        self.spi.close()
         self.clear()
 
     def verification(self, new_previous):
 
         # This function does some checks on the Pico's returned data
         # It and also can detect if a pico is actually connected and if it is desynced.
-        # TODO Extract new error Pico Codes and Base infomation from the remaining pico return values
-        #  Use these in the MQTT Server
+        # The whole return (sync state, echo, the Pico's status with the failing channels and bases found) is decoded
+        # into the history (see PCCS_Return), summarised in the end of the run
 
         # Debug
         # print(self.pico_return)
         # print(self.previous_array)
 
+        self.history.add(self.pico_return, self.previous_array, self.echo_shift, new_previous[1])
+
         if (sum(self.pico_return) == 0):
             # If the return is all zeros, either the Pico is dead or there is none connected
             print("No Pico in this")
             self.previous_array = tuple(new_previous)
-            return
+            return False
         elif (self.pico_return[4] == [255] or self.previous_array == ()):
             # The defult value on startup from the Pico, tells us something is connected
             print("initial loops")
             self.previous_array = tuple(new_previous)
-            return
-        elif (self.pico_return[0:3] == self.previous_array[0:3]):
+            return True
+        elif (self.pico_return[self.echo_shift:self.echo_shift + 3] == self.previous_array[0:3]):
             # For the second flashing onwards, the pico return's first 4 bytes should match up with the previous
             # frames first 4 values
             print("Verified Correct")
             # update the previous array with the new array provided to the function
             self.previous_array = tuple(new_previous)
-            return
+            return True
         else:
             # If none of the conditions are met, that is we get random values, we enter the desync mode
             # Currently we do a pretty complex process to fix the desync
@@ -582,128 +469,98 @@ class DetectorLayer:
             log_timestamp(event="Desync detected")
             print("Entering Desync Fixing")
             self.desync_protocol()
+            return False
+
+    def settle(self, frame, fixed, timeout=READY_TIMEOUT):
+        # Task that waits for the Pico to be done with frame (sent and verified), fixed is the sleep used without
+        # polling. Returns False if the Pico never came back, the verification of the next frame finds the desync.
+        if not self.poll_ready:
+            yield time.monotonic() + fixed
+            return True
+        self.status_seq += 1
+        result = yield ReadyPoll(self.spi, self.cs, frame, self.status_seq, timeout)
+        self.settle_stats.record(frame[1], result, fixed)
+        if result.ready:
+            self.previous_array = tuple(result.last_frame)
+            self.echo_shift = result.shift
+            # The Pico prints the status page before it takes the next frame
+            yield time.monotonic() + PROBE_SETTLE
+        else:
+            print(f"Pico {self.cs} not done with frame 0x{frame[1]:02x} after {result.settle * 1000:.0f} ms")
+            log_timestamp(event=f"Pico {self.cs} not ready after frame 0x{frame[1]:02x}")
+        return result.ready
 
     def desync_protocol(self):
         # When desynced the pico is recieving the opcode and data in the wrong order.
-        # That is instead of the Pico's rolling buffer starting with the 0xff 0xf_ it starts with some other bytes
-        # Typically the offset returns to some fixed value in the voltage bytes
-
-        # Currently to fix, the desync, we send an array 0-35 two times to get some information from the
-        # Pico return as to what the desync ofset is.
-        # We then send a complementary short array which should reallign the buffer
-        # Finally we send a 0xFF followed by all 0x00s twice to check the pico return and ensure that it is alligned.
-
-        self.spi.open(0, self.cs)
-        self.spi.max_speed_hz = 50 * 1000
-        self.spi.mode = 0
-
-        desync_test = bytearray()
-        desync_fix = bytearray()
-
-        desync_test.extend([i for i in range(36)])  # An array 0-35 in bytes
-        print(desync_test)
-        time.sleep(0.5)
-        print("Zeroth Test send", self.spi.xfer3(desync_test))
-        time.sleep(0.5)
-        test_return1 = self.spi.xfer3(desync_test)
-        print(test_return1)
-        print("CALCULATED DESYNC = ", test_return1[-1])
-
-        time.sleep(0.5)
-        # int(test_return1[-1])
-        desync_fix.extend([i for i in range(test_return1[-1] + 1)])
-        print(desync_fix)
-        time.sleep(0.5)
-        test_return2 = self.spi.xfer3(desync_fix)
-
-        print(test_return2)
-        time.sleep(0.5)
-        revert_array = bytearray()
-        revert_array.extend([255, 255])
-        revert_array.extend([0 for i in range(34)])
-        test_return3 = self.spi.xfer3(revert_array)
-        self.previous_array = tuple(revert_array)
-        print(test_return3[-1])
-
-        self.spi.close()
-
-        print("Desync Hopefully fixed")
-        log_timestamp(event="Hopefully fixed")
-        print("prev_return = ", self.previous_array)
+        # The offset is read from the echo of resync frames, a short transfer realigns the Pico and probe frames check
+        # it worked, retried with a backoff if not (see PCCS_SPI.resync)
+
+        result = resync(self.spi, self.cs)
+        self.previous_array = tuple(result.last_frame)
+
+        if result.ok:
+            self.echo_shift = result.shift
+            print(f"Desync fixed in {result.elapsed * 1000:.0f} ms ({result.attempts} attempts)")
+            log_timestamp(event=f"Desync fixed in {result.elapsed * 1000:.0f} ms, {result.attempts} attempts, "
+                                f"echo shift {result.shift}")
+        else:
+            print(f"Desync NOT fixed after {result.attempts} attempts")
+            log_timestamp(event=f"Desync not fixed after {result.attempts} attempts")
 
     def layer_scan(self):
+        run_interleaved([self.scan_task()])
+
+    def scan_task(self):
         # This function just sends the opcode to perform the device scan followed by a bunch of zeros
         # The Pico does the scan by attempting to communicate dummy data to the known I2C addresses.
         # If the I2C returns non-zero, we successfully found something, if not then we conclude that there is no device
         # The Pico scans the addresses for the V4,V5 and V6 bases, with the V5 and V6 having 2 addresses
 
-        self.spi.open(0, self.cs)
-        self.spi.max_speed_hz = 50 * 1000
-        self.spi.mode = 0
-
         # print(data)
         # for byte in data:
-        #     self.spi.xfer3([byte])
-        opcode_scan = bytearray()
-        opcode_scan.extend([0xff, 0xfe])
-        opcode_scan.extend([0x00 for _ in range(34)])
+        #     self.spi.transfer(self.cs, [byte])
+        opcode_scan = self.encoder.scan_frame()
         # self.display(opcode_scan)
-        self.pico_return = self.spi.xfer3(opcode_scan)
-        self.verification(opcode_scan)
-        self.spi.close()
+        self.pico_return = self.spi.transfer(self.cs, opcode_scan)
+        if self.verification(opcode_scan):
+            # The scan goes over every I2C address, the first frames after it would otherwise arrive mid scan
+            yield from self.settle(opcode_scan, 0, SCAN_TIMEOUT)
         self.clear()
 
     def clear(self):
-        # Clears the two data arrays
-        self.data_array.clear()
-        self.data_array2.clear()
+        # Clears the frame data (opcodes stay)
+        self.encoder.clear()
 
     def send_data(self):
         # The command to send the data for Bar like data (similar logic to the slab)
 
-        # Enable SPI
-        self.spi.open(0, self.cs)
-        self.spi.max_speed_hz = 50 * 1000
-        self.spi.mode = 0
-        opcode_data = bytearray()
-        opcode_data.extend([0xff, 0xff])  # Bar detector Opcode
-        opcode_data.extend(self.data_array)
-        self.pico_return = self.spi.xfer3(opcode_data)
-        self.spi.close()
+        opcode_data = self.encoder.bar_frame()  # Bar detector Opcode
+        self.pico_return = self.spi.transfer(self.cs, opcode_data)
 
         self.verification(opcode_data)
 
         self.clear()
 
     def send_lightbar_data(self):
+        run_interleaved([self.lightbar_task()])
+
+    def lightbar_task(self):
         # Send Lightbar data. Again similar logic to sending the slab but now the opcode is different
         # New code to send 2 frames to the Pico,
         # This is needed as 1 layer on the slab is 16*2 PMTs, need 2x the DAC data.
 
-        # Enable SPI
-
-        self.spi.open(0, self.cs)
-        self.spi.max_speed_hz = 50 * 1000
-        self.spi.mode = 0
-
         # print(data)
         # for byte in data:
-        #     self.spi.xfer3([byte])
-        opcode_data1 = bytearray()
-        opcode_data1.extend([0xff, 0xfa])  # Lightbar Opcode 1
-        opcode_data1.extend(self.data_array)
-        self.pico_return = self.spi.xfer3(opcode_data1)
-        self.verification(opcode_data1)
-
-        time.sleep(0.10)
-
-        opcode_data2 = bytearray()
-        opcode_data2.extend([0xff, 0xfb])  # Lightbar Opcode 2
-        opcode_data2.extend(self.data_array2)
-        self.pico_return = self.spi.xfer3(opcode_data2)
-        self.verification(opcode_data2)
-
-        self.spi.close()
+        #     self.spi.transfer(self.cs, [byte])
+        opcode_data1, opcode_data2 = self.encoder.lightbar_frames()  # Lightbar Opcodes 1 and 2
+        self.pico_return = self.spi.transfer(self.cs, opcode_data1)
+        if self.verification(opcode_data1):
+            yield from self.settle(opcode_data1, 0.10)
+
+        self.pico_return = self.spi.transfer(self.cs, opcode_data2)
+        if self.verification(opcode_data2):
+            yield from self.settle(opcode_data2, 0)
+
         self.clear()
 
 
@@ -739,7 +596,10 @@ def on_message(client, userdata, message):
             if status == "ready_for_flash":
                 print(f"{sub_id} is ready for flash.")
                 with ready_lock:
-                    ready_for_flash.add(sub_id)
+                    if data.get("event") == current_event:
+                        ready_for_flash.add(sub_id)
+                    else:
+                        print(f"Discarded stale ready_for_flash from {sub_id} (event {data.get('event')})")
 
             # A heartbeat mechanism is implemented in which the Sub PCCS send out a heartbeat every n seconds.
             # We can use this information to figure out when network connectivity has issues
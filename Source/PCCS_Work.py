@@ -0,0 +1,71 @@
+# PCCS Work - The work queue of the Receiver. The MQTT callback only decodes a message and queues what it asks for
+# (staging the data on the Picos, the device prep, the pulses), one worker thread runs the jobs in the order they
+# came in. paho's network thread is never blocked by the SPI, the I2C scan or a burst, so keepalives, acks and new
+# messages keep flowing while they run.
+#
+# A job can be queued to coalesce: if the job at the back of the queue (not started yet) is of the same kind it is
+# replaced, e.g. of several data messages that came in while the Picos were busy only the newest configuration is
+# staged. Only the back of the queue is replaced, a data message is never moved past a pulse queued after it.
+# cancel() drops the queued jobs of a kind (the pulses, on an abort).
+
+import threading
+import traceback
+from collections import deque, Counter, namedtuple
+
+Job = namedtuple("Job", ["kind", "function", "args"])
+
+
+class WorkQueue:
+    def __init__(self, on_error=None, name="PCCS_Work"):
+        # on_error(kind, traceback text) is called on the worker thread when a job raises
+        self.jobs = deque()
+        self.condition = threading.Condition()
+        self.on_error = on_error
+        self.busy = None  # Kind of the job running
+        self.counts = Counter()  # done, failed, coalesced, cancelled
+        self.thread = threading.Thread(target=self._run, name=name, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def put(self, kind, function, *args, coalesce=False):
+        with self.condition:
+            if coalesce and self.jobs and self.jobs[-1].kind == kind:
+                self.jobs[-1] = Job(kind, function, args)
+                self.counts["coalesced"] += 1
+            else:
+                self.jobs.append(Job(kind, function, args))
+            self.condition.notify()
+
+    def cancel(self, kind):
+        # Drop the queued (not started) jobs of kind, returns how many
+        with self.condition:
+            kept = [job for job in self.jobs if job.kind != kind]
+            cancelled = len(self.jobs) - len(kept)
+            self.jobs = deque(kept)
+            self.counts["cancelled"] += cancelled
+        return cancelled
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.jobs:
+                    self.condition.wait()
+                job = self.jobs.popleft()
+                self.busy = job.kind
+            try:
+                job.function(*job.args)
+                self.counts["done"] += 1
+            except Exception:
+                self.counts["failed"] += 1
+                if self.on_error is not None:
+                    self.on_error(job.kind, traceback.format_exc())
+            finally:
+                self.busy = None
+
+    def status(self):
+        # JSON friendly state, for the heartbeat
+        with self.condition:
+            queued = [job.kind for job in self.jobs]
+        return {"busy": self.busy, "queued": queued, **self.counts}
@@ -48,6 +48,29 @@ int8_t desync_flag = 0;
 
 bool bad_chan[16][2]; 
 
+// Status for the host, written into bytes 5-9 of out_buf after every page (see Source/PCCS_Return.py). Channel i is
+// bit 15 - i, the same order as the pattern bytes.
+#define STATUS_VERSION 1
+uint16_t chan_faults = 0;  // The last write to a base on the channel failed
+uint16_t chan_present = 0; // The last scan found a base on the channel
+
+void setChannelBit(uint16_t *bits, int chan, bool value) {
+    uint16_t bit = 1 << (15 - chan);
+    if (value) {
+        *bits |= bit;
+    } else {
+        *bits &= ~bit;
+    }
+}
+
+void writeStatus(uint8_t *outbuf) {
+    outbuf[5] = STATUS_VERSION;
+    outbuf[6] = chan_faults >> 8;
+    outbuf[7] = chan_faults & 0xFF;
+    outbuf[8] = chan_present >> 8;
+    outbuf[9] = chan_present & 0xFF;
+}
+
 
 void chooseChannel(uint8_t chan){
     if (chan > 15) {
@@ -107,6 +130,7 @@ void versionScan() {
         if (device_count[i] == 0) {
             printf("No devices found in Channel %u\n", i);
         }
+        setChannelBit(&chan_present, i, device_count[i] > 0);
     
     }
 
@@ -202,7 +226,7 @@ void voltageSetting(uint8_t buf[]) {
         // Prepare data bytes for the DAC (12-bit data needs to be split into two bytes)
         uint8_t dac_data[2] = { (uint8_t)(data >> 8), (uint8_t)(data & 0xFF) };
         
-        int ret; //where we will verify if I2C write is successful
+        int ret = 1; //where we will verify if I2C write is successful (stays 1 without a base)
 
         // Send data to DAC/Pot
         switch (address[i][0]) {
@@ -243,6 +267,7 @@ void voltageSetting(uint8_t buf[]) {
                 printf("No recognized address for channel %d\n", i);
                 break;
         }
+        setChannelBit(&chan_faults, i, ret <= 0);
     }
     // To make sure it hasn't crashed
     printf("Set Voltage correctly\n");
@@ -259,6 +284,7 @@ void slab_voltageSetting(uint8_t buf[], int slab_frame_ID) {
     
     for (int i = 0; i < 8; i++) { // Loop over the 8 channels
         chooseChannel(i + slab_frame_ID * 8);
+        bool failed = false;
         
         for(int j = 0; j<2; j++){ //Loop over the potential two bases per channel
 
@@ -273,7 +299,7 @@ void slab_voltageSetting(uint8_t buf[], int slab_frame_ID) {
             // Prepare data bytes for the DAC (12-bit data needs to be split into two bytes)
             uint8_t dac_data[2] = { (uint8_t)(data >> 8), (uint8_t)(data & 0xFF) };
 
-            int ret; //where we will verify if I2C write is successful
+            int ret = 1; //where we will verify if I2C write is successful (stays 1 without a base)
 
             switch (address[i*2 + 8*slab_frame_ID][j]) {
                 case 0x4D:
@@ -313,7 +339,9 @@ void slab_voltageSetting(uint8_t buf[], int slab_frame_ID) {
                     printf("No recognized address for channel %d\n", i);
                     break;
             }
+            failed |= ret <= 0;
         }
+        setChannelBit(&chan_faults, i + slab_frame_ID * 8, failed);
     }
 
 }
@@ -392,6 +420,7 @@ void lightbar(uint8_t buf[], int slab_frame_ID){
         
         chooseChannel(i + slab_frame_ID * 8);
         printf("Choosing Channel: %d\n", i + slab_frame_ID * 8);
+        bool failed = false;
         
         for(int j = 0; j<2; j++){ //Loop over the two bases per channel
 
@@ -412,8 +441,8 @@ void lightbar(uint8_t buf[], int slab_frame_ID){
 
 
  
-            int ret_1; //where we will verify if DAC write is successful
-            int ret_2; //where we will verify if MUX write is successful
+            int ret_1 = 1; //where we will verify if DAC write is successful
+            int ret_2 = 1; //where we will verify if MUX write is successful
 
             printf("Expected Address: %d\n", address[i + slab_frame_ID * 8][j]);
 
@@ -458,7 +487,9 @@ void lightbar(uint8_t buf[], int slab_frame_ID){
                     printf("No recognized address for channel %d\n", i);
                     break;
             }
+            failed |= ret_1 <= 0 || ret_2 <= 0;
         }
+        setChannelBit(&chan_faults, i + slab_frame_ID * 8, failed);
     }
 
     // for (int i = 0; i < 16; i++) {
@@ -574,6 +605,7 @@ int main() {
 
         if (desync_flag == 0){
             processInput(in_buf, out_buf);
+            writeStatus(out_buf);
         }else{
             for (int i = 0; i < 4; i++) {
                 out_buf[i] = in_buf[i];
@@ -1,32 +1,17 @@
 # LV Distribution Board Code
 import random
 import time
-import spidev
 import datetime
 import json
 from collections import Counter
 import os
 import csv
-import gpiod
+from PCCS_Frame import FrameEncoder
+from PCCS_GPIO import PulseLines
+from PCCS_SPI import SpiTransport
 
-chip = gpiod.Chip('gpiochip4')
-
-Pulse_En = chip.get_line(14)
-Pulse_En.request(consumer="Pulse_En", type=gpiod.LINE_REQ_DIR_OUT)
-
-Pulse_Send = chip.get_line(23)
-Pulse_Send.request(consumer="Pulse_Send", type=gpiod.LINE_REQ_DIR_OUT)
-
-
-Sys_Rst = chip.get_line(26)
-Sys_Rst.request(consumer="Sys_Rst", type=gpiod.LINE_REQ_DIR_OUT)
-
-OE = chip.get_line(15)
-OE.request(consumer="OE", type=gpiod.LINE_REQ_DIR_OUT)
-
-
-Trigger_Send = chip.get_line(24)
-Trigger_Send.request(consumer="Trigger_Send", type=gpiod.LINE_REQ_DIR_OUT)
+# The pulse path lines, requested together (see PCCS_GPIO)
+pulse_lines = PulseLines()
 
 # The program works using 3 different objects, A run object which is created every time runs are requested,
 # A detector object which handles the data flow to 5 Detector layer objects, each of which actually send the SPI data
@@ -36,80 +21,31 @@ Trigger_Send.request(consumer="Trigger_Send", type=gpiod.LINE_REQ_DIR_OUT)
 
 class DetectorLayer:
     def __init__(self, cs_id, detector_spi):
-        self.data_array = bytearray()
+        # The bar frame is built into a preallocated buffer by the shared encoder (see PCCS_Frame)
+        self.encoder = FrameEncoder()
         self.spi = detector_spi
         self.cs = cs_id
 
-    def convert_pattern_to_bytes(self, pattern):
-
-        pattern_bytes = bytearray()
-        print(pattern)
-        half_byte_list = [0, 0, 0, 0]
-        counter = 0
-        for row in pattern:
-            half_byte = 0
-            for i, boolean in enumerate(row):
-                if boolean:
-                    half_byte += 2 ** (3 - i)
-            half_byte_list[counter] = half_byte
-            counter += 1
-
-        byte_2 = (half_byte_list[2] << 4) | half_byte_list[3]
-        byte_1 = (half_byte_list[0] << 4) | half_byte_list[1]
-
-        pattern_bytes.append(byte_1)
-        pattern_bytes.append(byte_2)
-
-        # Extend self.data_array with pattern_bytes
-        self.data_array.extend(pattern_bytes)
-
-    def convert_voltage_to_bytes(self, voltage):
-        voltage_bytes = bytearray()
-
-        for value in voltage:
-            voltage_bytes.append((value >> 8) & 0xFF)  # High byte
-            voltage_bytes.append(value & 0xFF)  # Low byte
-
-
-        self.data_array.extend(voltage_bytes)
-
     def set_pattern(self, pattern, voltage):
-        self.convert_pattern_to_bytes(pattern)
-        self.convert_voltage_to_bytes(voltage)
+        # pattern is 4 rows of 4 bools (one half byte each, MSB first), voltage the 16 DAC values
+        self.encoder.set_pattern(pattern, voltage)
 
     def layer_scan(self):
 
-        self.spi.open(0, self.cs)
-        self.spi.max_speed_hz = 50*1000
-        self.spi.mode = 0
-
-
         # print(data)
         # for byte in data:
-        #     self.spi.xfer3([byte])
-        opcode_scan = bytearray()
-        opcode_scan.extend([0xff, 0xfe])
-        opcode_scan.extend([0x00 for _ in range(34)])
+        #     self.spi.transfer(self.cs, [byte])
+        opcode_scan = self.encoder.scan_frame()
         #self.display(opcode_scan)
-        self.spi.xfer3(opcode_scan)
-        self.spi.close()
+        self.spi.transfer(self.cs, opcode_scan)
 
     def send_data(self):
-        # Enable SPI
-
-        self.spi.open(0, self.cs)
-        self.spi.max_speed_hz = 50*1000
-        self.spi.mode = 0
-
         # print(data)
         # for byte in data:
-        #     self.spi.xfer3([byte])
-        opcode_data = bytearray()
-        opcode_data.extend([0xff, 0xff])
-        opcode_data.extend(self.data_array)
+        #     self.spi.transfer(self.cs, [byte])
+        opcode_data = self.encoder.bar_frame()
         self.display(opcode_data)
-        self.spi.xfer3(opcode_data)
-        self.spi.close()
+        self.spi.transfer(self.cs, opcode_data)
 
     def display(self, arr):
         for i, byte_value in enumerate(arr):
@@ -120,33 +56,24 @@ class DetectorLayer:
                 print()
 
     def clear(self):
-        self.data_array.clear()
+        self.encoder.clear()
 
 
 def send_pulse():
-    Sys_Rst.set_value(0)
-    Sys_Rst.set_value(1)
-
-    OE.set_value(0)
-    Pulse_En.set_value(1)
-    print("Pulse  Allowed")
-
-    Trigger_Send.set_value(1)
-    Pulse_Send.set_value(1)
+    pulse_lines.play("rise", 1)
     time.sleep(.00001)
-    Trigger_Send.set_value(0)
+    pulse_lines.play("untrigger", 1)
+    print("Pulse  Allowed")
     time.sleep(.1)
-    Pulse_Send.set_value(0)
-
 
-    Pulse_En.set_value(0)
-    OE.set_value(1)
+    pulse_lines.play("fall", 1)
     print("Pulse No longer allowed")
 
 
 class Detector:
-    def __init__(self, number_of_layers):
-        self.spi = spidev.SpiDev()
+    def __init__(self, number_of_layers, spi=None):
+        # One open SPI handle per chip select for the whole run (see PCCS_SPI)
+        self.spi = spi if spi is not None else SpiTransport()
         self.olayer = [DetectorLayer(_, self.spi) for _ in range(number_of_layers)]
         self.i2c_scan(number_of_layers)
 